@@ -0,0 +1,36 @@
+import os
+
+from fastapi import APIRouter, Depends, HTTPException, Query
+from app.core.auth import verify_token
+from app.services import occupancy
+
+router = APIRouter()
+AVAILABILITY_MAX_CELLS = int(os.getenv("AVAILABILITY_MAX_CELLS", "100000"))
+
+
+@router.get("/availability")
+async def availability(
+    court_ids: list[int] = Query(...),
+    slot_from: int = Query(..., ge=0),
+    slot_to: int = Query(..., ge=0),
+    payload=Depends(verify_token),
+):
+    """
+    Slots sem booking ativa por quadra, de `slot_from` a `slot_to` (inclusive),
+    respondidos do índice em memória. Não consulta o Agenda: um slot livre
+    aqui ainda pode ser recusado por ele no create_booking.
+    """
+    if slot_to < slot_from:
+        raise HTTPException(422, "slot_to must be >= slot_from")
+    if slot_to > occupancy.index.max_slot_id:
+        raise HTTPException(422, f"slot_to must be <= {occupancy.index.max_slot_id}")
+    if len(court_ids) * (slot_to - slot_from + 1) > AVAILABILITY_MAX_CELLS:
+        raise HTTPException(422, f"range larger than {AVAILABILITY_MAX_CELLS} cells")
+    if not occupancy.index.loaded:
+        raise HTTPException(503, "availability index is loading", headers={"Retry-After": "1"})
+    free = occupancy.index.free_slots(court_ids, slot_from, slot_to)
+    return {
+        "slot_from": slot_from,
+        "slot_to": slot_to,
+        "courts": [{"court_id": court_id, "free": free[court_id]} for court_id in court_ids],
+    }
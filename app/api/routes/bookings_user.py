@@ -1,23 +1,44 @@
+import asyncio
+import csv
+import hashlib
+import io
+import json
 import os
-import psycopg2
+import uuid
+from datetime import date, timedelta
 
-from fastapi import APIRouter, HTTPException, Depends
+import httpx
 
-from pydantic import BaseModel
-from typing import List, Optional
+from fastapi import APIRouter, HTTPException, Depends, Query, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+from psycopg2 import errors
+from psycopg2.extras import execute_values
 
-from app.services import agenda_client, payment_client
-from app.api.routes.quotes import calculate_quote
-from app.core.auth import verify_token
-from dotenv import load_dotenv
+from pydantic import BaseModel, Field
+from typing import List, Literal, Optional
 
-load_dotenv()
+from app.core import cache, consistency, db, events
+from app.repositories import bookings
+from app.services import agenda_client, checkout, contention, payment_client
+from app.services.resilience import CircuitOpen
+from app.api.routes.quotes import calculate_quote
+from app.core.auth import has_permission, optional_claims, verify_token
 
 router = APIRouter()
-DATABASE_URL = os.getenv("DATABASE_URL")
-
-def get_conn():
-    return psycopg2.connect(DATABASE_URL, sslmode="require")
+BATCH_MAX_ITEMS = int(os.getenv("BOOKING_BATCH_MAX_ITEMS", "100"))
+BATCH_LOCK_CONCURRENCY = int(os.getenv("BOOKING_BATCH_LOCK_CONCURRENCY", "8"))
+LONG_POLL_MAX_WAIT = float(os.getenv("BOOKING_LONG_POLL_MAX_WAIT", "60"))
+SSE_HEARTBEAT = float(os.getenv("BOOKING_SSE_HEARTBEAT", "15"))
+SSE_MAX_DURATION = float(os.getenv("BOOKING_SSE_MAX_DURATION", "600"))
+FINAL_STATUSES = {"CONFIRMED", "CANCELLED"}
+LIST_MAX_LIMIT = int(os.getenv("BOOKING_LIST_MAX_LIMIT", "200"))
+EXPORT_CHUNK_SIZE = int(os.getenv("BOOKING_EXPORT_CHUNK_SIZE", "2000"))
+# sync: responde com o resultado do Payment; async: 202 + job (app/services/checkout.py)
+CHECKOUT_MODE = os.getenv("CHECKOUT_DEFAULT_MODE", "sync")
+LIST_COLUMNS = ["id", "court_id", "slot_id", "status", "estimate_total", "paid_total", "created_at"]
+
+# eventos vindos de outros workers também derrubam o L1 local (e o load em andamento)
+events.hub.add_listener(lambda event: cache.booking_views.invalidate_local(event["booking_id"]))
 
 
 # ======= MODELS =======
@@ -27,6 +48,11 @@ class BookingCreate(BaseModel):
     extras: List[str] = []
     # não tem mais notes; se o front mandar, será ignorado pelo parse manual abaixo
 
+class BookingBatch(BaseModel):
+    items: List[BookingCreate] = Field(min_length=1, max_length=BATCH_MAX_ITEMS)
+    # atomic: qualquer lock falhou -> nada é criado; best_effort: cria o que der
+    mode: Literal["atomic", "best_effort"] = "atomic"
+
 class BookingCheckout(BaseModel):
     method: str
     coupon: Optional[str] = None
@@ -35,7 +61,7 @@ class BookingCheckout(BaseModel):
 # ======= ENDPOINTS =======
 @router.post("/bookings")
 
-async def create_booking(payload: BookingCreate):
+async def create_booking(payload: BookingCreate, response: Response, claims=Depends(optional_claims)):
     """
     JSON esperado:
     { "court_id": 1, "slot_id": 17, "extras": ["ball","vest"] }
@@ -49,140 +75,586 @@ async def create_booking(payload: BookingCreate):
     estimate = calculate_quote(court_id, slot_id, extras)
     price_map = {e["type"]: float(e["price"]) for e in estimate.get("extras", [])}
 
-    conn = get_conn()
     try:
-        cur = conn.cursor()
+        with contention.gate.claim(court_id, slot_id) as slot:
+            created = await _create_booking(court_id, slot_id, extras, estimate, price_map, claims, slot)
+    except contention.SlotHeld as e:
+        raise HTTPException(status_code=409, detail=f"slot not available: {e}")
+    consistency.tracker.wrote(created["booking_id"], response)
+    return created
 
-        # 1) cria booking (sem coluna notes)
-        cur.execute(
-            """
-            INSERT INTO bookings (court_id, slot_id, status, estimate_total)
-            VALUES (%s, %s, %s, %s)
-            RETURNING id
-            """,
-            (court_id, slot_id, "CREATED", float(estimate["total"])),
-        )
-        booking_id = cur.fetchone()[0]
 
-        # 2) lock no Agenda usando booking_id real
+async def _create_booking(court_id, slot_id, extras, estimate, price_map, claims, slot):
+    async with db.connection() as conn:
         try:
-            lock = agenda_client.create_lock(
-                court_id=court_id, slot_id=slot_id, booking_id=booking_id
-            )
-            if not lock or not lock.get("lock_id"):
-                raise RuntimeError("failed to lock slot")
+            cur = conn.cursor()
+
+            # 1) booking e extras num único statement
+            try:
+                created = await bookings.insert(
+                    cur, court_id, slot_id, float(estimate["total"]), claims and claims.get("sub"),
+                    [(e, price_map.get(e, 0.0)) for e in extras],
+                )
+            except errors.UniqueViolation:
+                # outro worker já tem booking ativa neste slot
+                await conn.rollback()
+                contention.gate.hold(slot, contention.REJECT_TTL)
+                raise HTTPException(status_code=409, detail="slot not available: already booked")
+            booking_id = created["booking_id"]
+
+            # 2) lock no Agenda usando booking_id real
+            try:
+                lock = await agenda_client.get_client().create_lock(
+                    court_id=court_id, slot_id=slot_id, booking_id=booking_id
+                )
+                if not lock or not lock.get("lock_id"):
+                    raise RuntimeError("failed to lock slot")
+            except CircuitOpen as e:
+                await conn.rollback()
+                raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(int(e.retry_after))})
+            except Exception as e:
+                await conn.rollback()
+                if isinstance(e, httpx.HTTPStatusError) and e.response.status_code == 409:
+                    contention.gate.hold(slot, contention.REJECT_TTL)
+                raise HTTPException(status_code=409, detail=f"slot not available: {e}")
+
+            await conn.commit()
+            cur.close()
+            events.hub.publish(created)
+
+            return {
+                "booking_id": booking_id,
+                "status": "CREATED",
+                "estimate": estimate,
+                "lock_id": lock["lock_id"],
+            }
+
+        except HTTPException:
+            raise
         except Exception as e:
-            conn.rollback()
-            raise HTTPException(status_code=409, detail=f"slot not available: {e}")
+            try:
+                await conn.rollback()
+            except Exception:
+                pass
+            raise HTTPException(status_code=500, detail=str(e))
+
+
+def _insert_batch(raw, rows):
+    """
+    Ids na ordem de `rows`; None para o item cujo slot já tem booking ativa
+    (ou repete o slot de um item anterior do lote).
+    """
+    cur = raw.cursor()
+    try:
+        result = execute_values(
+            cur,
+            """
+            INSERT INTO bookings (court_id, slot_id, status, estimate_total, user_sub) VALUES %s
+            ON CONFLICT (court_id, slot_id) WHERE status IN ('CREATED', 'PENDING_PAYMENT', 'CONFIRMED')
+            DO NOTHING
+            RETURNING id, court_id, slot_id
+            """,
+            rows,
+            fetch=True,
+            page_size=len(rows),
+        )
+        inserted = {(court_id, slot_id): booking_id for booking_id, court_id, slot_id in result}
+        return [inserted.pop((row[0], row[1]), None) for row in rows]
+    finally:
+        cur.close()
 
-        # 3) extras
 
-        for e in extras:
+def _finish_batch(raw, failed_ids, extras_rows, created):
+    cur = raw.cursor()
+    try:
+        if failed_ids:
+            cur.execute("DELETE FROM bookings WHERE id = ANY(%s)", (failed_ids,))
+        if extras_rows:
+            execute_values(
+                cur,
+                "INSERT INTO booking_extras (booking_id, type, qty, price) VALUES %s",
+                extras_rows,
+            )
+        if created:
             cur.execute(
-                """
-                INSERT INTO booking_extras (booking_id, type, qty, price)
-                VALUES (%s, %s, %s, %s)
-                """,
-                (booking_id, e, 1, price_map.get(e, 0.0)),
+                "SELECT pg_notify(%s, e) FROM unnest(%s::text[]) AS e",
+                (events.CHANNEL, [json.dumps({**event, "origin": events.origin()}) for event in created]),
             )
-
-        conn.commit()
+        raw.commit()
+    finally:
         cur.close()
 
-        return {
-            "booking_id": booking_id,
-            "status": "CREATED",
-            "estimate": estimate,
-            "lock_id": lock["lock_id"],
-        }
 
-    except HTTPException:
-        raise
-    except Exception as e:
-        try:
-            conn.rollback()
-        except Exception:
-            pass
-        raise HTTPException(status_code=500, detail=str(e))
-    finally:
+async def _release_locks(lock_ids):
+    agenda = agenda_client.get_client()
+    sem = asyncio.Semaphore(BATCH_LOCK_CONCURRENCY)
+
+    async def release(lock_id):
+        async with sem:
+            try:
+                await agenda.release_lock(lock_id)
+            except Exception:
+                # o lock expira sozinho no Agenda (ttl)
+                pass
+
+    await asyncio.gather(*(release(lock_id) for lock_id in lock_ids))
+
+
+@router.post("/bookings/batch")
+async def create_bookings_batch(payload: BookingBatch, response: Response, claims=Depends(optional_claims)):
+    """
+    JSON esperado:
+    { "mode": "atomic" | "best_effort",
+      "items": [{ "court_id": 1, "slot_id": 17, "extras": ["ball"] }, ...] }
+    """
+    items = payload.items
+    estimates = [calculate_quote(i.court_id, i.slot_id, i.extras or []) for i in items]
+
+    async with db.connection() as conn:
+        # 1) todas as bookings num único INSERT multi-row; slot ocupado vira item FAILED
+        booking_ids = await conn.run(
+            _insert_batch,
+            [(i.court_id, i.slot_id, "CREATED", float(e["total"]), claims and claims.get("sub"))
+             for i, e in zip(items, estimates)],
+        )
+        if None in booking_ids and payload.mode == "atomic":
+            await conn.rollback()
+            results = [
+                {"index": index, "status": "FAILED", "error": "slot not available"} if booking_id is None
+                else {"index": index, "status": "ROLLED_BACK", "booking_id": None, "lock_id": None}
+                for index, booking_id in enumerate(booking_ids)
+            ]
+            raise HTTPException(status_code=409, detail={"mode": payload.mode, "results": results})
+
+        # 2) locks no Agenda em paralelo, com fan-out limitado
+        agenda = agenda_client.get_client()
+        sem = asyncio.Semaphore(BATCH_LOCK_CONCURRENCY)
+
+        async def lock(item, booking_id):
+            if booking_id is None:
+                return None, "slot not available"
+            async with sem:
+                try:
+                    result = await agenda.create_lock(
+                        court_id=item.court_id, slot_id=item.slot_id, booking_id=booking_id
+                    )
+                    if not result or not result.get("lock_id"):
+                        raise RuntimeError("failed to lock slot")
+                    return result["lock_id"], None
+                except Exception as e:
+                    return None, f"slot not available: {e}"
+
+        locks = await asyncio.gather(*(lock(i, b) for i, b in zip(items, booking_ids)))
+        taken = [lock_id for lock_id, _ in locks if lock_id]
+        failed = [b for b, (lock_id, _) in zip(booking_ids, locks) if b is not None and not lock_id]
+
+        results = []
+        for index, (booking_id, estimate, (lock_id, error)) in enumerate(zip(booking_ids, estimates, locks)):
+            if lock_id:
+                results.append({"index": index, "booking_id": booking_id, "status": "CREATED",
+                                "estimate": estimate, "lock_id": lock_id})
+            else:
+                results.append({"index": index, "status": "FAILED", "error": error})
+
+        if failed and payload.mode == "atomic":
+            await conn.rollback()
+            await _release_locks(taken)
+            for r in results:
+                if r["status"] == "CREATED":
+                    r.update(status="ROLLED_BACK", booking_id=None, lock_id=None)
+            raise HTTPException(status_code=409, detail={"mode": payload.mode, "results": results})
+
+        # 3) extras das bookings que conseguiram lock, também em lote
+        ok_ids = set(booking_ids) - set(failed) - {None}
+        extras_rows = [
+            (booking_id, e["type"], 1, float(e["price"]))
+            for booking_id, estimate in zip(booking_ids, estimates)
+            if booking_id in ok_ids
+            for e in estimate.get("extras", [])
+        ]
+        created = [
+            {"booking_id": booking_id, "status": "CREATED", "court_id": item.court_id, "slot_id": item.slot_id}
+            for item, booking_id in zip(items, booking_ids)
+            if booking_id in ok_ids
+        ]
         try:
-            conn.close()
-        except Exception:
-            pass
+            await conn.run(_finish_batch, failed, extras_rows, created)
+        except Exception as e:
+            await _release_locks(taken)
+            raise HTTPException(status_code=500, detail=str(e))
+
+    for item, booking_id, (lock_id, _) in zip(items, booking_ids, locks):
+        if lock_id:
+            contention.gate.hold((item.court_id, item.slot_id))
+            consistency.tracker.wrote(booking_id, response)
+    for event in created:
+        events.hub.publish(event)
+
+    return {"mode": payload.mode, "results": results}
+
+
+class BookingFilters(BaseModel):
+    court_id: Optional[int] = None
+    status: Optional[str] = None
+    date_from: Optional[date] = None
+    date_to: Optional[date] = None
+    # só quem tem read:all_bookings escolhe o dono; os demais veem apenas as próprias
+    owner: Optional[str] = None
+
+
+def _filters(claims: dict, filters: BookingFilters) -> BookingFilters:
+    if not has_permission(claims, "read:all_bookings"):
+        filters = filters.model_copy(update={"owner": claims.get("sub")})
+    return filters
+
+
+def _listing_query(filters: BookingFilters, after: Optional[int] = None, limit: Optional[int] = None):
+    where, params = [], []
+    if filters.owner is not None:
+        where.append("user_sub = %s")
+        params.append(filters.owner)
+    if filters.court_id is not None:
+        where.append("court_id = %s")
+        params.append(filters.court_id)
+    if filters.status is not None:
+        where.append("status = %s")
+        params.append(filters.status)
+    if filters.date_from is not None:
+        where.append("created_at >= %s")
+        params.append(filters.date_from)
+    if filters.date_to is not None:
+        where.append("created_at < %s")
+        params.append(filters.date_to + timedelta(days=1))
+    if after is not None:
+        where.append("id > %s")
+        params.append(after)
+    sql = f"SELECT {', '.join(LIST_COLUMNS)} FROM bookings"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY id"
+    if limit is not None:
+        sql += " LIMIT %s"
+        params.append(limit)
+    return sql, params
+
+
+def _row_view(row) -> dict:
+    view = dict(zip(LIST_COLUMNS, row))
+    view["estimate_total"] = float(view["estimate_total"])
+    if view.get("paid_total") is not None:
+        view["paid_total"] = float(view["paid_total"])
+    if view.get("created_at") is not None:
+        view["created_at"] = view["created_at"].isoformat()
+    return view
+
+
+async def _list_bookings(filters: BookingFilters, after: Optional[int], limit: int, request: Request):
+    sql, params = _listing_query(filters, after, limit)
+    async with db.connection(readonly=not consistency.tracker.use_primary(request=request)) as conn:
+        cur = conn.cursor()
+        await cur.execute(sql, params)
+        rows = await cur.fetchall()
+        cur.close()
+    return [_row_view(r) for r in rows]
 
 
+@router.get("/bookings")
+async def list_bookings(
+    request: Request,
+    filters: BookingFilters = Depends(),
+    after: Optional[int] = None,
+    limit: int = Query(50, ge=1, le=LIST_MAX_LIMIT),
+    payload=Depends(verify_token),
+):
+    """Paginação por keyset: passe `next_after` da página anterior em `after`."""
+    items = await _list_bookings(_filters(payload, filters), after, limit, request)
+    return {"items": items, "next_after": items[-1]["id"] if len(items) == limit else None}
 
-@router.get("/bookings/{booking_id}")
-async def get_booking(booking_id: int, payload=Depends(verify_token)):
-    conn = get_conn()
-    try:
+
+@router.get("/me/bookings")
+async def my_bookings(
+    request: Request,
+    after: Optional[int] = None,
+    limit: int = Query(50, ge=1, le=LIST_MAX_LIMIT),
+    payload=Depends(verify_token),
+):
+    return await _list_bookings(BookingFilters(owner=payload.get("sub")), after, limit, request)
+
+
+def _open_export_cursor(raw, sql, params):
+    cur = raw.cursor(name=f"export_{uuid.uuid4().hex}")
+    cur.itersize = EXPORT_CHUNK_SIZE
+    cur.execute(sql, params)
+    return cur
+
+
+def _fetch_chunk(raw, cur):
+    return cur.fetchmany(EXPORT_CHUNK_SIZE)
+
+
+def _close_cursor(raw, cur):
+    cur.close()
+
+
+@router.get("/bookings/export")
+async def export_bookings(
+    request: Request,
+    filters: BookingFilters = Depends(),
+    format: Literal["ndjson", "csv"] = "ndjson",
+    payload=Depends(verify_token),
+):
+    """
+    Exporta todas as bookings do filtro lendo de um cursor no servidor em
+    blocos de EXPORT_CHUNK_SIZE linhas: memória constante e primeiro byte rápido.
+    """
+    sql, params = _listing_query(_filters(payload, filters))
+    readonly = not consistency.tracker.use_primary(request=request)
+
+    async def stream():
+        if format == "csv":
+            yield ",".join(LIST_COLUMNS) + "\n"
+        async with db.connection(readonly=readonly) as conn:
+            cur = await conn.run(_open_export_cursor, sql, params)
+            try:
+                while True:
+                    rows = await conn.run(_fetch_chunk, cur)
+                    if not rows:
+                        break
+                    views = [_row_view(r) for r in rows]
+                    if format == "csv":
+                        buf = io.StringIO()
+                        writer = csv.writer(buf, lineterminator="\n")
+                        writer.writerows([v.get(c) for c in LIST_COLUMNS] for v in views)
+                        yield buf.getvalue()
+                    else:
+                        yield "".join(json.dumps(v) + "\n" for v in views)
+            finally:
+                await conn.run(_close_cursor, cur)
+
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    return StreamingResponse(
+        stream(),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="bookings.{format}"'},
+    )
+
+
+async def _load_booking_view(booking_id: int, primary: bool = False):
+    async with db.connection(readonly=not primary) as conn:
         cur = conn.cursor()
-        cur.execute(
-            "SELECT id, court_id, slot_id, status, estimate_total, paid_total FROM bookings WHERE id=%s",
-            (booking_id,),
-        )
-        row = cur.fetchone()
+        row = await bookings.view(cur, booking_id)
         cur.close()
-        if not row:
+    if not row:
+        return None
+    view = {
+        "id": row[0],
+        "court_id": row[1],
+        "slot_id": row[2],
+        "status": row[3],
+        "estimate_total": float(row[4]),
+        "paid_total": float(row[5]) if row[5] else None,
+    }
+    etag = hashlib.sha1(json.dumps(view, sort_keys=True).encode()).hexdigest()[:16]
+    return {"view": view, "etag": f'"{etag}"'}
+
+
+async def _booking_entry(booking_id: int, request: Optional[Request] = None):
+    # booking recém-alterada (por qualquer worker) ou cliente que acabou de escrever: lê do primário
+    primary = consistency.tracker.use_primary(booking_id, request)
+    return await cache.booking_views.get_or_load(booking_id, lambda: _load_booking_view(booking_id, primary))
+
+
+@router.get("/bookings/{booking_id}")
+async def get_booking(
+    booking_id: int,
+    request: Request,
+    response: Response,
+    wait: float = Query(0, ge=0, le=LONG_POLL_MAX_WAIT),
+    payload=Depends(verify_token),
+):
+    """
+    Com `?wait=N` e If-None-Match igual ao estado atual, segura a requisição
+    até a booking mudar (ou N segundos) em vez de o cliente ficar consultando.
+    """
+    if_none_match = request.headers.get("if-none-match")
+    async with events.hub.subscribe(booking_id) as sub:
+        entry = await _booking_entry(booking_id, request)
+        if entry is None:
             raise HTTPException(404, "booking not found")
-        return {
-            "id": row[0],
-            "court_id": row[1],
-            "slot_id": row[2],
-            "status": row[3],
-            "estimate_total": float(row[4]),
-            "paid_total": float(row[5]) if row[5] else None,
-        }
-    finally:
-        conn.close()
+        if wait and if_none_match == entry["etag"] and entry["view"]["status"] not in FINAL_STATUSES:
+            if await sub.wait(wait) is not None:
+                entry = await _booking_entry(booking_id, request) or entry
+    if if_none_match == entry["etag"]:
+        return Response(status_code=304, headers={"ETag": entry["etag"]})
+    response.headers["ETag"] = entry["etag"]
+    return entry["view"]
+
+
+@router.get("/bookings/{booking_id}/events")
+async def booking_events(booking_id: int, request: Request, payload=Depends(verify_token)):
+    """Server-sent events com o estado da booking; termina em CONFIRMED/CANCELLED."""
+    entry = await _booking_entry(booking_id, request)
+    if entry is None:
+        raise HTTPException(404, "booking not found")
+
+    async def stream():
+        nonlocal entry
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + SSE_MAX_DURATION
+        async with events.hub.subscribe(booking_id) as sub:
+            yield f"event: status\nid: {entry['etag']}\ndata: {json.dumps(entry['view'])}\n\n"
+            while entry["view"]["status"] not in FINAL_STATUSES and loop.time() < deadline:
+                if await sub.wait(SSE_HEARTBEAT) is None:
+                    if await request.is_disconnected():
+                        return
+                    yield ": keepalive\n\n"
+                    continue
+                current = await _booking_entry(booking_id, request)
+                if current is None:
+                    return
+                if current["etag"] != entry["etag"]:
+                    entry = current
+                    yield f"event: status\nid: {entry['etag']}\ndata: {json.dumps(entry['view'])}\n\n"
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 @router.delete("/bookings/{booking_id}")
-async def cancel_booking(booking_id: int, payload=Depends(verify_token)):
-    conn = get_conn()
-    try:
+async def cancel_booking(booking_id: int, response: Response, payload=Depends(verify_token)):
+    async with db.connection() as conn:
         cur = conn.cursor()
-        cur.execute("SELECT status FROM bookings WHERE id=%s", (booking_id,))
-        row = cur.fetchone()
-        if not row:
-            raise HTTPException(404, "booking not found")
-        if row[0] == "CONFIRMED":
-            raise HTTPException(400, "cannot cancel confirmed booking")
-        cur.execute("UPDATE bookings SET status='CANCELLED' WHERE id=%s", (booking_id,))
-        conn.commit()
+        # SELECT FOR UPDATE + UPDATE condicional + pg_notify num único round trip
+        status, event = await bookings.cancel(cur, booking_id)
+        await conn.commit()
         cur.close()
-        return {"ok": True}
-    finally:
-        conn.close()
+    if status is None:
+        raise HTTPException(404, "booking not found")
+    if status == "CONFIRMED":
+        raise HTTPException(400, "cannot cancel confirmed booking")
+    if event:
+        await cache.booking_views.invalidate(booking_id)
+        events.hub.publish(event)
+    consistency.tracker.wrote(booking_id, response)
+    return {"ok": True}
 
 
 
 @router.post("/bookings/{booking_id}/checkout")
-async def checkout_booking(booking_id: int, payload: BookingCheckout):
+async def checkout_booking(
+    booking_id: int,
+    payload: BookingCheckout,
+    response: Response,
+    mode: Literal["sync", "async"] = Query(CHECKOUT_MODE),
+):
     """
     JSON: { "method": "CARD" | "PIX" | "BOLETO", "coupon": "ABC" }
+
+    Com `?mode=async` a booking vai para PENDING_PAYMENT e a resposta é 202
+    com o job; o Payment é chamado em segundo plano (GET /checkout-jobs/{id}).
     """
     method = payload.method
     coupon = payload.coupon
+    if mode == "async":
+        return await _checkout_async(booking_id, method, coupon)
 
-    conn = get_conn()
+    # transação curta antes da cobrança; conexão e linha ficam livres enquanto o Payment responde.
+    # A tentativa também é um job (RUNNING): o mesmo bloqueio do modo async vale para as duas
+    job_id, amount, key = await _start_checkout(booking_id, method, coupon, run_now=True, response=response)
     try:
-        cur = conn.cursor()
-        cur.execute("SELECT estimate_total FROM bookings WHERE id=%s", (booking_id,))
-        row = cur.fetchone()
-        if not row:
-            raise HTTPException(404, "booking not found")
-
-        amount = float(row[0])
-        pay = payment_client.checkout(
-            booking_id=booking_id, amount=amount, method=method, coupon=coupon
+        pay = await payment_client.get_client().checkout(
+            booking_id=booking_id, amount=float(amount), method=method, coupon=coupon, idempotency_key=key
         )
+    except Exception as e:
+        # recusa ou chamada que não saiu: FAILED devolve a booking para CREATED;
+        # resultado ambíguo (timeout, 5xx) fica UNKNOWN em PENDING_PAYMENT até o callback do Payment
+        outcome = checkout.classify(e)
+        await checkout.record((job_id, "UNKNOWN" if outcome == "UNKNOWN" else "FAILED",
+                               None, None, f"{type(e).__name__}: {e}"[:500], 0))
+        error = _payment_error(e, booking_id)
+        if error is None:
+            raise
+        raise error from e
+    await checkout.record((job_id, "DONE", str(pay.get("payment_id")), pay.get("status"), None, 0))
 
-        cur.execute("UPDATE bookings SET status='PENDING_PAYMENT' WHERE id=%s", (booking_id,))
-        conn.commit()
-        cur.close()
+    return {"payment_id": pay.get("payment_id"), "status": pay.get("status")}
 
-        return {"payment_id": pay.get("payment_id"), "status": pay.get("status")}
-    finally:
-        conn.close()
+
+def _payment_error(exc: Exception, booking_id: int) -> Optional[HTTPException]:
+    """
+    Recusa do Payment (4xx) -> 402 com o motivo dele; sem conexão -> 503;
+    timeout -> 504 e 5xx/conexão caída -> 502, avisando que a booking segue
+    em PENDING_PAYMENT. None para o que não veio do Payment (CircuitOpen tem handler próprio).
+    """
+    if isinstance(exc, httpx.HTTPStatusError) and exc.response.status_code < 500:
+        try:
+            reason = exc.response.json()
+        except ValueError:
+            reason = exc.response.text[:500]
+        if isinstance(reason, dict) and "detail" in reason:
+            reason = reason["detail"]
+        return HTTPException(402, {"error": "payment rejected", "upstream_status": exc.response.status_code, "reason": reason})
+    if not isinstance(exc, httpx.HTTPError):
+        return None
+    if payment_client.not_charged(exc):
+        return HTTPException(503, "payment unavailable", headers={"Retry-After": "1"})
+    pending = {
+        "error": "payment outcome unknown",
+        "booking_id": booking_id,
+        "status": "PENDING_PAYMENT",
+        "message": "booking is still PENDING_PAYMENT until Payment confirms or rejects the charge",
+    }
+    return HTTPException(504 if isinstance(exc, httpx.TimeoutException) else 502, pending)
+
+
+async def _start_checkout(booking_id: int, method: str, coupon: Optional[str], *, run_now: bool,
+                          response: Optional[Response] = None):
+    """Booking em PENDING_PAYMENT com o job gravado; devolve (job_id, valor, chave de idempotência)."""
+    async with db.connection() as conn:
+        cur = conn.cursor()
+        try:
+            previous, job, event = await bookings.start_checkout(
+                cur, booking_id, method, coupon, run_now=run_now, lease=checkout.SYNC_LEASE if run_now else 0.0
+            )
+        except errors.UniqueViolation:
+            # outro pedido gravou o job entre o nosso snapshot e o INSERT
+            await conn.rollback()
+            cur.close()
+            raise HTTPException(409, "checkout already in progress")
+        await conn.commit()
+        cur.close()
+    if previous is None:
+        raise HTTPException(404, "booking not found")
+    if event is None:
+        if previous in ("CREATED", "PENDING_PAYMENT"):
+            # job QUEUED/RUNNING, ou UNKNOWN esperando o callback do Payment
+            raise HTTPException(409, "checkout already in progress")
+        raise HTTPException(409, f"cannot checkout {previous.lower()} booking")
+    await cache.booking_views.invalidate(booking_id)
+    events.hub.publish(event)
+    consistency.tracker.wrote(booking_id, response)
+    return job
+
+
+async def _checkout_async(booking_id: int, method: str, coupon: Optional[str]):
+    job_id, _, _ = await _start_checkout(booking_id, method, coupon, run_now=False)
+    checkout.worker.notify()
+    response = JSONResponse(
+        status_code=202,
+        content={"job_id": job_id, "booking_id": booking_id, "status": "QUEUED"},
+        headers={"Location": f"/checkout-jobs/{job_id}"},
+    )
+    consistency.tracker.wrote(booking_id, response)
+    return response
+
+
+@router.get("/checkout-jobs/{job_id}")
+async def checkout_job(job_id: int, payload=Depends(verify_token)):
+    job = await checkout.job_status(job_id)
+    if job is None:
+        raise HTTPException(404, "checkout job not found")
+    return job
 
@@ -1,42 +1,162 @@
 import os
-import psycopg2
-from fastapi import APIRouter
-from app.services import agenda_client
-from dotenv import load_dotenv
+from collections import OrderedDict
+from typing import Any, List
 
-load_dotenv()
+from fastapi import APIRouter, Body
+from pydantic import BaseModel, ValidationError
+from app.core import cache, db, events
+from app.repositories import bookings
+from app.services import outbox
 
 router = APIRouter()
-DATABASE_URL = os.getenv("DATABASE_URL")
 
-def get_conn():
-    return psycopg2.connect(DATABASE_URL, sslmode="require")
+# status do Payment -> (novo status da booking, status de origem permitidos)
+TRANSITIONS = {
+    "APPROVED": ("CONFIRMED", ["CREATED", "PENDING_PAYMENT"]),
+    "DECLINED": ("CANCELLED", ["CREATED", "PENDING_PAYMENT"]),
+}
+PENDING_TRANSITION = ("PENDING_PAYMENT", ["CREATED"])
+# ação gravada no outbox para o Agenda quando a transição se aplica
+AGENDA_ACTIONS = {"APPROVED": "mark_booked", "DECLINED": "release_lock"}
+
+SEEN_MAX = int(os.getenv("CALLBACK_DEDUP_CACHE_SIZE", "10000"))
+BATCH_MAX_ITEMS = int(os.getenv("CALLBACK_BATCH_MAX_ITEMS", "5000"))
+seen_callbacks: OrderedDict[tuple[int, str], None] = OrderedDict()
+
+
+def _remember(key):
+    seen_callbacks[key] = None
+    seen_callbacks.move_to_end(key)
+    while len(seen_callbacks) > SEEN_MAX:
+        seen_callbacks.popitem(last=False)
+
+
+class PaymentCallback(BaseModel):
+    payment_id: int
+    booking_id: int
+    status: str
+    paid_amount: float | None = None
+    invoice_id: int | None = None
+    invoice_url: str | None = None
+
+
+def _transition(cb: PaymentCallback) -> dict:
+    """Argumentos de bookings.apply_payment_callback(s) para um callback."""
+    new_status, allowed = TRANSITIONS.get(cb.status, PENDING_TRANSITION)
+    return {
+        "payment_id": cb.payment_id,
+        "status": cb.status,
+        "booking_id": cb.booking_id,
+        "new_status": new_status,
+        "allowed": allowed,
+        "paid_amount": cb.paid_amount if cb.status == "APPROVED" else None,
+        "invoice_id": cb.invoice_id,
+        "invoice_url": cb.invoice_url,
+        "agenda_action": AGENDA_ACTIONS.get(cb.status),
+    }
+
 
 @router.post("/callbacks/payment")
 async def payment_callback(payment_id: int, booking_id: int, status: str, paid_amount: float | None = None, invoice_id: int | None = None, invoice_url: str | None = None):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT court_id, slot_id FROM bookings WHERE id=%s", (booking_id,))
-    row = cur.fetchone()
-    if not row:
+    key = (payment_id, status)
+    if key in seen_callbacks:
+        return {"ok": True, "duplicate": True}
+
+    callback = PaymentCallback(
+        payment_id=payment_id, booking_id=booking_id, status=status,
+        paid_amount=paid_amount, invoice_id=invoice_id, invoice_url=invoice_url,
+    )
+    async with db.connection() as conn:
+        cur = conn.cursor()
+        # dedup, transição condicional (entrega fora de ordem não volta CONFIRMED
+        # para PENDING_PAYMENT), fatura, outbox e NOTIFY num único round trip
+        result = await bookings.apply_payment_callback(cur, **_transition(callback))
+        if result["duplicate"]:
+            await conn.rollback()
+        else:
+            await conn.commit()
         cur.close()
-        conn.close()
+    _remember(key)
+    if result["duplicate"]:
+        return {"ok": True, "duplicate": True}
+
+    event = result["event"]
+    if event or result["invoiced"]:
+        await cache.booking_views.invalidate(booking_id)
+
+    if not event:
         return {"ignored": True}
+    events.hub.publish(event)
+    # Agenda é avisado pelo dispatcher do outbox, fora desta requisição
+    if status in AGENDA_ACTIONS:
+        outbox.dispatcher.notify()
+    return {"ok": True}
 
-    if status == "APPROVED":
-        cur.execute("UPDATE bookings SET status='CONFIRMED', paid_total=%s WHERE id=%s", (paid_amount, booking_id))
-        agenda_client.mark_booked(court_id=row[0], slot_id=row[1], booking_id=booking_id)
-    elif status == "DECLINED":
-        cur.execute("UPDATE bookings SET status='CANCELLED' WHERE id=%s", (booking_id,))
-        agenda_client.release_lock(f"{row[0]}-{row[1]}-{booking_id}")
-    else:
-        cur.execute("UPDATE bookings SET status='PENDING_PAYMENT' WHERE id=%s", (booking_id,))
 
-    if invoice_id:
-        cur.execute("UPDATE bookings SET invoice_id=%s, invoice_url=%s WHERE id=%s", (invoice_id, invoice_url, booking_id))
+def _rounds(callbacks: list[tuple[int, PaymentCallback]]) -> list[list[tuple[int, PaymentCallback]]]:
+    """
+    Divide o lote em rodadas com no máximo um callback por booking, na ordem
+    de chegada: PENDING seguido de APPROVED da mesma booking vira duas rodadas.
+    """
+    rounds: list[list] = []
+    seen_per_booking: dict[int, int] = {}
+    for item in callbacks:
+        n = seen_per_booking.get(item[1].booking_id, 0)
+        seen_per_booking[item[1].booking_id] = n + 1
+        if n == len(rounds):
+            rounds.append([])
+        rounds[n].append(item)
+    return rounds
 
-    conn.commit()
-    cur.close()
-    conn.close()
 
-    return {"ok": True}
+@router.post("/callbacks/payment/batch")
+async def payment_callbacks_batch(items: List[Any] = Body(..., min_length=1, max_length=BATCH_MAX_ITEMS)):
+    """
+    JSON: [{ "payment_id": 1, "booking_id": 10, "status": "APPROVED", "paid_amount": 100 }, ...]
+
+    Todos os callbacks numa única transação, com SQL por conjunto (um statement
+    por rodada). Cada item tem seu resultado (ok, ignored, duplicate ou
+    invalid); item inválido não derruba o resto do lote.
+    """
+    results: list[dict] = [{} for _ in items]
+    pending: list[tuple[int, PaymentCallback]] = []
+    keys = set()
+    for index, item in enumerate(items):
+        try:
+            callback = PaymentCallback.model_validate(item)
+        except ValidationError as e:
+            results[index] = {"index": index, "result": "invalid", "error": e.errors(include_url=False, include_input=False)}
+            continue
+        key = (callback.payment_id, callback.status)
+        if key in seen_callbacks or key in keys:
+            results[index] = {"index": index, "result": "duplicate"}
+            continue
+        keys.add(key)
+        pending.append((index, callback))
+
+    applied: list[dict] = []
+    if pending:
+        async with db.connection() as conn:
+            cur = conn.cursor()
+            for batch in _rounds(pending):
+                outcome = await bookings.apply_payment_callbacks(cur, [_transition(cb) for _, cb in batch])
+                for (index, callback), result in zip(batch, outcome):
+                    applied.append({**result, "booking_id": callback.booking_id})
+                    if result["duplicate"]:
+                        status = "duplicate"
+                    else:
+                        status = "ok" if result["event"] else "ignored"
+                    results[index] = {"index": index, "result": status}
+            await conn.commit()
+            cur.close()
+        for key in keys:
+            _remember(key)
+
+    for result in applied:
+        if result["event"] or result["invoiced"]:
+            await cache.booking_views.invalidate(result["booking_id"])
+        if result["event"]:
+            events.hub.publish(result["event"])
+    if any(r["event"] for r in applied):
+        outbox.dispatcher.notify()
+    return {"results": results}
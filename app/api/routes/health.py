@@ -1,5 +1,8 @@
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
+from app.core import metrics
 from app.core.auth import verify_token
+from app.services import outbox
 
 router = APIRouter()
 
@@ -8,3 +11,19 @@ async def health(payload=Depends(verify_token)):
     return {
         "status": "ok",
     }
+
+# sem token: sonda de readiness do orquestrador; pronto só depois do warm-up e até o início do shutdown
+@router.get("/ready")
+async def ready(request: Request):
+    if not getattr(request.app.state, "ready", False):
+        return JSONResponse(status_code=503, content={"status": "starting"}, headers={"Retry-After": "1"})
+    return {"status": "ready"}
+
+@router.get("/health/outbox")
+async def outbox_health(payload=Depends(verify_token)):
+    return await outbox.stats()
+
+# sem token: o scraper do Prometheus não tem como obter um JWT
+@router.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint():
+    return PlainTextResponse(await metrics.render(), media_type="text/plain; version=0.0.4")
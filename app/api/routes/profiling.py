@@ -0,0 +1,62 @@
+import os
+from typing import List, Optional
+
+from fastapi import APIRouter, Depends
+from fastapi.responses import PlainTextResponse
+from pydantic import BaseModel, Field
+
+from app.core.auth import require_permission
+from app.core.profiler import Session, profiler
+
+router = APIRouter()
+PROFILE_MAX_DURATION = float(os.getenv("PROFILE_MAX_DURATION", "600"))
+admin = require_permission("admin:profile")
+
+
+class ProfileStart(BaseModel):
+    rate: float = Field(0.0, ge=0, le=1)
+    routes: List[str] = []
+    header: Optional[str] = None
+    interval_ms: float = Field(5.0, ge=1, le=1000)
+    duration: float = Field(60.0, gt=0, le=PROFILE_MAX_DURATION)
+    max_requests: int = Field(32, ge=1, le=1024)
+
+
+@router.post("/admin/profile")
+async def start_profile(body: ProfileStart, payload=Depends(admin)):
+    """
+    Abre uma sessão de profiling neste worker: amostra `rate` dos requests,
+    os das rotas (template, ex. `/bookings/{booking_id}/checkout`) em `routes`
+    e os que trazem o header `header`. Termina sozinha após `duration` segundos.
+
+    Vale só para o worker que atendeu (`pid` na resposta): perfilar exige um
+    worker só (WEB_CONCURRENCY=1), ver app.core.profiler.
+    """
+    session = Session(
+        rate=body.rate,
+        routes=tuple(body.routes),
+        header=body.header,
+        interval=body.interval_ms / 1000,
+        duration=body.duration,
+        max_requests=body.max_requests,
+    )
+    profiler.start(session)
+    return {"pid": os.getpid(), **session.describe()}
+
+
+@router.get("/admin/profile")
+async def profile_status(payload=Depends(admin)):
+    session = profiler.session or profiler.last
+    return {"pid": os.getpid(), "active": profiler.active, "session": session.describe() if session else None}
+
+
+@router.get("/admin/profile/collapsed", response_class=PlainTextResponse)
+async def profile_collapsed(payload=Depends(admin)):
+    """Pilhas colapsadas da sessão atual (ou da última), prontas para flamegraph.pl/speedscope."""
+    return PlainTextResponse(profiler.collapsed(), headers={"X-Worker-Pid": str(os.getpid())})
+
+
+@router.delete("/admin/profile")
+async def stop_profile(payload=Depends(admin)):
+    session = profiler.stop()
+    return {"pid": os.getpid(), "active": False, "session": session.describe() if session else None}
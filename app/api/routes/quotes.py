@@ -1,28 +1,67 @@
-from fastapi import APIRouter, Depends
-from dotenv import load_dotenv
-from app.core.auth import verify_token
+import os
 
-load_dotenv()
+from fastapi import APIRouter, Depends, HTTPException, Query
+from app.core.auth import require_permission, verify_token
+from app.services import pricing
+from app.services.pricing import PricingSnapshot
 
 router = APIRouter()
+MATRIX_MAX_CELLS = int(os.getenv("QUOTE_MATRIX_MAX_CELLS", "20000"))
 
-EXTRA_PRICES = {"ball": 5.0, "vest": 8.0, "lights": 12.0}
-BASE_PRICE = 50.0
+@router.get("/quotes/matrix")
+async def quote_matrix_endpoint(
+    court_ids: list[int] = Query(...),
+    slot_from: int = Query(...),
+    slot_to: int = Query(...),
+    extras: list[str] | None = Query(None),
+    payload=Depends(verify_token),
+):
+    """
+    Grade de preços em formato colunar: `total[i][j]` é o total da quadra
+    `court_ids[i]` no slot `slot_from + j` (slot_to incluso).
+    """
+    if slot_to < slot_from:
+        raise HTTPException(422, "slot_to must be >= slot_from")
+    if len(court_ids) * (slot_to - slot_from + 1) > MATRIX_MAX_CELLS:
+        raise HTTPException(422, f"matrix larger than {MATRIX_MAX_CELLS} cells")
+    return calculate_quote_matrix(court_ids, slot_from, slot_to, extras or [])
 
 @router.get("/quotes")
 async def quote_endpoint(
     court_id: int,
     slot_id: int,
-    extras: list[str] | None = None,
+    extras: list[str] | None = Query(None),
     payload=Depends(verify_token),
 ):
     return calculate_quote(court_id, slot_id, extras or [])
 
-def calculate_quote(court_id: int, slot_id: int, extras: list[str]):
-    extras_cost = sum(EXTRA_PRICES.get(e, 0.0) for e in extras)
-    total = BASE_PRICE + extras_cost
+@router.post("/pricing/reload")
+async def reload_pricing(payload=Depends(require_permission("admin:pricing"))):
+    snapshot = await pricing.cache.reload()
+    return {"version": snapshot.version}
+
+def calculate_quote(court_id: int, slot_id: int, extras: list[str], snapshot: PricingSnapshot | None = None):
+    prices = snapshot or pricing.current()
+    subtotal = prices.base_price(court_id, slot_id)
+    extra_items = [{"type": e, "price": prices.extra_price(e)} for e in extras]
+    total = subtotal + sum(e["price"] for e in extra_items)
     return {
-        "subtotal": BASE_PRICE,
-        "extras": [{"type": e, "price": EXTRA_PRICES.get(e, 0.0)} for e in extras],
+        "subtotal": subtotal,
+        "extras": extra_items,
         "total": total,
     }
+
+def calculate_quote_matrix(court_ids: list[int], slot_from: int, slot_to: int, extras: list[str],
+                           snapshot: PricingSnapshot | None = None):
+    prices = snapshot or pricing.current()
+    extra_items = [{"type": e, "price": prices.extra_price(e)} for e in extras]
+    extras_total = sum(e["price"] for e in extra_items)
+    return {
+        "pricing_version": prices.version,
+        "court_ids": court_ids,
+        "slot_from": slot_from,
+        "slot_to": slot_to,
+        "extras": extra_items,
+        "extras_total": extras_total,
+        "total": prices.price_rows(court_ids, range(slot_from, slot_to + 1), add=extras_total),
+    }
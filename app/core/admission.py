@@ -0,0 +1,286 @@
+"""
+Controle de admissão na borda: rejeita antes de validar JWT, abrir conexão
+ou chamar upstream.
+
+- limite global de requisições em andamento -> 503;
+- limite de concorrência por rota -> 503;
+- requisições longas (SSE, long-poll) só contam num limite próprio -> 503;
+- token bucket por cliente (sub do token já verificado, senão IP), global e
+  por rota -> 429.
+
+Os buckets usam GCRA (um único timestamp por chave), em memória com LRU ou,
+com ADMISSION_REDIS_URL, num Redis compartilhado entre workers.
+"""
+import json
+import logging
+import math
+import os
+import time
+from collections import OrderedDict
+from typing import Optional
+from urllib.parse import parse_qsl
+
+from starlette.routing import Match
+
+from app.core import auth, metrics
+
+logger = logging.getLogger("uvicorn.error")
+
+REJECTED = metrics.Counter("sb_admission_rejected_total", "Requests shed by admission control", ("route", "reason"))
+
+# rota -> {"rate": req/s, "burst": requisições, "concurrency": em andamento, "stream": ...}; ADMISSION_ROUTE_LIMITS (JSON) sobrescreve
+# "stream": true (sempre longa) ou o parâmetro de query que a torna longa quando > 0
+DEFAULT_ROUTE_LIMITS = {
+    "GET /bookings/{booking_id}": {"stream": "wait"},
+    "GET /bookings/{booking_id}/events": {"stream": True},
+    "POST /bookings": {"rate": 10, "burst": 20, "concurrency": 64},
+    "POST /bookings/batch": {"rate": 1, "burst": 5, "concurrency": 8},
+    "POST /bookings/{booking_id}/checkout": {"rate": 5, "burst": 10, "concurrency": 64},
+    "GET /bookings/export": {"rate": 0.2, "burst": 2, "concurrency": 4},
+    "GET /quotes": {"rate": 20, "burst": 40},
+    "GET /quotes/matrix": {"rate": 5, "burst": 10},
+}
+# fora do controle de admissão: sondas não podem falhar por carga
+DEFAULT_EXEMPT = "/health,/ready,/metrics"
+# sem bucket por cliente (só os limites de concorrência): o Payment manda rajadas de callbacks no fechamento do mês
+DEFAULT_UNMETERED = "/callbacks/payment,/callbacks/payment/batch"
+
+
+class MemoryBuckets:
+    """GCRA em memória: chave -> instante teórico de chegada (TAT), com LRU."""
+
+    def __init__(self, maxsize: int = 100000):
+        self.maxsize = maxsize
+        self._tat: OrderedDict[str, float] = OrderedDict()
+
+    def __len__(self):
+        return len(self._tat)
+
+    def clear(self):
+        self._tat.clear()
+
+    async def take(self, key: str, rate: float, burst: float) -> float:
+        """0 se a requisição passa; senão segundos até a próxima ser aceita."""
+        now = time.monotonic()
+        interval = 1.0 / rate
+        tat = max(self._tat.get(key, now), now)
+        wait = tat + interval - burst * interval - now
+        if wait > 0:
+            return wait
+        self._tat[key] = tat + interval
+        self._tat.move_to_end(key)
+        # chave despejada equivale a bucket cheio: o cliente só ganha o que já teria ganho esperando
+        while len(self._tat) > self.maxsize:
+            self._tat.popitem(last=False)
+        return 0.0
+
+
+_GCRA = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local interval = 1 / tonumber(ARGV[1])
+local tat = tonumber(redis.call('GET', KEYS[1]) or now)
+if tat < now then tat = now end
+local wait = tat + interval - tonumber(ARGV[2]) * interval - now
+if wait > 0 then return tostring(wait) end
+redis.call('SET', KEYS[1], tostring(tat + interval), 'PX', math.ceil((tat + interval - now) * 1000) + 1)
+return '0'
+"""
+
+
+class SharedBuckets:
+    """
+    Mesmo GCRA num servidor com a API do redis.asyncio (`eval`), atômico via
+    script. Se o servidor falhar, cai para os buckets locais até ele voltar.
+    """
+
+    def __init__(self, client, prefix: str = "admission", fallback: Optional[MemoryBuckets] = None):
+        self.client = client
+        self.prefix = prefix
+        self.fallback = fallback or MemoryBuckets()
+        self._failing = False
+
+    async def take(self, key: str, rate: float, burst: float) -> float:
+        try:
+            wait = float(await self.client.eval(_GCRA, 1, f"{self.prefix}:{key}", rate, burst))
+        except Exception as e:
+            if not self._failing:
+                logger.warning("shared rate limiter unavailable, using local buckets: %s", e)
+            self._failing = True
+            return await self.fallback.take(key, rate, burst)
+        self._failing = False
+        return wait
+
+
+def buckets_from_env():
+    url = os.getenv("ADMISSION_REDIS_URL")
+    local = MemoryBuckets(int(os.getenv("ADMISSION_MAX_KEYS", "100000")))
+    if not url:
+        return local
+    # dependência opcional, como no cache compartilhado
+    import redis.asyncio as redis
+
+    return SharedBuckets(redis.from_url(url), fallback=local)
+
+
+class AdmissionPolicy:
+    def __init__(
+        self,
+        buckets,
+        *,
+        rate: float = 50.0,
+        burst: float = 100.0,
+        max_in_flight: int = 512,
+        max_streams: int = 1024,
+        routes: Optional[dict] = None,
+        exempt: tuple = (),
+        unmetered: tuple = (),
+    ):
+        self.buckets = buckets
+        self.rate = rate
+        self.burst = burst
+        self.max_in_flight = max_in_flight
+        self.max_streams = max_streams
+        self.routes = routes or {}
+        self.exempt = set(exempt)
+        self.unmetered = set(unmetered)
+        self.in_flight = 0
+        self.route_in_flight: dict[str, int] = {}
+        # SSE e long-poll abertos: ficam fora de in_flight/route_in_flight
+        self.streams = 0
+
+
+def _paths(value: str) -> tuple:
+    return tuple(p.strip() for p in value.split(",") if p.strip())
+
+
+def policy_from_env() -> AdmissionPolicy:
+    routes = dict(DEFAULT_ROUTE_LIMITS)
+    routes.update(json.loads(os.getenv("ADMISSION_ROUTE_LIMITS", "{}")))
+    return AdmissionPolicy(
+        buckets_from_env(),
+        rate=float(os.getenv("ADMISSION_RATE", "50")),
+        burst=float(os.getenv("ADMISSION_BURST", "100")),
+        max_in_flight=int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "512")),
+        max_streams=int(os.getenv("ADMISSION_MAX_STREAMS", "1024")),
+        routes=routes,
+        exempt=_paths(os.getenv("ADMISSION_EXEMPT_PATHS", DEFAULT_EXEMPT)),
+        unmetered=_paths(os.getenv("ADMISSION_UNMETERED_PATHS", DEFAULT_UNMETERED)),
+    )
+
+
+default_policy = policy_from_env()
+
+
+def route_path(scope) -> str:
+    app = scope.get("app")
+    for route in getattr(getattr(app, "router", None), "routes", ()):
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return "<unmatched>"
+
+
+def _header(scope, name: bytes) -> Optional[bytes]:
+    for key, value in scope.get("headers", ()):
+        if key == name:
+            return value
+    return None
+
+
+def _long_lived(scope, stream) -> bool:
+    """Rota marcada com `"stream": true`, ou com o parâmetro de query indicado e > 0."""
+    if not stream:
+        return False
+    if stream is True:
+        return True
+    for key, value in parse_qsl(scope.get("query_string", b"").decode("latin-1")):
+        if key == stream:
+            try:
+                return float(value) > 0
+            except ValueError:
+                return False
+    return False
+
+
+def client_key(scope) -> str:
+    """sub de um token que já passou por verify_token; senão o IP (tokens desconhecidos não ganham bucket próprio)."""
+    authorization = _header(scope, b"authorization")
+    if authorization and authorization[:7].lower() == b"bearer ":
+        claims = auth.verified_tokens.get(authorization[7:].decode("latin-1").rsplit(".", 1)[-1])
+        if claims is not None and claims.get("sub"):
+            return f"sub:{claims['sub']}"
+    client = scope.get("client")
+    return f"ip:{client[0] if client else 'unknown'}"
+
+
+class AdmissionMiddleware:
+    """Middleware ASGI puro; sem `policy`, usa a do módulo (configurada pelo ambiente)."""
+
+    def __init__(self, app, policy: Optional[AdmissionPolicy] = None):
+        self.app = app
+        self.policy = policy or default_policy
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        policy = self.policy
+        path = route_path(scope)
+        if path in policy.exempt:
+            return await self.app(scope, receive, send)
+        route = f"{scope['method']} {path}"
+        limits = policy.routes.get(route, {})
+
+        # quem espera minutos parado não pode ocupar as vagas das requisições curtas
+        stream = _long_lived(scope, limits.get("stream"))
+        if stream:
+            if policy.streams >= policy.max_streams:
+                return await self._reject(send, route, "streams", 503, 1.0, "too many open streams")
+        elif policy.in_flight >= policy.max_in_flight:
+            return await self._reject(send, route, "in_flight", 503, 1.0, "server busy")
+        else:
+            concurrency = limits.get("concurrency")
+            if concurrency is not None and policy.route_in_flight.get(route, 0) >= concurrency:
+                return await self._reject(send, route, "concurrency", 503, 1.0, "route busy")
+
+        if path not in policy.unmetered:
+            key = client_key(scope)
+            wait = await policy.buckets.take(key, policy.rate, policy.burst)
+            if not wait and "rate" in limits:
+                wait = await policy.buckets.take(f"{route}|{key}", limits["rate"], limits.get("burst", limits["rate"]))
+            if wait:
+                return await self._reject(send, route, "rate", 429, wait, "rate limit exceeded")
+
+        if stream:
+            policy.streams += 1
+            try:
+                return await self.app(scope, receive, send)
+            finally:
+                policy.streams -= 1
+
+        policy.in_flight += 1
+        policy.route_in_flight[route] = policy.route_in_flight.get(route, 0) + 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            policy.in_flight -= 1
+            remaining = policy.route_in_flight[route] - 1
+            if remaining:
+                policy.route_in_flight[route] = remaining
+            else:
+                del policy.route_in_flight[route]
+
+    @staticmethod
+    async def _reject(send, route: str, reason: str, status: int, retry_after: float, detail: str):
+        REJECTED.inc(route, reason)
+        body = json.dumps({"detail": detail}).encode()
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", str(max(1, math.ceil(retry_after))).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
@@ -1,12 +1,19 @@
+import asyncio
+import os
+import re
+import time
+from collections import OrderedDict
 from functools import lru_cache
-from typing import Optional
-from jose import jwt
+from typing import Any, Optional
+
+import httpx
+from jose import jwk, jwt
+from jose.exceptions import JOSEError
 from fastapi import HTTPException, status, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-import requests
-import os
 
 security = HTTPBearer()
+optional_security = HTTPBearer(auto_error=False)
 
 @lru_cache
 def get_settings():
@@ -19,22 +26,134 @@ def get_settings():
 def get_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
     return credentials.credentials
 
-def verify_token(token: str = Depends(get_token)):
+
+_MAX_AGE = re.compile(r"max-age=(\d+)")
+
+
+class JWKSCache:
+    """
+    Chaves públicas do Auth0 já construídas, indexadas por `kid`.
+
+    O JWKS é baixado de novo quando o TTL vence (max-age do Cache-Control ou
+    `ttl`) ou quando chega um `kid` desconhecido — neste caso no máximo uma vez
+    a cada `min_refresh_interval` segundos, para que tokens forjados não virem
+    uma rajada de requisições ao Auth0.
+    """
+
+    def __init__(self, url: str, *, ttl: float = 3600.0, min_refresh_interval: float = 30.0,
+                 timeout: float = 5.0, algorithm: str = "RS256", transport=None):
+        self.url = url
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self.algorithm = algorithm
+        self._transport = transport
+        self._keys: dict[str, Any] = {}
+        self._expires_at = 0.0
+        self._last_fetch = float("-inf")
+        self._lock = asyncio.Lock()
+
+    async def get_key(self, kid: str):
+        now = time.monotonic()
+        if now >= self._expires_at:
+            await self.refresh()
+        elif kid not in self._keys and now - self._last_fetch >= self.min_refresh_interval:
+            await self.refresh()
+        return self._keys.get(kid)
+
+    async def refresh(self):
+        fetched_at = self._last_fetch
+        async with self._lock:
+            # outra corrotina já atualizou enquanto esperávamos o lock
+            if self._last_fetch != fetched_at:
+                return
+            self._last_fetch = time.monotonic()
+            try:
+                async with httpx.AsyncClient(timeout=self.timeout, transport=self._transport) as client:
+                    r = await client.get(self.url)
+                    r.raise_for_status()
+            except httpx.HTTPError:
+                if not self._keys:
+                    raise
+                # mantém as chaves antigas e tenta de novo depois do intervalo mínimo
+                self._expires_at = self._last_fetch + self.min_refresh_interval
+                return
+            keys = {}
+            for key in r.json().get("keys", []):
+                try:
+                    keys[key["kid"]] = jwk.construct(key, key.get("alg", self.algorithm))
+                except (KeyError, JOSEError):
+                    continue
+            self._keys = keys
+            self._expires_at = self._last_fetch + self._max_age(r.headers.get("cache-control"))
+
+    def _max_age(self, cache_control: Optional[str]) -> float:
+        if cache_control:
+            if "no-cache" in cache_control or "no-store" in cache_control:
+                return self.min_refresh_interval
+            m = _MAX_AGE.search(cache_control)
+            if m:
+                return float(m.group(1))
+        return self.ttl
+
+
+class VerifiedTokenCache:
+    """LRU assinatura do token -> claims já validados, válido até o `exp` do token."""
+
+    def __init__(self, maxsize: int = 10000):
+        self.maxsize = maxsize
+        self._items: OrderedDict[str, dict] = OrderedDict()
+
+    def get(self, signature: str) -> Optional[dict]:
+        claims = self._items.get(signature)
+        if claims is None:
+            return None
+        if claims.get("exp", 0) <= time.time():
+            del self._items[signature]
+            return None
+        self._items.move_to_end(signature)
+        return claims
+
+    def put(self, signature: str, claims: dict):
+        if "exp" not in claims:
+            return
+        self._items[signature] = claims
+        self._items.move_to_end(signature)
+        while len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+
+@lru_cache
+def get_jwks_cache() -> JWKSCache:
     settings = get_settings()
-    jwks_url = f"https://{settings['domain']}/.well-known/jwks.json"
-    jwks = requests.get(jwks_url).json()
-    unverified_header = jwt.get_unverified_header(token)
-    rsa_key: Optional[dict] = None
-    for key in jwks["keys"]:
-        if key["kid"] == unverified_header["kid"]:
-            rsa_key = {
-                "kty": key["kty"],
-                "kid": key["kid"],
-                "use": key["use"],
-                "n": key["n"],
-                "e": key["e"]
-            }
-            break
+    return JWKSCache(
+        os.getenv("AUTH0_JWKS_URL") or f"https://{settings['domain']}/.well-known/jwks.json",
+        ttl=float(os.getenv("JWKS_TTL", "3600")),
+        min_refresh_interval=float(os.getenv("JWKS_MIN_REFRESH_INTERVAL", "30")),
+        timeout=float(os.getenv("JWKS_TIMEOUT", "5")),
+        algorithm=settings["algorithms"][0],
+    )
+
+
+verified_tokens = VerifiedTokenCache(int(os.getenv("AUTH_TOKEN_CACHE_SIZE", "10000")))
+
+
+async def verify_token(token: str = Depends(get_token)):
+    signature = token.rsplit(".", 1)[-1]
+    claims = verified_tokens.get(signature)
+    if claims is not None:
+        return dict(claims)
+
+    settings = get_settings()
+    try:
+        unverified_header = jwt.get_unverified_header(token)
+        kid = unverified_header["kid"]
+    except (JOSEError, KeyError):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="invalid_header")
+    try:
+        rsa_key = await get_jwks_cache().get_key(kid)
+    except httpx.HTTPError:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="jwks_unavailable")
     if rsa_key is None:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="invalid_header")
     try:
@@ -47,4 +166,28 @@ def verify_token(token: str = Depends(get_token)):
         )
     except Exception:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="invalid_token")
-    return payload
+    verified_tokens.put(signature, payload)
+    return dict(payload)
+
+
+async def optional_claims(credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security)):
+    """Claims do token quando a requisição traz um; None para chamadas anônimas."""
+    if credentials is None:
+        return None
+    return await verify_token(credentials.credentials)
+
+
+def has_permission(payload: dict, permission: str) -> bool:
+    granted = set(payload.get("permissions") or []) | set((payload.get("scope") or "").split())
+    return permission in granted
+
+
+def require_permission(permission: str):
+    """Dependência que exige a permissão no token (claim `permissions` do RBAC do Auth0 ou `scope`)."""
+
+    async def dependency(payload=Depends(verify_token)):
+        if not has_permission(payload, permission):
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="insufficient_permissions")
+        return payload
+
+    return dependency
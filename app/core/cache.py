@@ -0,0 +1,137 @@
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Optional
+
+
+class TTLCache:
+    """LRU em memória com expiração por entrada."""
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 2.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items: OrderedDict[Any, tuple[float, Any]] = OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        item = self._items.get(key)
+        if item is None:
+            return None
+        expires_at, value = item
+        if expires_at <= time.monotonic():
+            del self._items[key]
+            return None
+        self._items.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl: Optional[float] = None):
+        self._items[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._items.move_to_end(key)
+        while len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+    def delete(self, key):
+        self._items.pop(key, None)
+
+    def clear(self):
+        self._items.clear()
+
+
+class SharedBackend:
+    """
+    Cache compartilhado entre workers sobre um cliente com a API do
+    redis.asyncio (`get`, `set(..., ex=)`, `delete`). Valores vão em JSON.
+    """
+
+    def __init__(self, client, prefix: str, ttl: float = 30.0):
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def _key(self, key) -> str:
+        return f"{self.prefix}:{key}"
+
+    async def get(self, key):
+        raw = await self.client.get(self._key(key))
+        return None if raw is None else json.loads(raw)
+
+    async def set(self, key, value):
+        await self.client.set(self._key(key), json.dumps(value), ex=max(1, int(self.ttl)))
+
+    async def delete(self, key):
+        await self.client.delete(self._key(key))
+
+
+def shared_backend_from_env(prefix: str) -> Optional[SharedBackend]:
+    url = os.getenv("CACHE_REDIS_URL")
+    if not url:
+        return None
+    # dependência opcional: só é importada quando o cache compartilhado é configurado
+    import redis.asyncio as redis
+
+    return SharedBackend(redis.from_url(url), prefix, ttl=float(os.getenv("CACHE_SHARED_TTL", "30")))
+
+
+class ReadThroughCache:
+    """
+    L1 local (TTLCache) na frente de um SharedBackend opcional.
+
+    `invalidate` incrementa a geração da chave: um load que começou antes da
+    invalidação não grava o valor antigo de volta no cache.
+    """
+
+    def __init__(self, local: TTLCache, shared: Optional[SharedBackend] = None):
+        self.local = local
+        self.shared = shared
+        self._generations: dict[Any, int] = {}
+        self._loading = 0
+
+    async def get(self, key):
+        value = self.local.get(key)
+        if value is None and self.shared is not None:
+            value = await self.shared.get(key)
+            if value is not None:
+                self.local.set(key, value)
+        return value
+
+    async def get_or_load(self, key, loader: Callable[[], Awaitable[Any]]):
+        value = await self.get(key)
+        if value is not None:
+            return value
+        generation = self._generations.get(key, 0)
+        self._loading += 1
+        try:
+            value = await loader()
+        finally:
+            self._loading -= 1
+        if value is not None and self._generations.get(key, 0) == generation:
+            self.local.set(key, value)
+            if self.shared is not None:
+                await self.shared.set(key, value)
+        return value
+
+    def invalidate_local(self, key):
+        """Só o L1 (síncrono, para listeners de evento); também barra loads em andamento."""
+        self._generations[key] = self._generations.get(key, 0) + 1
+        # só dá para esquecer as gerações quando nenhum load está em andamento
+        if self._loading == 0 and len(self._generations) > self.local.maxsize:
+            self._generations.clear()
+        self.local.delete(key)
+
+    async def invalidate(self, key):
+        self.invalidate_local(key)
+        if self.shared is not None:
+            await self.shared.delete(key)
+
+
+# views de GET /bookings/{id}; invalidadas por quem altera a linha
+booking_views = ReadThroughCache(
+    TTLCache(
+        maxsize=int(os.getenv("BOOKING_CACHE_SIZE", "10000")),
+        ttl=float(os.getenv("BOOKING_CACHE_TTL", "2")),
+    ),
+    shared_backend_from_env("booking"),
+)
@@ -0,0 +1,64 @@
+import os
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from fastapi import Request, Response
+
+from app.core import events
+
+# por quanto tempo depois de uma escrita as leituras vão para o primário (> lag da réplica)
+WINDOW = float(os.getenv("READ_YOUR_WRITES_WINDOW", "5"))
+COOKIE = "sb_rw_until"
+
+
+class ReadYourWrites:
+    """
+    Decide quando uma leitura não pode ir para a réplica.
+
+    - por booking: qualquer mudança (evento do hub, deste ou de outro worker)
+      manda as leituras daquela booking para o primário por `window` segundos;
+    - por cliente: quem escreveu recebe um cookie com o fim da janela e, até
+      lá, todas as suas leituras (inclusive listagens) vão para o primário,
+      em qualquer worker.
+    """
+
+    def __init__(self, window: float = WINDOW, maxsize: int = 100000):
+        self.window = window
+        self.maxsize = maxsize
+        self._recent: OrderedDict[int, float] = OrderedDict()
+
+    def clear(self):
+        self._recent.clear()
+
+    def wrote(self, booking_id: int, response: Optional[Response] = None):
+        self._recent[booking_id] = time.monotonic() + self.window
+        self._recent.move_to_end(booking_id)
+        while len(self._recent) > self.maxsize:
+            self._recent.popitem(last=False)
+        if response is not None:
+            response.set_cookie(
+                COOKIE, str(int(time.time() + self.window) + 1),
+                max_age=int(self.window) + 1, httponly=True, samesite="lax",
+            )
+
+    def on_event(self, event: dict):
+        self.wrote(event["booking_id"])
+
+    def use_primary(self, booking_id: Optional[int] = None, request: Optional[Request] = None) -> bool:
+        if booking_id is not None:
+            expires_at = self._recent.get(booking_id)
+            if expires_at is not None:
+                if expires_at > time.monotonic():
+                    return True
+                del self._recent[booking_id]
+        if request is not None:
+            try:
+                return float(request.cookies.get(COOKIE, 0)) > time.time()
+            except ValueError:
+                return False
+        return False
+
+
+tracker = ReadYourWrites()
+events.hub.add_listener(tracker.on_event)
@@ -0,0 +1,353 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from functools import partial
+from typing import Any, Callable, Optional
+
+import psycopg2
+import psycopg2.extensions
+
+from app.core import metrics
+
+logger = logging.getLogger("uvicorn.error")
+
+DATABASE_URL = os.getenv("DATABASE_URL")
+# réplica opcional para leituras; sem ela tudo vai para o primário
+DATABASE_REPLICA_URL = os.getenv("DATABASE_REPLICA_URL")
+# réplica que falhou fica fora por este tempo e as leituras vão para o primário
+REPLICA_RETRY_AFTER = float(os.getenv("DB_REPLICA_RETRY_AFTER", "30"))
+
+
+class PoolTimeout(RuntimeError):
+    """Nenhuma conexão ficou livre dentro do acquire timeout."""
+
+
+class AsyncCursor:
+    """Cursor psycopg2 com as chamadas bloqueantes fora do event loop."""
+
+    def __init__(self, cur):
+        self._cur = cur
+
+    @property
+    def rowcount(self) -> int:
+        return self._cur.rowcount
+
+    @property
+    def connection(self):
+        """Conexão psycopg2 do cursor (chave dos prepared statements)."""
+        return self._cur.connection
+
+    async def execute(self, query: str, params=None):
+        with metrics.timed("db", "execute"):
+            await asyncio.to_thread(self._cur.execute, query, params)
+
+    async def fetchone(self):
+        return self._cur.fetchone()
+
+    async def fetchall(self):
+        return self._cur.fetchall()
+
+    def close(self):
+        self._cur.close()
+
+
+class AsyncConnection:
+    def __init__(self, raw):
+        self.raw = raw
+
+    def cursor(self) -> AsyncCursor:
+        return AsyncCursor(self.raw.cursor())
+
+    async def commit(self):
+        with metrics.timed("db", "commit"):
+            await asyncio.to_thread(self.raw.commit)
+
+    async def rollback(self):
+        with metrics.timed("db", "rollback"):
+            await asyncio.to_thread(self.raw.rollback)
+
+    async def run(self, fn: Callable, *args):
+        """Executa fn(raw_conn, *args) numa thread (execute_values, COPY, cursores nomeados...)."""
+        with metrics.timed("db", getattr(fn, "__name__", "run")):
+            return await asyncio.to_thread(fn, self.raw, *args)
+
+
+class _Pooled:
+    __slots__ = ("conn", "created_at", "last_used")
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.created_at = self.last_used = time.monotonic()
+
+
+class ConnectionPool:
+    """
+    Pool limitado de conexões psycopg2.
+
+    - no máximo `max_size` conexões emprestadas ao mesmo tempo; quem passar
+      de `timeout` segundos esperando recebe PoolTimeout;
+    - `min_size` conexões são abertas no startup (handshake TLS fora do request);
+    - conexões ociosas há mais de `check_after` segundos são testadas com
+      SELECT 1 antes de voltar ao uso; mais velhas que `max_lifetime` são recicladas.
+    """
+
+    def __init__(
+        self,
+        connect: Callable[[], Any],
+        *,
+        min_size: int = 1,
+        max_size: int = 10,
+        timeout: float = 5.0,
+        check_after: float = 30.0,
+        max_lifetime: float = 1800.0,
+    ):
+        if min_size > max_size:
+            raise ValueError("min_size must be <= max_size")
+        self._connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.check_after = check_after
+        self.max_lifetime = max_lifetime
+        self._idle: deque[_Pooled] = deque()
+        self._meta: dict[int, _Pooled] = {}
+        self._slots = asyncio.Semaphore(max_size)
+        self._closed = False
+
+    @property
+    def size(self) -> int:
+        return len(self._meta)
+
+    @property
+    def idle(self) -> int:
+        return len(self._idle)
+
+    async def open(self):
+        conns = await asyncio.gather(
+            *(asyncio.to_thread(self._connect) for _ in range(self.min_size))
+        )
+        for conn in conns:
+            item = _Pooled(conn)
+            self._meta[id(conn)] = item
+            self._idle.append(item)
+
+    async def close(self):
+        self._closed = True
+        while self._idle:
+            self._discard(self._idle.pop())
+
+    async def warm(self, fn: Callable[[Any], None]):
+        """
+        Executa fn(raw_conn) em cada conexão ociosa (ex.: preparar statements
+        antes do primeiro request). Passa por acquire/release: se fn falhar
+        com a transação aberta, o release faz o rollback ou descarta a conexão.
+        """
+        async def one():
+            conn = await self.acquire()
+            try:
+                await asyncio.to_thread(fn, conn)
+            finally:
+                await self.release(conn)
+
+        await asyncio.gather(*(one() for _ in range(len(self._idle))))
+
+    async def acquire(self):
+        if self._closed:
+            raise RuntimeError("pool is closed")
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            raise PoolTimeout(f"no database connection available after {self.timeout}s")
+        try:
+            return await self._checkout()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    async def release(self, conn):
+        try:
+            item = self._meta.get(id(conn))
+            if item is None:
+                return
+            if self._closed or conn.closed:
+                self._discard(item)
+                return
+            if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    await asyncio.to_thread(conn.rollback)
+                except Exception:
+                    self._discard(item)
+                    return
+            item.last_used = time.monotonic()
+            self._idle.append(item)
+        finally:
+            self._slots.release()
+
+    async def _checkout(self):
+        while self._idle:
+            # LIFO: a conexão usada por último é a que mais provavelmente está viva
+            item = self._idle.pop()
+            now = time.monotonic()
+            if item.conn.closed or now - item.created_at > self.max_lifetime:
+                self._discard(item)
+                continue
+            if now - item.last_used > self.check_after and not await self._healthy(item.conn):
+                self._discard(item)
+                continue
+            return item.conn
+        conn = await asyncio.to_thread(self._connect)
+        self._meta[id(conn)] = _Pooled(conn)
+        return conn
+
+    @staticmethod
+    async def _healthy(conn) -> bool:
+        def ping():
+            cur = conn.cursor()
+            try:
+                cur.execute("SELECT 1")
+                cur.fetchone()
+            finally:
+                cur.close()
+            conn.rollback()
+
+        try:
+            await asyncio.to_thread(ping)
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, item: _Pooled):
+        self._meta.pop(id(item.conn), None)
+        try:
+            item.conn.close()
+        except Exception:
+            pass
+
+
+def pool_from_env(dsn: Optional[str] = None, prefix: str = "DB_POOL") -> ConnectionPool:
+    """Pool configurado por `<PREFIX>_MIN_SIZE`, `<PREFIX>_MAX_SIZE`, `<PREFIX>_TIMEOUT`..."""
+    def env(key, default):
+        return os.getenv(f"{prefix}_{key}", os.getenv(f"DB_POOL_{key}", default))
+
+    connect = partial(
+        psycopg2.connect,
+        dsn or DATABASE_URL,
+        sslmode=os.getenv("DB_SSLMODE", "require"),
+        connect_timeout=int(os.getenv("DB_CONNECT_TIMEOUT", "10")),
+    )
+    return ConnectionPool(
+        connect,
+        min_size=int(env("MIN_SIZE", "2")),
+        max_size=int(env("MAX_SIZE", "10")),
+        timeout=float(env("TIMEOUT", "5")),
+        check_after=float(env("CHECK_AFTER", "30")),
+        max_lifetime=float(env("MAX_LIFETIME", "1800")),
+    )
+
+
+_pool: Optional[ConnectionPool] = None
+_replica: Optional[ConnectionPool] = None
+_replica_down_until = 0.0
+
+POOL_CONNECTIONS = metrics.Gauge("sb_db_pool_connections", "Connections held by the pool", ("state",))
+REPLICA_CONNECTIONS = metrics.Gauge("sb_db_replica_pool_connections", "Connections held by the replica pool", ("state",))
+REPLICA_UP = metrics.Gauge("sb_db_replica_up", "1 while read-only queries are routed to the replica")
+READS = metrics.Counter("sb_db_readonly_connections_total", "Read-only connections handed out, by target", ("target",))
+
+
+async def _collect_pool():
+    if _pool is not None:
+        POOL_CONNECTIONS.set(_pool.size - _pool.idle, "in_use")
+        POOL_CONNECTIONS.set(_pool.idle, "idle")
+    if _replica is not None:
+        REPLICA_CONNECTIONS.set(_replica.size - _replica.idle, "in_use")
+        REPLICA_CONNECTIONS.set(_replica.idle, "idle")
+    REPLICA_UP.set(1 if replica_available() else 0)
+
+
+metrics.add_collector(_collect_pool)
+
+
+def get_pool() -> ConnectionPool:
+    if _pool is None:
+        raise RuntimeError("database pool is not open")
+    return _pool
+
+
+def replica_available() -> bool:
+    return _replica is not None and time.monotonic() >= _replica_down_until
+
+
+def mark_replica_down(exc: BaseException):
+    global _replica_down_until
+    if time.monotonic() >= _replica_down_until:
+        logger.warning("read replica unavailable, reading from primary for %ss: %s", REPLICA_RETRY_AFTER, exc)
+    _replica_down_until = time.monotonic() + REPLICA_RETRY_AFTER
+
+
+async def open_pool():
+    global _pool, _replica
+    if _pool is None:
+        pool = pool_from_env()
+        await pool.open()
+        _pool = pool
+    if DATABASE_REPLICA_URL and _replica is None:
+        replica = pool_from_env(DATABASE_REPLICA_URL, "DB_REPLICA_POOL")
+        try:
+            await replica.open()
+        except Exception as e:
+            # réplica fora no startup não impede a subida; conexões abrem sob demanda depois
+            mark_replica_down(e)
+        _replica = replica
+
+
+async def close_pool():
+    global _pool, _replica
+    pool, _pool = _pool, None
+    replica, _replica = _replica, None
+    if pool is not None:
+        await pool.close()
+    if replica is not None:
+        await replica.close()
+
+
+async def _acquire_readonly():
+    if replica_available():
+        try:
+            raw = await _replica.acquire()
+            READS.inc("replica")
+            return _replica, raw
+        except PoolTimeout:
+            raise
+        except Exception as e:
+            mark_replica_down(e)
+    READS.inc("primary")
+    pool = get_pool()
+    return pool, await pool.acquire()
+
+
+@asynccontextmanager
+async def connection(readonly: bool = False):
+    """
+    Empresta uma conexão do pool; transação pendente é desfeita na devolução.
+    `readonly=True` usa a réplica quando configurada e saudável (sem garantia
+    de ler a própria escrita: quem acabou de escrever deve ler do primário).
+    """
+    with metrics.timed("db", "acquire"):
+        if readonly:
+            pool, raw = await _acquire_readonly()
+        else:
+            pool = get_pool()
+            raw = await pool.acquire()
+    try:
+        yield AsyncConnection(raw)
+    except psycopg2.OperationalError as e:
+        # réplica caiu no meio da leitura: as próximas vão para o primário
+        if pool is _replica:
+            mark_replica_down(e)
+        raise
+    finally:
+        await pool.release(raw)
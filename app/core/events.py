@@ -0,0 +1,223 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+from contextlib import asynccontextmanager
+from typing import Callable, Optional
+
+import psycopg2
+import psycopg2.extensions
+
+from app.core import db, metrics
+
+logger = logging.getLogger("uvicorn.error")
+
+CHANNEL = "booking_events"
+_HOSTNAME = socket.gethostname()
+
+
+def origin() -> str:
+    # calculado na hora: o pid muda quando o worker é criado por fork
+    return f"{_HOSTNAME}:{os.getpid()}"
+
+
+class _Topic:
+    __slots__ = ("version", "event", "future", "refs")
+
+    def __init__(self):
+        self.version = 0
+        self.event: Optional[dict] = None
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.refs = 0
+
+
+class Subscription:
+    def __init__(self, topic: _Topic):
+        self._topic = topic
+        self._seen = topic.version
+
+    async def wait(self, timeout: float) -> Optional[dict]:
+        """Próximo evento da booking, ou None se `timeout` passar sem nenhum."""
+        topic = self._topic
+        if topic.version == self._seen:
+            try:
+                async with asyncio.timeout(timeout):
+                    await asyncio.shield(topic.future)
+            except TimeoutError:
+                return None
+        self._seen = topic.version
+        return topic.event
+
+
+class BookingHub:
+    """
+    Espera por mudanças de booking dentro do processo. Todos os clientes
+    parados na mesma booking dividem uma única future, então milhares de
+    long-polls/SSE ociosos custam só a corrotina de cada um.
+    """
+
+    def __init__(self):
+        self._topics: dict[int, _Topic] = {}
+        self._listeners: list[Callable[[dict], None]] = []
+
+    @property
+    def waiting(self) -> int:
+        return sum(t.refs for t in self._topics.values())
+
+    def add_listener(self, fn: Callable[[dict], None]):
+        self._listeners.append(fn)
+
+    @asynccontextmanager
+    async def subscribe(self, booking_id: int):
+        topic = self._topics.get(booking_id)
+        if topic is None:
+            topic = self._topics[booking_id] = _Topic()
+        topic.refs += 1
+        try:
+            yield Subscription(topic)
+        finally:
+            topic.refs -= 1
+            if topic.refs == 0 and self._topics.get(booking_id) is topic:
+                del self._topics[booking_id]
+
+    def publish(self, event: dict):
+        for fn in self._listeners:
+            try:
+                fn(event)
+            except Exception:
+                logger.exception("booking event listener failed")
+        topic = self._topics.get(event["booking_id"])
+        if topic is None:
+            return
+        topic.version += 1
+        topic.event = event
+        future, topic.future = topic.future, asyncio.get_running_loop().create_future()
+        future.set_result(event)
+
+
+hub = BookingHub()
+
+HUB_WAITING = metrics.Gauge("sb_booking_waiters", "Long-poll/SSE clients waiting on booking events")
+
+
+async def _collect():
+    HUB_WAITING.set(hub.waiting)
+
+
+metrics.add_collector(_collect)
+
+
+async def notify(cur: db.AsyncCursor, booking_id: int, status: str, **fields) -> dict:
+    """
+    NOTIFY para os outros workers, entregue pelo Postgres só no commit da
+    transação de `cur`. Quem chama publica o evento devolvido no hub local
+    depois do commit.
+    """
+    event = {"booking_id": booking_id, "status": status, **fields}
+    await cur.execute(
+        "SELECT pg_notify(%s, %s)",
+        (CHANNEL, json.dumps({**event, "origin": origin()})),
+    )
+    return event
+
+
+class PgListener:
+    """LISTEN numa conexão dedicada (fora do pool), lida pelo event loop via add_reader."""
+
+    def __init__(self, connect: Callable, channel: str, on_event: Callable[[dict], None],
+                 retry_interval: float = 5.0, on_listen: Optional[Callable[[], None]] = None):
+        self._connect = connect
+        self.channel = channel
+        self.on_event = on_event
+        self.retry_interval = retry_interval
+        # chamado a cada LISTEN estabelecido: o que foi notificado antes dele (ou enquanto
+        # a conexão estava caída) não chega, quem mantém estado derivado dos eventos recarrega
+        self.on_listen = on_listen
+        self._conn = None
+        self._task: Optional[asyncio.Task] = None
+        self._lost: Optional[asyncio.Event] = None
+        self._attempted: Optional[asyncio.Event] = None
+
+    async def start(self):
+        """Volta depois da primeira tentativa de LISTEN (com sucesso ou não)."""
+        self._lost = asyncio.Event()
+        self._attempted = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        await self._attempted.wait()
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._close()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                self._conn = await asyncio.to_thread(self._listen)
+                self._lost.clear()
+                loop.add_reader(self._conn.fileno(), self._on_readable)
+                if self.on_listen is not None:
+                    self.on_listen()
+                self._attempted.set()
+                await self._lost.wait()
+            except Exception:
+                logger.exception("LISTEN %s failed; retrying", self.channel)
+            self._attempted.set()
+            self._close()
+            await asyncio.sleep(self.retry_interval)
+
+    def _listen(self):
+        conn = self._connect()
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        cur = conn.cursor()
+        cur.execute(f"LISTEN {self.channel}")
+        cur.close()
+        return conn
+
+    def _on_readable(self):
+        try:
+            self._conn.poll()
+        except Exception:
+            logger.warning("LISTEN %s connection lost", self.channel)
+            self._lost.set()
+            return
+        while self._conn.notifies:
+            notification = self._conn.notifies.pop(0)
+            try:
+                event = json.loads(notification.payload)
+            except ValueError:
+                continue
+            if event.pop("origin", None) == origin():
+                continue
+            self.on_event(event)
+
+    def _close(self):
+        if self._conn is None:
+            return
+        try:
+            asyncio.get_running_loop().remove_reader(self._conn.fileno())
+        except Exception:
+            pass
+        try:
+            self._conn.close()
+        except Exception:
+            pass
+        self._conn = None
+
+
+def listener_from_env(on_listen: Optional[Callable[[], None]] = None) -> Optional[PgListener]:
+    if not db.DATABASE_URL:
+        return None
+    return PgListener(
+        lambda: psycopg2.connect(db.DATABASE_URL, sslmode=os.getenv("DB_SSLMODE", "require")),
+        CHANNEL,
+        hub.publish,
+        on_listen=on_listen,
+    )
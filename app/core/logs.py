@@ -0,0 +1,196 @@
+"""
+Logging estruturado fora do event loop.
+
+Os loggers da aplicação só enfileiram o LogRecord; formatar (inclusive o
+traceback) em JSON e escrever no stream acontece numa thread (QueueListener).
+Com a fila cheia o registro é descartado e contado, o request não espera.
+"""
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import time
+import uuid
+from collections import OrderedDict
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Optional
+
+from app.core import metrics
+
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# corpo de request registrado em erros de validação é cortado neste tamanho (bytes)
+LOG_BODY_MAX = int(os.getenv("LOG_BODY_MAX", "2048"))
+# a mesma exceção (tipo + frames) só tem a pilha registrada uma vez por janela
+LOG_TRACEBACK_WINDOW = float(os.getenv("LOG_TRACEBACK_WINDOW", "60"))
+# "uvicorn" cobre o uvicorn.error, usado pela aplicação inteira
+LOGGERS = ("uvicorn", "uvicorn.access")
+HEADER = "x-request-id"
+
+DROPPED = metrics.Counter("sb_log_records_dropped_total", "Log records dropped because the log queue was full", ("level",))
+SUPPRESSED = metrics.Counter("sb_log_tracebacks_suppressed_total", "Repeated tracebacks not logged within the dedup window")
+
+request_id: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+
+
+class JsonFormatter(logging.Formatter):
+    """Uma linha JSON por registro; `extra={"fields": {...}}` vira chaves do objeto."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if getattr(record, "request_id", None):
+            entry["request_id"] = record.request_id
+        entry.update(getattr(record, "fields", None) or {})
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # o QueueHandler padrão formata aqui, no event loop; só o request id precisa ser capturado agora
+        if getattr(record, "request_id", None) is None:
+            record.request_id = request_id.get()
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DROPPED.inc(record.levelname)
+
+
+class _QueueListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # no stop a fila pode estar cheia: espera a thread abrir espaço
+        self.queue.put(self._sentinel)
+
+
+class Pipeline:
+    """Troca os handlers de `loggers` por uma fila limitada drenada por uma thread."""
+
+    def __init__(self, maxsize: int = LOG_QUEUE_SIZE, stream=None):
+        self.queue: queue.Queue = queue.Queue(maxsize)
+        self.handler = _QueueHandler(self.queue)
+        output = logging.StreamHandler(stream or sys.stderr)
+        output.setFormatter(JsonFormatter())
+        self._listener = _QueueListener(self.queue, output)
+        self._saved: dict[str, tuple[list, bool]] = {}
+
+    def start(self, loggers: tuple = LOGGERS):
+        if self._saved:
+            return
+        for name in loggers:
+            logger = logging.getLogger(name)
+            self._saved[name] = (logger.handlers[:], logger.propagate)
+            logger.handlers = [self.handler]
+            logger.propagate = False
+        self._listener.start()
+
+    def stop(self):
+        if not self._saved:
+            return
+        self._listener.stop()
+        for name, (handlers, propagate) in self._saved.items():
+            logger = logging.getLogger(name)
+            logger.handlers = handlers
+            logger.propagate = propagate
+        self._saved.clear()
+
+
+class TracebackSampler:
+    """
+    Deduplica tracebacks: por assinatura (tipo + arquivo/linha de cada frame),
+    a pilha é registrada na primeira ocorrência de cada janela; as demais só
+    são contadas e o total aparece no próximo registro completo.
+    """
+
+    def __init__(self, window: float = LOG_TRACEBACK_WINDOW, maxsize: int = 1000):
+        self.window = window
+        self.maxsize = maxsize
+        self._seen: OrderedDict[tuple, list] = OrderedDict()
+
+    @staticmethod
+    def fingerprint(exc: BaseException) -> tuple:
+        frames = []
+        tb = exc.__traceback__
+        while tb is not None:
+            frames.append((tb.tb_frame.f_code.co_filename, tb.tb_lineno))
+            tb = tb.tb_next
+        return type(exc).__qualname__, tuple(frames)
+
+    def check(self, exc: BaseException) -> Optional[int]:
+        """None se a pilha deve ser omitida; senão quantas foram omitidas desde a última registrada."""
+        key = self.fingerprint(exc)
+        now = time.monotonic()
+        state = self._seen.get(key)
+        if state is not None and now < state[0]:
+            state[1] += 1
+            SUPPRESSED.inc()
+            return None
+        suppressed = state[1] if state is not None else 0
+        self._seen[key] = [now + self.window, 0]
+        self._seen.move_to_end(key)
+        while len(self._seen) > self.maxsize:
+            self._seen.popitem(last=False)
+        return suppressed
+
+    def clear(self):
+        self._seen.clear()
+
+
+def truncate(body: bytes, limit: int = LOG_BODY_MAX) -> str:
+    text = body[:limit].decode("utf-8", errors="replace")
+    if len(body) > limit:
+        text += f"...<{len(body) - limit} more bytes>"
+    return text
+
+
+def request_fields(request) -> dict:
+    """Mesmos rótulos das métricas HTTP (rota do template), para cruzar log e métrica."""
+    return {
+        "method": request.method,
+        "route": getattr(request.scope.get("route"), "path", "<unmatched>"),
+        "path": request.url.path,
+    }
+
+
+def _valid_id(value: bytes) -> bool:
+    return 0 < len(value) <= 128 and all(33 <= c < 127 for c in value)
+
+
+class RequestIdMiddleware:
+    """
+    Middleware ASGI puro: usa o X-Request-ID recebido (se for sensato) ou gera
+    um, devolve no header e deixa no contexto para os logs do request.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        incoming = next((v for k, v in scope.get("headers", ()) if k == HEADER.encode()), b"")
+        rid = incoming.decode("ascii") if _valid_id(incoming) else uuid.uuid4().hex
+        # sem reset: cada request roda no seu próprio contexto e o handler de 500
+        # (ServerErrorMiddleware, mais externo) ainda precisa do id
+        request_id.set(rid)
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [(HEADER.encode(), rid.encode())]
+            await send(message)
+
+        await self.app(scope, receive, send_with_id)
+
+
+pipeline = Pipeline()
+tracebacks = TracebackSampler()
@@ -0,0 +1,178 @@
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Awaitable, Callable, Optional
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: dict[tuple, object] = {}
+        REGISTRY.append(self)
+
+    def header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount: float = 1.0):
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def value(self, *labels) -> float:
+        return self._values.get(labels, 0.0)
+
+    def render(self) -> list[str]:
+        return self.header() + [
+            f"{self.name}{_labels(self.labelnames, k)} {v}" for k, v in self._values.items()
+        ]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, *labels):
+        self._values[labels] = value
+
+    def dec(self, *labels, amount: float = 1.0):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels):
+        state = self._values.get(labels)
+        if state is None:
+            state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        state[0][bisect_left(self.buckets, value)] += 1
+        state[1] += value
+
+    def count(self, *labels) -> int:
+        state = self._values.get(labels)
+        return sum(state[0]) if state else 0
+
+    def render(self) -> list[str]:
+        lines = self.header()
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                le = 'le="%s"' % ("+Inf" if bound == float("inf") else repr(bound))
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+REGISTRY: list[_Metric] = []
+_collectors: list[Callable[[], Awaitable[None]]] = []
+
+
+def add_collector(fn: Callable[[], Awaitable[None]]):
+    """
+    Corrotina chamada a cada scrape para atualizar gauges calculados sob demanda.
+    Só estado em memória: /metrics não tem token, um collector que consulte o
+    banco vira um jeito de esgotar o pool.
+    """
+    _collectors.append(fn)
+
+
+async def render() -> str:
+    for collect in _collectors:
+        try:
+            await collect()
+        except Exception:
+            pass
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+HTTP_LATENCY = Histogram("sb_http_request_duration_seconds", "HTTP request latency by route", ("method", "route"))
+HTTP_REQUESTS = Counter("sb_http_requests_total", "HTTP responses by route and status", ("method", "route", "status"))
+HTTP_IN_FLIGHT = Gauge("sb_http_requests_in_flight", "HTTP requests being processed")
+DEPENDENCY_LATENCY = Histogram(
+    "sb_dependency_duration_seconds", "Latency of DB and upstream calls", ("kind", "operation")
+)
+
+# tempos por dependência da requisição atual, para o header Server-Timing
+_timings: ContextVar[Optional[dict]] = ContextVar("sb_timings", default=None)
+
+
+@contextmanager
+def timed(kind: str, operation: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        DEPENDENCY_LATENCY.observe(elapsed, kind, operation)
+        timings = _timings.get()
+        if timings is not None:
+            timings[kind] = timings.get(kind, 0.0) + elapsed
+
+
+def _server_timing(timings: dict, total: float) -> bytes:
+    parts = [f"{kind};dur={elapsed * 1000:.1f}" for kind, elapsed in timings.items()]
+    parts.append(f"app;dur={total * 1000:.1f}")
+    return ", ".join(parts).encode()
+
+
+class MetricsMiddleware:
+    """Middleware ASGI puro: latência/status por rota, requisições em andamento e Server-Timing."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        timings: dict = {}
+        token = _timings.set(timings)
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"server-timing", _server_timing(timings, time.perf_counter() - start))
+                ]
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            HTTP_IN_FLIGHT.dec()
+            _timings.reset(token)
+            route = scope.get("route")
+            path = getattr(route, "path", "<unmatched>")
+            HTTP_LATENCY.observe(time.perf_counter() - start, scope["method"], path)
+            HTTP_REQUESTS.inc(scope["method"], path, str(status))
@@ -0,0 +1,217 @@
+"""
+Profiler por amostragem para requests em produção, ligado sob demanda.
+
+Cada request selecionado (fração aleatória, rota ou header) registra sua
+task; uma thread amostra, a cada `interval`, a pilha da thread do event loop
+se a task estiver rodando, ou a cadeia de corrotinas (cr_await) se estiver
+suspensa. Assim o tempo de parede aparece onde o request está: esperando
+`to_thread` (psycopg2), um upstream, ou serializando JSON no loop.
+
+O resultado são pilhas colapsadas (`rota;frame;frame N`), o formato do
+flamegraph.pl / speedscope. Desligado, o middleware só testa `active` e não
+existe thread.
+
+O estado é do processo: com vários workers (app.server), cada chamada de
+/admin/profile cai num worker qualquer e só vale para ele. Para perfilar,
+suba com WEB_CONCURRENCY=1; as respostas trazem o `pid` do worker para
+conferir que start, collapsed e stop falaram com o mesmo processo.
+"""
+import asyncio
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Optional
+
+from app.core import metrics
+from app.core.admission import route_path
+
+SAMPLES = metrics.Counter("sb_profiler_samples_total", "Stack samples taken by the request profiler")
+
+
+class Session:
+    def __init__(
+        self,
+        *,
+        rate: float = 0.0,
+        routes: tuple = (),
+        header: Optional[str] = None,
+        interval: float = 0.005,
+        duration: float = 60.0,
+        max_requests: int = 32,
+        max_stacks: int = 10000,
+    ):
+        self.rate = rate
+        self.routes = set(routes)
+        self.header = header.lower().encode() if header else None
+        self.interval = interval
+        self.ends_at = time.monotonic() + duration
+        self.max_requests = max_requests
+        self.max_stacks = max_stacks
+        # escrito pela thread do profiler, lido pelas rotas de admin no event loop
+        self.stacks: Counter = Counter()
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.samples = 0
+        self.dropped = 0
+
+    def wants(self, scope) -> Optional[str]:
+        """Rota do request se ele deve ser amostrado."""
+        route = route_path(scope)
+        if route in self.routes:
+            return route
+        if self.header is not None and any(k == self.header for k, _ in scope.get("headers", ())):
+            return route
+        if self.rate and random.random() < self.rate:
+            return route
+        return None
+
+    def add(self, stack: str):
+        with self._lock:
+            if stack in self.stacks or len(self.stacks) < self.max_stacks:
+                self.stacks[stack] += 1
+            else:
+                self.dropped += 1
+            self.samples += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self.stacks)
+
+    def describe(self) -> dict:
+        with self._lock:
+            stacks, samples, dropped = len(self.stacks), self.samples, self.dropped
+        return {
+            "rate": self.rate,
+            "routes": sorted(self.routes),
+            "header": self.header.decode() if self.header else None,
+            "interval": self.interval,
+            "remaining": max(0.0, self.ends_at - time.monotonic()),
+            "requests": self.requests,
+            "samples": samples,
+            "stacks": stacks,
+            "dropped": dropped,
+        }
+
+
+def _name(frame) -> str:
+    return f"{frame.f_globals.get('__name__', '?')}:{frame.f_code.co_qualname}"
+
+
+def _task_frames(task: asyncio.Task, start, loop_frame) -> list:
+    """Frames do request, do middleware até a folha."""
+    # rodando agora: a pilha da thread do loop passa pelo frame do middleware
+    frames = []
+    frame = loop_frame
+    while frame is not None:
+        frames.append(frame)
+        if frame is start:
+            frames.reverse()
+            return frames
+        frame = frame.f_back
+    # suspensa: segue a cadeia de corrotinas até o que ela aguarda (future do to_thread, socket...)
+    frames = []
+    coro = task.get_coro()
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+        if frame is None:
+            break
+        if frames or frame is start:
+            frames.append(frame)
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+    return frames
+
+
+class Profiler:
+    def __init__(self):
+        self.session: Optional[Session] = None
+        self.last: Optional[Session] = None
+        # lido pelo middleware a cada request: a única coisa que custa com o profiler desligado
+        self.active = False
+        # task -> (frame do middleware, rota)
+        self._requests: dict[asyncio.Task, tuple] = {}
+        self._loop_thread: Optional[int] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def start(self, session: Session):
+        self.stop()
+        self.session = session
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(session,), name="profiler", daemon=True)
+        self._thread.start()
+        self.active = True
+
+    def stop(self) -> Optional[Session]:
+        self.active = False
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            self._stop.set()
+            thread.join()
+        if self.session is not None:
+            self.last, self.session = self.session, None
+        self._requests.clear()
+        return self.last
+
+    def collapsed(self) -> str:
+        session = self.session or self.last
+        if session is None:
+            return ""
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(session.snapshot().items()))
+
+    def enter(self, route: str, frame) -> Optional[asyncio.Task]:
+        session = self.session
+        if session is None or len(self._requests) >= session.max_requests:
+            return None
+        task = asyncio.current_task()
+        self._loop_thread = threading.get_ident()
+        self._requests[task] = (frame, route)
+        session.requests += 1
+        return task
+
+    def leave(self, task: asyncio.Task):
+        self._requests.pop(task, None)
+
+    def _run(self, session: Session):
+        while not self._stop.wait(session.interval):
+            if time.monotonic() >= session.ends_at:
+                # a sessão expira sozinha; o resultado continua disponível até a próxima
+                self.active = False
+                break
+            if self._requests:
+                self._sample(session)
+
+    def _sample(self, session: Session):
+        loop_frame = sys._current_frames().get(self._loop_thread)
+        for task, (start, route) in list(self._requests.items()):
+            try:
+                frames = _task_frames(task, start, loop_frame)
+            except (AttributeError, RuntimeError):
+                # a task mudou enquanto era lida; perde-se uma amostra
+                continue
+            if not frames:
+                continue
+            session.add(";".join([route, *(_name(f) for f in frames)]))
+            SAMPLES.inc()
+
+
+class ProfilerMiddleware:
+    """Middleware ASGI puro; só faz algo enquanto há uma sessão de profiling ativa."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if not profiler.active or scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        route = profiler.session.wants(scope) if profiler.session is not None else None
+        task = profiler.enter(route, sys._getframe()) if route is not None else None
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            if task is not None:
+                profiler.leave(task)
+
+
+profiler = Profiler()
@@ -1,33 +1,115 @@
-from fastapi import FastAPI
-from app.api.routes import health, bookings_user, quotes, callbacks
+from contextlib import asynccontextmanager
+
 from dotenv import load_dotenv
+
+# único ponto que lê o .env; precisa vir antes dos módulos que leem o ambiente ao serem importados
 load_dotenv()
 
+from fastapi import FastAPI
+from app.api.routes import availability, health, bookings_user, profiling, quotes, callbacks
+from app.core import db, events, logs
+from app.core.admission import AdmissionMiddleware
+from app.core.metrics import MetricsMiddleware
+from app.core.profiler import ProfilerMiddleware, profiler
+from app.services import agenda_client, checkout, occupancy, outbox, payment_client, pricing, reaper, warmup
+from app.services.resilience import CircuitOpen
+
 
-app = FastAPI(title="Sports-Booking")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    logs.pipeline.start()
+    await db.open_pool()
+    agenda_client.get_client()
+    payment_client.get_client()
+    await pricing.cache.start()
+    # LISTEN antes da carga: a recarga agendada pelo primeiro LISTEN vê que a
+    # carga do startup já é posterior a ele e não repete a varredura
+    listener = events.listener_from_env(on_listen=occupancy.index.reload_later)
+    if listener is not None:
+        await listener.start()
+    await occupancy.index.load()
+    await outbox.dispatcher.start()
+    await reaper.reaper.start()
+    await checkout.worker.start()
+    await warmup.run()
+    # o supervisor só tira o worker antigo de serviço depois que este passa daqui
+    app.state.ready = True
+    try:
+        yield
+    finally:
+        app.state.ready = False
+        if listener is not None:
+            await listener.stop()
+        await checkout.worker.stop()
+        await reaper.reaper.stop()
+        await outbox.dispatcher.stop()
+        await pricing.cache.stop()
+        await agenda_client.close_client()
+        await payment_client.close_client()
+        await db.close_pool()
+        profiler.stop()
+        logs.pipeline.stop()
+
+
+app = FastAPI(title="Sports-Booking", lifespan=lifespan)
+# a última adicionada fica por fora: as métricas também contam os 429/503 da admissão
+# e o profiler só vê requests admitidos
+app.add_middleware(ProfilerMiddleware)
+app.add_middleware(AdmissionMiddleware)
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(logs.RequestIdMiddleware)
 
 
 app.include_router(health.router, tags=["health"])
 app.include_router(bookings_user.router, tags=["bookings"])
 app.include_router(quotes.router, tags=["quotes"])
 app.include_router(callbacks.router, tags=["callbacks"])
+app.include_router(availability.router, tags=["availability"])
+app.include_router(profiling.router, tags=["admin"])
 
 from fastapi import Request
 from fastapi.exceptions import RequestValidationError
 from fastapi.responses import JSONResponse
-import traceback, logging
+import logging
 
 logger = logging.getLogger("uvicorn.error")
 
 @app.exception_handler(Exception)
 async def unhandled_exc(request: Request, exc: Exception):
-    tb = "".join(traceback.format_exception(type(exc), exc, exc.__traceback__))
-    logger.error("500 on %s %s | %s", request.method, request.url.path, tb)
-    # devolve o erro para facilitar o debug (temporário):
-    return JSONResponse(status_code=500, content={"detail": str(exc)})
+    # a pilha é formatada na thread de log, e só uma vez por janela para a mesma falha
+    suppressed = logs.tracebacks.check(exc)
+    if suppressed is not None:
+        logger.error(
+            "500 on %s %s | %r", request.method, request.url.path, exc,
+            exc_info=exc, extra={"fields": {**logs.request_fields(request), "status": 500, "suppressed": suppressed}},
+        )
+    # devolve o erro para facilitar o debug (temporário); o header vai aqui porque
+    # o ServerErrorMiddleware fica fora do RequestIdMiddleware
+    return JSONResponse(
+        status_code=500, content={"detail": str(exc)}, headers={"X-Request-ID": logs.request_id.get() or ""},
+    )
+
+@app.exception_handler(db.PoolTimeout)
+async def pool_timeout_exc(request: Request, exc: db.PoolTimeout):
+    logger.warning("503 on %s %s | %s", request.method, request.url.path, exc, extra={"fields": logs.request_fields(request)})
+    return JSONResponse(status_code=503, content={"detail": "database busy"}, headers={"Retry-After": "1"})
+
+@app.exception_handler(CircuitOpen)
+async def circuit_open_exc(request: Request, exc: CircuitOpen):
+    logger.warning("503 on %s %s | %s", request.method, request.url.path, exc, extra={"fields": logs.request_fields(request)})
+    return JSONResponse(
+        status_code=503,
+        content={"detail": f"{exc.upstream} unavailable"},
+        headers={"Retry-After": str(int(exc.retry_after))},
+    )
 
 @app.exception_handler(RequestValidationError)
 async def validation_exc(request: Request, exc: RequestValidationError):
-    body = (await request.body()).decode() if await request.body() else "<empty>"
-    logger.error("422 on %s %s | body=%s | errors=%s", request.method, request.url.path, body, exc.errors())
+    body = await request.body()
+    # "input" repete o corpo inteiro em cada erro; o corpo já vai truncado
+    errors = [{k: v for k, v in error.items() if k != "input"} for error in exc.errors()]
+    logger.error(
+        "422 on %s %s", request.method, request.url.path,
+        extra={"fields": {**logs.request_fields(request), "body": logs.truncate(body) if body else "<empty>", "errors": errors}},
+    )
     return JSONResponse(status_code=422, content={"detail": exc.errors()})
@@ -0,0 +1,342 @@
+"""
+Acesso à tabela bookings com prepared statements do servidor.
+
+Cada statement é preparado uma vez por conexão (PREPARE sobrevive a rollback
+e vive enquanto a conexão estiver no pool); depois disso toda chamada é um
+único EXECUTE. As transições de estado são um UPDATE condicional com
+RETURNING, e o pg_notify do evento vai no mesmo statement.
+"""
+from typing import Optional
+from weakref import WeakKeyDictionary
+
+from app.core import db, events
+
+# nome -> (tipos dos parâmetros, SQL)
+STATEMENTS: dict[str, tuple[str, str]] = {
+    "sb_booking_insert": (
+        "int, int, numeric, text, text[], numeric[], text, text",
+        """
+        WITH booking AS (
+            INSERT INTO bookings (court_id, slot_id, status, estimate_total, user_sub)
+            VALUES ($1, $2, 'CREATED', $3, $4)
+            RETURNING id
+        ), extras AS (
+            INSERT INTO booking_extras (booking_id, type, qty, price)
+            SELECT booking.id, e.type, 1, e.price
+            FROM booking, unnest($5, $6) AS e(type, price)
+        ), notified AS (
+            SELECT pg_notify($7, json_build_object(
+                'booking_id', id, 'status', 'CREATED',
+                'court_id', $1, 'slot_id', $2, 'origin', $8)::text)
+            FROM booking
+        )
+        SELECT id, (SELECT count(*) FROM notified) FROM booking
+        """,
+    ),
+    "sb_booking_view": (
+        "bigint",
+        "SELECT id, court_id, slot_id, status, estimate_total, paid_total FROM bookings WHERE id = $1",
+    ),
+    # PENDING_PAYMENT e o job do checkout antes de chamar o Payment: o reaper só
+    # cancela CREATED e nenhum lock de linha fica preso durante a cobrança.
+    # Job em aberto (QUEUED/RUNNING/UNKNOWN) bloqueia outra cobrança; a corrida
+    # entre dois pedidos cai no índice único da 0009. A chave de idempotência
+    # muda só depois de uma recusa definitiva (FAILED)
+    "sb_booking_start_checkout": (
+        "bigint, text, text, text, text, text, float8",
+        """
+        WITH target AS (
+            SELECT id, status FROM bookings WHERE id = $1 FOR UPDATE
+        ), open_job AS (
+            SELECT 1 FROM checkout_jobs
+            WHERE booking_id = $1 AND status IN ('QUEUED', 'RUNNING', 'UNKNOWN')
+            LIMIT 1
+        ), moved AS (
+            UPDATE bookings b SET status = 'PENDING_PAYMENT'
+            FROM target t
+            WHERE b.id = t.id AND t.status IN ('CREATED', 'PENDING_PAYMENT')
+              AND NOT EXISTS (SELECT 1 FROM open_job)
+            RETURNING b.id, b.estimate_total, b.court_id, b.slot_id
+        ), job AS (
+            INSERT INTO checkout_jobs (booking_id, amount, method, coupon, status, attempts,
+                                       available_at, idempotency_key)
+            SELECT id, estimate_total, $4, $5, $6, CASE WHEN $6 = 'RUNNING' THEN 1 ELSE 0 END,
+                   now() + $7 * interval '1 second',
+                   'booking-' || id || '-' || (
+                       SELECT count(*) FROM checkout_jobs f WHERE f.booking_id = $1 AND f.status = 'FAILED'
+                   )
+            FROM moved
+            RETURNING id, idempotency_key
+        ), notified AS (
+            SELECT pg_notify($2, json_build_object(
+                'booking_id', id, 'status', 'PENDING_PAYMENT',
+                'court_id', court_id, 'slot_id', slot_id, 'origin', $3)::text)
+            FROM moved
+        )
+        SELECT t.status, m.estimate_total, m.court_id, m.slot_id, j.id, j.idempotency_key,
+               (SELECT count(*) FROM notified)
+        FROM target t LEFT JOIN moved m ON true LEFT JOIN job j ON true
+        """,
+    ),
+    "sb_booking_cancel": (
+        "bigint, text, text",
+        """
+        WITH target AS (
+            SELECT id, status, court_id, slot_id FROM bookings WHERE id = $1 FOR UPDATE
+        ), cancelled AS (
+            UPDATE bookings b SET status = 'CANCELLED'
+            FROM target t
+            WHERE b.id = t.id AND t.status NOT IN ('CONFIRMED', 'CANCELLED')
+            RETURNING b.id, b.court_id, b.slot_id
+        ), notified AS (
+            SELECT pg_notify($2, json_build_object(
+                'booking_id', id, 'status', 'CANCELLED',
+                'court_id', court_id, 'slot_id', slot_id, 'origin', $3)::text)
+            FROM cancelled
+        )
+        SELECT t.status, t.court_id, t.slot_id, (SELECT count(*) FROM notified) FROM target t
+        """,
+    ),
+    # $1 payment_id, $2 status do Payment, $3 booking_id, $4 novo status, $5 status de
+    # origem permitidos, $6 valor pago, $7/$8 fatura, $9 ação no Agenda (ou NULL)
+    "sb_booking_payment_callback": (
+        "bigint, text, bigint, text, text[], numeric, bigint, text, text, text, text",
+        """
+        WITH fresh AS (
+            INSERT INTO payment_callbacks (payment_id, status, booking_id) VALUES ($1, $2, $3)
+            ON CONFLICT DO NOTHING
+            RETURNING booking_id
+        ), moved AS (
+            UPDATE bookings b
+            SET status = $4,
+                paid_total = COALESCE($6, b.paid_total),
+                invoice_id = COALESCE($7, b.invoice_id),
+                invoice_url = COALESCE($8, b.invoice_url)
+            FROM fresh
+            WHERE b.id = fresh.booking_id AND b.status = ANY($5)
+            RETURNING b.id, b.court_id, b.slot_id
+        ), resolved AS (
+            -- o callback prova que o Payment recebeu a cobrança de um job ambíguo
+            UPDATE checkout_jobs j SET status = 'DONE', payment_id = $1::text, payment_status = $2,
+                                       finished_at = now()
+            FROM fresh
+            WHERE j.booking_id = fresh.booking_id AND j.status = 'UNKNOWN'
+        ), invoiced AS (
+            -- transição ignorada (fora de ordem), mas a fatura ainda é gravada
+            UPDATE bookings b SET invoice_id = $7, invoice_url = $8
+            FROM fresh
+            WHERE b.id = fresh.booking_id AND $7 IS NOT NULL AND NOT EXISTS (SELECT 1 FROM moved)
+            RETURNING b.id
+        ), queued AS (
+            INSERT INTO outbox (upstream, action, payload)
+            SELECT 'agenda', $9, CASE $9
+                WHEN 'mark_booked' THEN jsonb_build_object('court_id', court_id, 'slot_id', slot_id, 'booking_id', id)
+                ELSE jsonb_build_object('lock_id', concat_ws('-', court_id, slot_id, id))
+            END
+            FROM moved WHERE $9 IS NOT NULL
+            RETURNING id
+        ), notified AS (
+            SELECT pg_notify($10, json_build_object(
+                'booking_id', id, 'status', $4,
+                'court_id', court_id, 'slot_id', slot_id, 'origin', $11)::text)
+            FROM moved
+        )
+        SELECT (SELECT count(*) FROM fresh), m.court_id, m.slot_id,
+               (SELECT count(*) FROM invoiced), (SELECT count(*) FROM queued), (SELECT count(*) FROM notified)
+        FROM (SELECT 1) AS one LEFT JOIN moved m ON true
+        """,
+    ),
+    # mesma transição em lote: uma linha por callback, no máximo um callback por booking
+    "sb_booking_payment_callbacks": (
+        "int[], bigint[], text[], bigint[], text[], text[], numeric[], bigint[], text[], text[], text, text",
+        """
+        WITH incoming AS (
+            SELECT * FROM unnest($1, $2, $3, $4, $5, $6, $7, $8, $9, $10)
+                AS i(idx, payment_id, status, booking_id, new_status, allowed,
+                     paid_amount, invoice_id, invoice_url, action)
+        ), fresh AS (
+            INSERT INTO payment_callbacks (payment_id, status, booking_id)
+            SELECT payment_id, status, booking_id FROM incoming
+            ON CONFLICT DO NOTHING
+            RETURNING payment_id, status
+        ), applied AS (
+            SELECT i.* FROM incoming i JOIN fresh f USING (payment_id, status)
+        ), moved AS (
+            UPDATE bookings b
+            SET status = a.new_status,
+                paid_total = COALESCE(a.paid_amount, b.paid_total),
+                invoice_id = COALESCE(a.invoice_id, b.invoice_id),
+                invoice_url = COALESCE(a.invoice_url, b.invoice_url)
+            FROM applied a
+            WHERE b.id = a.booking_id AND b.status = ANY(string_to_array(a.allowed, ','))
+            RETURNING a.idx, b.id, b.court_id, b.slot_id
+        ), resolved AS (
+            UPDATE checkout_jobs j SET status = 'DONE', payment_id = a.payment_id::text,
+                                       payment_status = a.status, finished_at = now()
+            FROM applied a
+            WHERE j.booking_id = a.booking_id AND j.status = 'UNKNOWN'
+        ), invoiced AS (
+            UPDATE bookings b SET invoice_id = a.invoice_id, invoice_url = a.invoice_url
+            FROM applied a
+            WHERE b.id = a.booking_id AND a.invoice_id IS NOT NULL
+              AND NOT EXISTS (SELECT 1 FROM moved m WHERE m.idx = a.idx)
+            RETURNING a.idx
+        ), queued AS (
+            INSERT INTO outbox (upstream, action, payload)
+            SELECT 'agenda', a.action, CASE a.action
+                WHEN 'mark_booked' THEN jsonb_build_object('court_id', m.court_id, 'slot_id', m.slot_id, 'booking_id', m.id)
+                ELSE jsonb_build_object('lock_id', concat_ws('-', m.court_id, m.slot_id, m.id))
+            END
+            FROM moved m JOIN applied a USING (idx)
+            WHERE a.action IS NOT NULL
+            RETURNING id
+        ), notified AS (
+            SELECT pg_notify($11, json_build_object(
+                'booking_id', m.id, 'status', a.new_status,
+                'court_id', m.court_id, 'slot_id', m.slot_id, 'origin', $12)::text)
+            FROM moved m JOIN applied a USING (idx)
+        )
+        SELECT i.idx, f.payment_id IS NOT NULL, m.court_id, m.slot_id, v.idx IS NOT NULL,
+               (SELECT count(*) FROM queued), (SELECT count(*) FROM notified)
+        FROM incoming i
+        LEFT JOIN fresh f USING (payment_id, status)
+        LEFT JOIN moved m USING (idx)
+        LEFT JOIN invoiced v USING (idx)
+        ORDER BY i.idx
+        """,
+    ),
+}
+
+# conexão psycopg2 -> statements já preparados nela
+_prepared: "WeakKeyDictionary[object, set[str]]" = WeakKeyDictionary()
+
+
+async def execute(cur: db.AsyncCursor, name: str, params: tuple):
+    raw = cur.connection
+    prepared = _prepared.get(raw)
+    if prepared is None:
+        prepared = _prepared[raw] = set()
+    if name not in prepared:
+        types, sql = STATEMENTS[name]
+        await cur.execute(f"PREPARE {name} ({types}) AS {sql}")
+        prepared.add(name)
+    await cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+
+
+def prepare_all(raw):
+    """Prepara todos os statements numa conexão psycopg2 (síncrono; usado no warm-up do pool)."""
+    prepared = _prepared.setdefault(raw, set())
+    cur = raw.cursor()
+    try:
+        for name, (types, sql) in STATEMENTS.items():
+            if name not in prepared:
+                cur.execute(f"PREPARE {name} ({types}) AS {sql}")
+                prepared.add(name)
+    finally:
+        cur.close()
+        # PREPARE sobrevive ao fim da transação; a conexão volta ociosa ao pool,
+        # inclusive quando um PREPARE falhou e deixou a transação abortada
+        raw.rollback()
+
+
+def event(booking_id: int, status: str, court_id: int, slot_id: int) -> dict:
+    """Evento para o hub local, igual ao que o statement mandou por pg_notify."""
+    return {"booking_id": booking_id, "status": status, "court_id": court_id, "slot_id": slot_id}
+
+
+async def insert(cur: db.AsyncCursor, court_id: int, slot_id: int, estimate_total: float,
+                 user_sub: Optional[str], extras: list[tuple[str, float]]) -> dict:
+    """Booking CREATED e todos os extras num único statement; devolve o evento."""
+    await execute(cur, "sb_booking_insert", (
+        court_id, slot_id, estimate_total, user_sub,
+        [t for t, _ in extras], [p for _, p in extras],
+        events.CHANNEL, events.origin(),
+    ))
+    return event((await cur.fetchone())[0], "CREATED", court_id, slot_id)
+
+
+async def view(cur: db.AsyncCursor, booking_id: int):
+    await execute(cur, "sb_booking_view", (booking_id,))
+    return await cur.fetchone()
+
+
+async def start_checkout(cur: db.AsyncCursor, booking_id: int, method: str, coupon: Optional[str],
+                         *, run_now: bool, lease: float = 0.0):
+    """
+    (status anterior, job, evento), com job = (job_id, valor, chave de
+    idempotência). Com `run_now` o job já nasce RUNNING (quem chama cobra na
+    hora) e vira UNKNOWN se não for registrado em `lease` segundos; senão fica
+    QUEUED para o worker. Status anterior None = booking não existe; evento
+    None = nada mudou (fora de CREATED/PENDING_PAYMENT ou com job em aberto).
+    """
+    await execute(cur, "sb_booking_start_checkout", (
+        booking_id, events.CHANNEL, events.origin(), method, coupon,
+        "RUNNING" if run_now else "QUEUED", lease,
+    ))
+    row = await cur.fetchone()
+    if not row:
+        return None, None, None
+    status, amount, court_id, slot_id, job_id, key, notified = row
+    if not notified:
+        return status, None, None
+    return status, (job_id, amount, key), event(booking_id, "PENDING_PAYMENT", court_id, slot_id)
+
+
+async def cancel(cur: db.AsyncCursor, booking_id: int):
+    """
+    (status anterior, evento ou None). Status anterior None = booking não
+    existe; CONFIRMED/CANCELLED não mudam e não geram evento.
+    """
+    await execute(cur, "sb_booking_cancel", (booking_id, events.CHANNEL, events.origin()))
+    row = await cur.fetchone()
+    if not row:
+        return None, None
+    status, court_id, slot_id, notified = row
+    return status, event(booking_id, "CANCELLED", court_id, slot_id) if notified else None
+
+
+async def apply_payment_callback(cur: db.AsyncCursor, *, payment_id: int, status: str, booking_id: int,
+                                 new_status: str, allowed: list[str], paid_amount: Optional[float],
+                                 invoice_id: Optional[int], invoice_url: Optional[str],
+                                 agenda_action: Optional[str]) -> dict:
+    """
+    Dedup, transição condicional, fatura, outbox e pg_notify num único statement.
+    `duplicate`: (payment_id, status) já processado; `event`: None se a transição
+    não se aplicou; `invoiced`: só a fatura foi gravada.
+    """
+    await execute(cur, "sb_booking_payment_callback", (
+        payment_id, status, booking_id, new_status, allowed, paid_amount,
+        invoice_id, invoice_url, agenda_action, events.CHANNEL, events.origin(),
+    ))
+    fresh, court_id, slot_id, invoiced, _, _ = await cur.fetchone()
+    return {
+        "duplicate": not fresh,
+        "event": event(booking_id, new_status, court_id, slot_id) if court_id is not None else None,
+        "invoiced": bool(invoiced),
+    }
+
+
+async def apply_payment_callbacks(cur: db.AsyncCursor, callbacks: list[dict]) -> list[dict]:
+    """
+    Versão em lote de apply_payment_callback: um único statement para todos os
+    callbacks. Cada dict traz os argumentos nomeados de apply_payment_callback;
+    no máximo um callback por booking (quem chama divide o resto em rodadas).
+    O resultado vem na mesma ordem de `callbacks`.
+    """
+    columns = ("payment_id", "status", "booking_id", "new_status", "allowed",
+               "paid_amount", "invoice_id", "invoice_url", "agenda_action")
+    arrays = [list(range(len(callbacks)))]
+    for column in columns:
+        values = [c[column] for c in callbacks]
+        # text[] de text[] não passa por unnest; vai como "CREATED,PENDING_PAYMENT"
+        arrays.append([",".join(v) for v in values] if column == "allowed" else values)
+    await execute(cur, "sb_booking_payment_callbacks", (*arrays, events.CHANNEL, events.origin()))
+    results = []
+    for (_, fresh, court_id, slot_id, invoiced, _, _), callback in zip(await cur.fetchall(), callbacks):
+        results.append({
+            "duplicate": not fresh,
+            "event": event(callback["booking_id"], callback["new_status"], court_id, slot_id)
+            if court_id is not None else None,
+            "invoiced": invoiced,
+        })
+    return results
@@ -0,0 +1,53 @@
+"""
+Entrada de produção: `python -m app.server`.
+
+Supervisor do uvicorn com um worker por CPU disponível (ou WEB_CONCURRENCY).
+Cada worker tem seu próprio pool: DB_POOL_MAX_SIZE x workers precisa caber
+no max_connections do Postgres. Estado em memória por processo (profiler,
+caches L1) não é compartilhado: /admin/profile precisa de WEB_CONCURRENCY=1.
+
+- SIGHUP: troca os workers um a um; o novo só entra depois do lifespan
+  (pool aberto e warm-up feito) e só então o antigo é encerrado;
+- SIGTERM: para de aceitar conexões e espera os requests em andamento por
+  até SERVER_GRACEFUL_TIMEOUT segundos.
+
+Lê só o ambiente do processo; o .env é carregado por `app.main` em cada worker.
+"""
+import math
+import os
+from pathlib import Path
+
+import uvicorn
+
+
+def cpu_count() -> int:
+    """CPUs que o processo pode usar: afinidade e, em container, a cota do cgroup v2."""
+    try:
+        count = len(os.sched_getaffinity(0))
+    except AttributeError:
+        count = os.cpu_count() or 1
+    try:
+        quota, period = Path("/sys/fs/cgroup/cpu.max").read_text().split()
+        if quota != "max":
+            count = min(count, max(1, math.ceil(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return count
+
+
+def main():
+    uvicorn.run(
+        "app.main:app",
+        host=os.getenv("HOST", "0.0.0.0"),
+        port=int(os.getenv("PORT", "5000")),
+        workers=int(os.getenv("WEB_CONCURRENCY") or cpu_count()),
+        timeout_graceful_shutdown=int(os.getenv("SERVER_GRACEFUL_TIMEOUT", "30")),
+        # warm-up incluso: pool, upstreams e JWKS antes de o worker contar como pronto
+        timeout_worker_healthcheck=int(os.getenv("SERVER_WORKER_READY_TIMEOUT", "60")),
+        timeout_keep_alive=int(os.getenv("SERVER_KEEP_ALIVE", "5")),
+        log_level=os.getenv("LOG_LEVEL", "info"),
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,45 +1,83 @@
 import os
-import requests
-from dotenv import load_dotenv
+from typing import Optional
 
-load_dotenv()
+import httpx
 
+from app.core import metrics
+from app.services.http import client_from_env, warm_connections, with_read_timeout
+from app.services.resilience import Upstream, upstream_from_env
 
 AGENDA_URL = os.getenv("AGENDA_URL", "http://18.231.197.236:8081")
+# validade do lock pedido em create_booking; depois disso o reaper cancela a booking
+LOCK_TTL = int(os.getenv("AGENDA_LOCK_TTL", "300"))
+# segunda cópia do create_lock quando a primeira passa do p95 (o lock é por booking_id)
+HEDGE_LOCKS = os.getenv("AGENDA_HEDGE_LOCKS", "0") == "1"
 
 
-def create_lock(court_id: int, slot_id: int, booking_id: int, ttl_seconds: int = 300):
-    r = requests.post(f"{AGENDA_URL}/locks", params={
-    "court_id": court_id,
-    "slot_id": slot_id,
-    "booking_id": booking_id,
-    "ttl_seconds": ttl_seconds,
-    }, timeout=10)
-    r.raise_for_status()
-    return r.json()
-
-
-def release_lock(lock_id: int):
-    r = requests.post(f"{AGENDA_URL}/locks/release", params={"lock_id": lock_id}, timeout=10)
-    r.raise_for_status()
-    return r.json()
-
-
-def mark_booked(court_id: int, slot_id: int, booking_id: int):
-    r = requests.post(f"{AGENDA_URL}/mark-booked", params={
-    "court_id": court_id,
-    "slot_id": slot_id,
-    "booking_id": booking_id,
-    }, timeout=10)
-    r.raise_for_status()
-    return r.json()
-
-
-def mark_released(court_id: int, slot_id: int, booking_id: int):
-    r = requests.post(f"{AGENDA_URL}/mark-released", params={
-    "court_id": court_id,
-    "slot_id": slot_id,
-    "booking_id": booking_id,
-    }, timeout=10)
-    r.raise_for_status()
-    return r.json()
\ No newline at end of file
+class AgendaClient:
+    """Cliente assíncrono do Sports-Agenda sobre um pool de conexões keep-alive por worker (limites em client_from_env)."""
+
+    def __init__(self, http: httpx.AsyncClient, upstream: Optional[Upstream] = None):
+        self._http = http
+        self.upstream = upstream or Upstream("agenda")
+
+    async def _post(self, path: str, params: dict, *, idempotent: bool = False, hedge: bool = False):
+        async def attempt(read_timeout: float):
+            with metrics.timed("agenda", path):
+                r = await self._http.post(path, params=params, timeout=with_read_timeout(self._http, read_timeout))
+            r.raise_for_status()
+            return r.json()
+
+        return await self.upstream.call(attempt, idempotent=idempotent, hedge=hedge)
+
+    async def create_lock(self, court_id: int, slot_id: int, booking_id: int, ttl_seconds: int = LOCK_TTL):
+        return await self._post("/locks", {
+            "court_id": court_id,
+            "slot_id": slot_id,
+            "booking_id": booking_id,
+            "ttl_seconds": ttl_seconds,
+        }, hedge=HEDGE_LOCKS)
+
+    async def release_lock(self, lock_id):
+        return await self._post("/locks/release", {"lock_id": lock_id}, idempotent=True)
+
+    async def mark_booked(self, court_id: int, slot_id: int, booking_id: int):
+        return await self._post("/mark-booked", {
+            "court_id": court_id,
+            "slot_id": slot_id,
+            "booking_id": booking_id,
+        }, idempotent=True)
+
+    async def mark_released(self, court_id: int, slot_id: int, booking_id: int):
+        return await self._post("/mark-released", {
+            "court_id": court_id,
+            "slot_id": slot_id,
+            "booking_id": booking_id,
+        }, idempotent=True)
+
+    async def warm(self, connections: int):
+        await warm_connections(self._http, connections)
+
+    async def aclose(self):
+        await self._http.aclose()
+
+
+_client: Optional[AgendaClient] = None
+
+
+def get_client() -> AgendaClient:
+    global _client
+    if _client is None:
+        _client = AgendaClient(
+            client_from_env("AGENDA", AGENDA_URL, read_timeout=10),
+            upstream_from_env("AGENDA", "agenda", read_timeout=10),
+        )
+    return _client
+
+
+async def close_client():
+    global _client
+    client, _client = _client, None
+    if client is not None:
+        await client.aclose()
+
@@ -0,0 +1,305 @@
+import asyncio
+import json
+import logging
+import os
+import random
+from typing import Optional
+
+import httpx
+from psycopg2.extras import execute_values
+
+from app.core import cache, db, events, metrics
+from app.services import payment_client
+
+logger = logging.getLogger("uvicorn.error")
+
+JOBS = metrics.Counter("sb_checkout_jobs_total", "Checkout jobs finished, by outcome", ("outcome",))
+# checkout síncrono: job RUNNING sem resultado depois disso vira UNKNOWN (processo caiu no meio)
+SYNC_LEASE = float(os.getenv("CHECKOUT_SYNC_LEASE", "60"))
+
+
+def _claim(raw, batch_size: int, lease: float):
+    """
+    Jobs reivindicados ficam RUNNING até o `_record`, como os do checkout
+    síncrono. Um RUNNING com lease vencido (processo caiu, ou o `_record`
+    falhou) pode já ter cobrado: vira
+    UNKNOWN, nunca volta para a fila; a booking segue em PENDING_PAYMENT até o
+    callback do Payment.
+    """
+    cur = raw.cursor()
+    try:
+        cur.execute(
+            """
+            UPDATE checkout_jobs
+            SET status = 'UNKNOWN',
+                last_error = coalesce(last_error || '; ', '') || 'lease expired, payment outcome unknown',
+                finished_at = now()
+            WHERE id IN (
+                SELECT id FROM checkout_jobs
+                WHERE status = 'RUNNING' AND available_at <= now()
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, booking_id
+            """
+        )
+        for job_id, booking_id in cur.fetchall():
+            logger.error("checkout job %s for booking %s expired while running; outcome unknown", job_id, booking_id)
+            JOBS.inc("unknown")
+        cur.execute(
+            """
+            UPDATE checkout_jobs SET status = 'RUNNING',
+                                     attempts = attempts + 1,
+                                     available_at = now() + %s * interval '1 second'
+            WHERE id IN (
+                SELECT id FROM checkout_jobs
+                WHERE status = 'QUEUED' AND available_at <= now()
+                ORDER BY id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, booking_id, amount, method, coupon, attempts, idempotency_key
+            """,
+            (lease, batch_size),
+        )
+        rows = cur.fetchall()
+        raw.commit()
+        return rows
+    finally:
+        cur.close()
+
+
+def _record(raw, results: list):
+    """
+    results: (job_id, status, payment_id, payment_status, error, delay).
+    Jobs FAILED devolvem a booking para CREATED, a menos que outro job dela
+    tenha chegado ao Payment (DONE); as bookings revertidas voltam como
+    eventos (já notificados via pg_notify nesta transação).
+    """
+    cur = raw.cursor()
+    try:
+        rows = execute_values(
+            cur,
+            """
+            UPDATE checkout_jobs j
+            SET status = v.status,
+                payment_id = v.payment_id,
+                payment_status = v.payment_status,
+                last_error = v.error,
+                available_at = now() + v.delay * interval '1 second',
+                finished_at = CASE WHEN v.status <> 'QUEUED' THEN now() END
+            FROM (VALUES %s) AS v(id, status, payment_id, payment_status, error, delay)
+            WHERE j.id = v.id
+            RETURNING j.booking_id, v.status
+            """,
+            results,
+            template="(%s, %s, %s, %s, %s, %s::float8)",
+            fetch=True,
+        )
+        failed = [booking_id for booking_id, status in rows if status == "FAILED"]
+        reverted = []
+        if failed:
+            cur.execute(
+                """
+                UPDATE bookings b SET status = 'CREATED'
+                WHERE b.id = ANY(%s) AND b.status = 'PENDING_PAYMENT'
+                  AND NOT EXISTS (SELECT 1 FROM checkout_jobs d WHERE d.booking_id = b.id AND d.status = 'DONE')
+                RETURNING b.id, b.court_id, b.slot_id
+                """,
+                (failed,),
+            )
+            reverted = [
+                {"booking_id": booking_id, "status": "CREATED", "court_id": court_id, "slot_id": slot_id}
+                for booking_id, court_id, slot_id in cur.fetchall()
+            ]
+        if reverted:
+            cur.execute(
+                "SELECT pg_notify(%s, e) FROM unnest(%s::text[]) AS e",
+                (events.CHANNEL, [json.dumps({**event, "origin": events.origin()}) for event in reverted]),
+            )
+        raw.commit()
+        return reverted
+    finally:
+        cur.close()
+
+
+def classify(exc: BaseException) -> str:
+    """
+    FAILED: o Payment recusou (4xx); RETRY: a chamada com certeza não chegou
+    a ele; UNKNOWN: pode ter cobrado (timeout, 5xx, qualquer outro erro).
+    """
+    if isinstance(exc, httpx.HTTPStatusError) and exc.response.status_code < 500:
+        return "FAILED"
+    if payment_client.not_charged(exc):
+        return "RETRY"
+    return "UNKNOWN"
+
+
+async def record(result: tuple):
+    """Grava o resultado de uma cobrança (ver `_record`) e publica as bookings revertidas."""
+    async with db.connection() as conn:
+        reverted = await conn.run(_record, [result])
+    if result[1] != "QUEUED":
+        JOBS.inc(result[1].lower())
+    for event in reverted:
+        await cache.booking_views.invalidate(event["booking_id"])
+        events.hub.publish(event)
+
+
+class CheckoutWorker:
+    """
+    Chama o Payment pelos jobs de checkout: reivindica com SKIP LOCKED (como o
+    outbox) só o que cabe na capacidade livre, no máximo `concurrency` chamadas
+    em voo por worker e nenhuma conexão do pool presa enquanto o Payment
+    responde. A cobrança não é idempotente: só é repetida (com backoff) quando
+    a chamada com certeza não chegou ao Payment; 4xx ou `max_attempts`
+    esgotado encerram o job como FAILED e timeout/5xx como UNKNOWN.
+    """
+
+    def __init__(
+        self,
+        *,
+        concurrency: int = 16,
+        poll_interval: float = 1.0,
+        lease: float = 60.0,
+        max_attempts: int = 5,
+        base_backoff: float = 1.0,
+        max_backoff: float = 60.0,
+    ):
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self._inflight: set[asyncio.Task] = set()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def notify(self):
+        """Acorda o worker logo após o commit de um job novo."""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def backoff(self, attempts: int) -> float:
+        delay = min(self.max_backoff, self.base_backoff * 2 ** (attempts - 1))
+        return delay * random.uniform(0.5, 1.0)
+
+    async def start(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # jobs interrompidos viram UNKNOWN quando o lease vence (ver _claim)
+        for task in list(self._inflight):
+            task.cancel()
+        await asyncio.gather(*self._inflight, return_exceptions=True)
+
+    async def run_once(self) -> int:
+        """Reivindica o que couber na capacidade livre e espera esses jobs terminarem."""
+        jobs = await self._claim()
+        await asyncio.gather(*(self._process(job) for job in jobs))
+        return len(jobs)
+
+    async def _claim(self) -> list:
+        free = self.concurrency - len(self._inflight)
+        if free <= 0:
+            return []
+        async with db.connection() as conn:
+            return await conn.run(_claim, free, self.lease)
+
+    async def _process(self, job):
+        await record(await self._pay(*job))
+
+    async def _pay(self, job_id, booking_id, amount, method, coupon, attempts, idempotency_key) -> tuple:
+        try:
+            pay = await payment_client.get_client().checkout(
+                booking_id=booking_id,
+                amount=float(amount),
+                method=method,
+                coupon=coupon,
+                idempotency_key=idempotency_key,
+            )
+            return job_id, "DONE", str(pay.get("payment_id")), pay.get("status"), None, 0
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"[:500]
+            outcome = classify(e)
+            if outcome == "UNKNOWN":
+                # timeout/5xx: pode ter cobrado; repetir arriscaria cobrar duas vezes
+                logger.error("checkout job %s for booking %s has unknown outcome: %s", job_id, booking_id, error)
+                return job_id, "UNKNOWN", None, None, error, 0
+            if outcome == "FAILED" or attempts >= self.max_attempts:
+                logger.error("checkout job %s for booking %s failed: %s", job_id, booking_id, error)
+                return job_id, "FAILED", None, None, error, 0
+            return job_id, "QUEUED", None, None, error, self.backoff(attempts)
+
+    def _spawn(self, job):
+        task = asyncio.create_task(self._process(job))
+        self._inflight.add(task)
+        task.add_done_callback(self._done)
+
+    def _done(self, task: asyncio.Task):
+        self._inflight.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("checkout job failed to record", exc_info=task.exception())
+
+    async def _run(self):
+        while True:
+            # pool cheio: espera um job terminar antes de reivindicar mais
+            if len(self._inflight) >= self.concurrency:
+                await asyncio.wait(self._inflight, return_when=asyncio.FIRST_COMPLETED)
+                continue
+            try:
+                jobs = await self._claim()
+                for job in jobs:
+                    self._spawn(job)
+                if len(self._inflight) >= self.concurrency:
+                    continue
+            except Exception:
+                logger.exception("checkout worker failed")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+
+async def job_status(job_id: int) -> Optional[dict]:
+    async with db.connection() as conn:
+        cur = conn.cursor()
+        await cur.execute(
+            """
+            SELECT booking_id, status, attempts, payment_id, payment_status, last_error
+            FROM checkout_jobs WHERE id = %s
+            """,
+            (job_id,),
+        )
+        row = await cur.fetchone()
+        await conn.commit()
+        cur.close()
+    if not row:
+        return None
+    booking_id, status, attempts, payment_id, payment_status, error = row
+    if status == "RUNNING" or (status == "QUEUED" and attempts):
+        status = "PROCESSING"
+    return {
+        "job_id": job_id,
+        "booking_id": booking_id,
+        "status": status,
+        "payment_id": payment_id,
+        "payment_status": payment_status,
+        "error": error,
+    }
+
+
+worker = CheckoutWorker(
+    concurrency=int(os.getenv("CHECKOUT_CONCURRENCY", "16")),
+    poll_interval=float(os.getenv("CHECKOUT_POLL_INTERVAL", "1")),
+    max_attempts=int(os.getenv("CHECKOUT_MAX_ATTEMPTS", "5")),
+)
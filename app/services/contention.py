@@ -0,0 +1,97 @@
+import os
+import time
+from contextlib import contextmanager
+
+from app.core import events, metrics
+from app.services import agenda_client
+
+# recusa definitiva (Agenda ou índice único): as próximas tentativas caem no gate por alguns segundos
+REJECT_TTL = float(os.getenv("CONTENTION_REJECT_TTL", "5"))
+REJECTED = metrics.Counter("sb_slot_contention_rejected_total", "create_booking attempts rejected by the in-process slot gate")
+
+
+class SlotHeld(Exception):
+    """O slot já tem uma tentativa em andamento ou uma booking ativa neste worker."""
+
+
+class SlotGate:
+    """
+    Índice em memória de (court_id, slot_id) ocupados neste worker.
+
+    `claim` deixa passar só a primeira tentativa por slot; as concorrentes
+    recebem SlotHeld na hora, sem INSERT nem chamada ao Agenda. Se a tentativa
+    der certo o slot fica marcado por `held_ttl` (validade do lock no Agenda);
+    se falhar a marca sai e a próxima tentativa pode seguir. Entre workers
+    quem segura é o índice único parcial de bookings ativas.
+    """
+
+    def __init__(self, *, held_ttl: float = 300.0, inflight_ttl: float = 60.0, maxsize: int = 100000):
+        self.held_ttl = held_ttl
+        self.inflight_ttl = inflight_ttl
+        self.maxsize = maxsize
+        self._expires: dict[tuple[int, int], float] = {}
+        self._inflight: set[tuple[int, int]] = set()
+
+    def __len__(self):
+        return len(self._expires)
+
+    def clear(self):
+        self._expires.clear()
+        self._inflight.clear()
+
+    def is_held(self, key: tuple[int, int]) -> bool:
+        expires_at = self._expires.get(key)
+        if expires_at is None:
+            return False
+        if expires_at <= time.monotonic():
+            self.release(key)
+            return False
+        return True
+
+    def hold(self, key: tuple[int, int], ttl: float | None = None):
+        self._inflight.discard(key)
+        self._expires[key] = time.monotonic() + (self.held_ttl if ttl is None else ttl)
+        if len(self._expires) > self.maxsize:
+            self._evict()
+
+    def release(self, key: tuple[int, int]):
+        self._inflight.discard(key)
+        self._expires.pop(key, None)
+
+    @contextmanager
+    def claim(self, court_id: int, slot_id: int):
+        key = (court_id, slot_id)
+        if self.is_held(key):
+            REJECTED.inc()
+            raise SlotHeld(f"slot {court_id}/{slot_id} is being booked")
+        self.hold(key, self.inflight_ttl)
+        self._inflight.add(key)
+        try:
+            yield key
+        except BaseException:
+            # quem chamou hold() dentro do bloco (ex.: Agenda recusou) mantém a marca
+            if key in self._inflight:
+                self.release(key)
+            raise
+        self.hold(key)
+
+    def on_event(self, event: dict):
+        if event.get("status") == "CANCELLED" and "court_id" in event:
+            self.release((event["court_id"], event["slot_id"]))
+
+    def _evict(self):
+        now = time.monotonic()
+        for key in [k for k, expires_at in self._expires.items() if expires_at <= now]:
+            self.release(key)
+        # ainda cheio: descarta os mais antigos (o índice único continua valendo)
+        while len(self._expires) > self.maxsize:
+            self.release(next(iter(self._expires)))
+
+
+gate = SlotGate(
+    held_ttl=agenda_client.LOCK_TTL,
+    inflight_ttl=float(os.getenv("CONTENTION_INFLIGHT_TTL", "60")),
+    maxsize=int(os.getenv("CONTENTION_MAX_SLOTS", "100000")),
+)
+# cancelamentos (usuário, pagamento recusado, reaper) de qualquer worker liberam o slot
+events.hub.add_listener(gate.on_event)
@@ -0,0 +1,40 @@
+import asyncio
+import os
+
+import httpx
+
+
+def client_from_env(prefix: str, base_url: str, read_timeout: float) -> httpx.AsyncClient:
+    """
+    AsyncClient com pool próprio e keep-alive para um upstream.
+
+    Configurável por variáveis `<PREFIX>_CONNECT_TIMEOUT`, `<PREFIX>_READ_TIMEOUT`,
+    `<PREFIX>_POOL_TIMEOUT`, `<PREFIX>_MAX_CONNECTIONS`, `<PREFIX>_MAX_KEEPALIVE`
+    e `<PREFIX>_KEEPALIVE_EXPIRY`.
+    """
+    def env(name, default):
+        return os.getenv(f"{prefix}_{name}", default)
+
+    timeout = httpx.Timeout(
+        connect=float(env("CONNECT_TIMEOUT", "3")),
+        read=float(env("READ_TIMEOUT", str(read_timeout))),
+        write=float(env("READ_TIMEOUT", str(read_timeout))),
+        pool=float(env("POOL_TIMEOUT", "5")),
+    )
+    limits = httpx.Limits(
+        max_connections=int(env("MAX_CONNECTIONS", "50")),
+        max_keepalive_connections=int(env("MAX_KEEPALIVE", "20")),
+        keepalive_expiry=float(env("KEEPALIVE_EXPIRY", "30")),
+    )
+    return httpx.AsyncClient(base_url=base_url, timeout=timeout, limits=limits)
+
+
+async def warm_connections(client: httpx.AsyncClient, connections: int):
+    """Abre até `connections` conexões keep-alive (TCP + TLS) com HEAD / simultâneos; o status não importa."""
+    await asyncio.gather(*(client.head("/") for _ in range(connections)))
+
+
+def with_read_timeout(client: httpx.AsyncClient, read: float) -> httpx.Timeout:
+    """Timeout do client com a leitura trocada (timeout adaptativo por chamada)."""
+    t = client.timeout
+    return httpx.Timeout(connect=t.connect, read=read, write=t.write, pool=t.pool)
@@ -0,0 +1,164 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Iterable, Optional
+
+from app.core import db, events, metrics
+
+logger = logging.getLogger("uvicorn.error")
+
+ACTIVE_STATUSES = ("CREATED", "PENDING_PAYMENT", "CONFIRMED")
+# antecedência máxima de uma reserva: booking criada antes disso é de slot que já passou
+HORIZON_DAYS = float(os.getenv("OCCUPANCY_HORIZON_DAYS", "90"))
+# o bitset de uma quadra tem tantos bits quanto o maior slot_id ocupado: o teto
+# limita cada int a MAX_SLOT_ID/8 bytes. Slots acima não entram no índice e o
+# /availability recusa intervalos que passem dele.
+MAX_SLOT_ID = int(os.getenv("OCCUPANCY_MAX_SLOT_ID", "100000"))
+OCCUPIED = metrics.Gauge("sb_occupancy_slots", "Occupied (court, slot) pairs in the in-memory availability index")
+
+
+class OccupancyIndex:
+    """
+    Slots ocupados por quadra como bitset (um int Python por quadra, bit
+    `slot_id` ligado = booking ativa). Carregado uma vez do banco e mantido
+    pelos eventos de booking (hub local + LISTEN dos outros workers); consultar
+    um intervalo é uma máscara e um AND.
+
+    `_owner` guarda qual booking ocupa cada slot: um CANCELLED atrasado de uma
+    booking antiga não libera o slot que outra booking já pegou.
+
+    Só indexa `0 <= slot_id <= max_slot_id`; quem consulta tem que ficar nesse
+    intervalo (ver MAX_SLOT_ID).
+    """
+
+    def __init__(self, max_slot_id: int = MAX_SLOT_ID):
+        self.max_slot_id = max_slot_id
+        self._bits: dict[int, int] = {}
+        self._owner: dict[tuple[int, int], int] = {}
+        # eventos que chegam durante uma carga são reaplicados por cima do snapshot
+        self._buffer: Optional[list[dict]] = None
+        self._loading = asyncio.Lock()
+        # monotonic do início do SELECT da última carga completa
+        self._snapshot_at: Optional[float] = None
+        self.loaded = False
+
+    def __len__(self):
+        return len(self._owner)
+
+    def clear(self):
+        self._bits.clear()
+        self._owner.clear()
+        self._buffer = None
+        self._snapshot_at = None
+        self.loaded = False
+
+    def occupy(self, court_id: int, slot_id: int, booking_id: int):
+        if not 0 <= slot_id <= self.max_slot_id:
+            logger.warning("occupancy: slot_id %s outside 0..%s not indexed", slot_id, self.max_slot_id)
+            return
+        self._owner[(court_id, slot_id)] = booking_id
+        self._bits[court_id] = self._bits.get(court_id, 0) | (1 << slot_id)
+
+    def release(self, court_id: int, slot_id: int, booking_id: int):
+        key = (court_id, slot_id)
+        if self._owner.get(key) != booking_id:
+            return
+        del self._owner[key]
+        bits = self._bits[court_id] & ~(1 << slot_id)
+        if bits:
+            self._bits[court_id] = bits
+        else:
+            del self._bits[court_id]
+
+    def apply(self, event: dict):
+        if "court_id" not in event or event.get("slot_id") is None:
+            return
+        if event["status"] in ACTIVE_STATUSES:
+            self.occupy(event["court_id"], event["slot_id"], event["booking_id"])
+        elif event["status"] == "CANCELLED":
+            self.release(event["court_id"], event["slot_id"], event["booking_id"])
+
+    def on_event(self, event: dict):
+        if self._buffer is not None:
+            self._buffer.append(event)
+        self.apply(event)
+
+    def replace(self, rows: Iterable[tuple[int, int, int]]):
+        """Troca o conteúdo por (booking_id, court_id, slot_id) de bookings ativas."""
+        self._bits = {}
+        self._owner = {}
+        for booking_id, court_id, slot_id in rows:
+            self.occupy(court_id, slot_id, booking_id)
+
+    async def load(self, since: Optional[float] = None):
+        """
+        Bookings ativas criadas dentro do horizonte. Com `since`, não faz nada
+        se a última carga começou depois desse instante (já cobre o que veio antes).
+        """
+        async with self._loading:
+            if since is not None and self._snapshot_at is not None and self._snapshot_at >= since:
+                return
+            self._buffer = []
+            try:
+                async with db.connection() as conn:
+                    cur = conn.cursor()
+                    started = time.monotonic()
+                    await cur.execute(
+                        """
+                        SELECT id, court_id, slot_id FROM bookings
+                        WHERE created_at >= now() - %s * interval '1 day'
+                          AND status IN %s AND slot_id BETWEEN 0 AND %s
+                        """,
+                        (HORIZON_DAYS, ACTIVE_STATUSES, self.max_slot_id),
+                    )
+                    rows = await cur.fetchall()
+                    cur.close()
+                self.replace(rows)
+                for event in self._buffer:
+                    self.apply(event)
+                self._snapshot_at = started
+                self.loaded = True
+            finally:
+                self._buffer = None
+
+    def reload_later(self):
+        """
+        Agendado a cada LISTEN estabelecido: eventos de antes dele não chegaram.
+        Se uma carga começou depois do LISTEN (a do startup), não repete a varredura.
+        """
+        task = asyncio.get_running_loop().create_task(self.load(since=time.monotonic()))
+        task.add_done_callback(self._reloaded)
+
+    @staticmethod
+    def _reloaded(task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("occupancy reload failed", exc_info=task.exception())
+
+    def free_slots(self, court_ids: list[int], slot_from: int, slot_to: int) -> dict[int, list[int]]:
+        """Slots livres de `slot_from` a `slot_to` (inclusive) para cada quadra."""
+        if slot_to > self.max_slot_id:
+            raise ValueError(f"slot_to above {self.max_slot_id}")
+        width = slot_to - slot_from + 1
+        window = (1 << width) - 1
+        result = {}
+        for court_id in court_ids:
+            free = ~(self._bits.get(court_id, 0) >> slot_from) & window
+            slots = []
+            while free:
+                low = free & -free
+                slots.append(slot_from + low.bit_length() - 1)
+                free ^= low
+            result[court_id] = slots
+        return result
+
+
+index = OccupancyIndex()
+events.hub.add_listener(index.on_event)
+
+
+async def _collect():
+    OCCUPIED.set(len(index))
+
+
+metrics.add_collector(_collect)
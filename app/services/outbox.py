@@ -0,0 +1,249 @@
+import asyncio
+import logging
+import os
+import random
+import time
+from typing import Awaitable, Callable, Optional
+
+from psycopg2.extras import Json, execute_values
+
+from app.core import db, metrics
+from app.services import agenda_client
+
+logger = logging.getLogger("uvicorn.error")
+
+OUTBOX_PENDING = metrics.Gauge("sb_outbox_pending", "Outbox rows waiting for delivery")
+OUTBOX_LAG = metrics.Gauge("sb_outbox_lag_seconds", "Age of the oldest pending outbox row")
+OUTBOX_FAILED = metrics.Gauge("sb_outbox_failed", "Outbox rows that exhausted their retries")
+
+
+def _agenda(action: str) -> Callable[[dict], Awaitable]:
+    async def call(payload: dict):
+        return await getattr(agenda_client.get_client(), action)(**payload)
+    return call
+
+
+# (upstream, action) -> corrotina que entrega o payload
+HANDLERS: dict[tuple[str, str], Callable[[dict], Awaitable]] = {
+    ("agenda", "mark_booked"): _agenda("mark_booked"),
+    ("agenda", "release_lock"): _agenda("release_lock"),
+    ("agenda", "mark_released"): _agenda("mark_released"),
+}
+
+
+async def enqueue(cur: db.AsyncCursor, upstream: str, action: str, payload: dict):
+    """Grava a notificação usando o cursor (e portanto a transação) de quem chama."""
+    await cur.execute(
+        "INSERT INTO outbox (upstream, action, payload) VALUES (%s, %s, %s)",
+        (upstream, action, Json(payload)),
+    )
+
+
+def _claim(raw, batch_size: int, lease: float):
+    cur = raw.cursor()
+    try:
+        # o lease esconde as linhas dos outros workers enquanto a entrega acontece
+        cur.execute(
+            """
+            UPDATE outbox SET attempts = attempts + 1,
+                              available_at = now() + %s * interval '1 second'
+            WHERE id IN (
+                SELECT id FROM outbox
+                WHERE dispatched_at IS NULL AND failed_at IS NULL AND available_at <= now()
+                ORDER BY id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, upstream, action, payload, attempts
+            """,
+            (lease, batch_size),
+        )
+        rows = cur.fetchall()
+        raw.commit()
+        return rows
+    finally:
+        cur.close()
+
+
+def _record(raw, done: list, retry: list):
+    cur = raw.cursor()
+    try:
+        if done:
+            cur.execute("UPDATE outbox SET dispatched_at = now() WHERE id = ANY(%s)", (done,))
+        if retry:
+            execute_values(
+                cur,
+                """
+                UPDATE outbox o
+                SET available_at = now() + v.delay * interval '1 second',
+                    last_error = v.error,
+                    failed_at = CASE WHEN v.dead THEN now() END
+                FROM (VALUES %s) AS v(id, delay, error, dead)
+                WHERE o.id = v.id
+                """,
+                retry,
+                template="(%s, %s::float8, %s, %s)",
+            )
+        raw.commit()
+    finally:
+        cur.close()
+
+
+class OutboxDispatcher:
+    """
+    Drena o outbox em lotes: reivindica linhas com SKIP LOCKED (vários workers
+    podem rodar juntos), entrega com limite de concorrência por upstream e
+    reagenda falhas com backoff exponencial até `max_attempts`.
+
+    Os gauges do outbox são atualizados aqui a cada `stats_interval`, nunca
+    no scrape: /metrics não tem token e não pode gerar consulta no banco.
+    """
+
+    def __init__(
+        self,
+        *,
+        batch_size: int = 100,
+        poll_interval: float = 1.0,
+        lease: float = 60.0,
+        max_attempts: int = 10,
+        base_backoff: float = 1.0,
+        max_backoff: float = 300.0,
+        concurrency: Optional[dict[str, int]] = None,
+        handlers: Optional[dict] = None,
+        stats_interval: float = 15.0,
+    ):
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.concurrency = concurrency or {}
+        self.handlers = HANDLERS if handlers is None else handlers
+        self.stats_interval = stats_interval
+        self._stats_due = 0.0
+        self.dispatched = 0
+        self.retried = 0
+        self.dead = 0
+        self._limits: dict[str, asyncio.Semaphore] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def notify(self):
+        """Acorda o dispatcher logo após um commit que gravou no outbox."""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def backoff(self, attempts: int) -> float:
+        delay = min(self.max_backoff, self.base_backoff * 2 ** (attempts - 1))
+        return delay * random.uniform(0.5, 1.0)
+
+    async def start(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def run_once(self) -> int:
+        async with db.connection() as conn:
+            rows = await conn.run(_claim, self.batch_size, self.lease)
+        if not rows:
+            return 0
+        results = await asyncio.gather(*(self._deliver(*row) for row in rows))
+        done = [r[0] for r, error in zip(rows, results) if error is None]
+        retry = []
+        for (row_id, upstream, action, _, attempts), error in zip(rows, results):
+            if error is None:
+                continue
+            dead = attempts >= self.max_attempts
+            retry.append((row_id, 0 if dead else self.backoff(attempts), error[:500], dead))
+            if dead:
+                self.dead += 1
+                logger.error("outbox %s %s.%s gave up after %s attempts: %s", row_id, upstream, action, attempts, error)
+        self.dispatched += len(done)
+        self.retried += len(retry)
+        async with db.connection() as conn:
+            await conn.run(_record, done, retry)
+        return len(rows)
+
+    async def _deliver(self, row_id, upstream, action, payload, attempts) -> Optional[str]:
+        handler = self.handlers.get((upstream, action))
+        if handler is None:
+            return f"no handler for {upstream}.{action}"
+        limit = self._limits.get(upstream)
+        if limit is None:
+            limit = self._limits[upstream] = asyncio.Semaphore(self.concurrency.get(upstream, 10))
+        async with limit:
+            try:
+                await handler(payload)
+                return None
+            except Exception as e:
+                return f"{type(e).__name__}: {e}"
+
+    async def refresh_gauges(self):
+        s = await stats()
+        OUTBOX_PENDING.set(s["pending"])
+        OUTBOX_LAG.set(s["lag_seconds"])
+        OUTBOX_FAILED.set(s["failed"])
+
+    async def _run(self):
+        while True:
+            if time.monotonic() >= self._stats_due:
+                self._stats_due = time.monotonic() + self.stats_interval
+                try:
+                    await self.refresh_gauges()
+                except Exception:
+                    logger.exception("outbox stats failed")
+            try:
+                # lote cheio: provavelmente tem mais, volta sem esperar
+                if await self.run_once() >= self.batch_size:
+                    continue
+            except Exception:
+                logger.exception("outbox dispatch failed")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+
+async def stats() -> dict:
+    """Tamanho e atraso do outbox (idade da notificação pendente mais antiga)."""
+    async with db.connection() as conn:
+        cur = conn.cursor()
+        await cur.execute(
+            """
+            SELECT count(*) FILTER (WHERE failed_at IS NULL),
+                   coalesce(extract(epoch FROM now() - min(created_at) FILTER (WHERE failed_at IS NULL)), 0),
+                   count(*) FILTER (WHERE failed_at IS NOT NULL)
+            FROM outbox WHERE dispatched_at IS NULL
+            """
+        )
+        pending, lag, failed = await cur.fetchone()
+        await conn.commit()
+        cur.close()
+    return {
+        "pending": pending,
+        "lag_seconds": float(lag),
+        "failed": failed,
+        "dispatched": dispatcher.dispatched,
+        "retried": dispatcher.retried,
+        "dead": dispatcher.dead,
+    }
+
+
+dispatcher = OutboxDispatcher(
+    batch_size=int(os.getenv("OUTBOX_BATCH_SIZE", "100")),
+    poll_interval=float(os.getenv("OUTBOX_POLL_INTERVAL", "1")),
+    max_attempts=int(os.getenv("OUTBOX_MAX_ATTEMPTS", "10")),
+    max_backoff=float(os.getenv("OUTBOX_MAX_BACKOFF", "300")),
+    stats_interval=float(os.getenv("OUTBOX_STATS_INTERVAL", "15")),
+    concurrency={"agenda": int(os.getenv("OUTBOX_AGENDA_CONCURRENCY", "10"))},
+)
@@ -1,17 +1,87 @@
 import os
-import requests
-from dotenv import load_dotenv
+from typing import Optional
 
-load_dotenv()
+import httpx
 
+from app.core import metrics
+from app.services.http import client_from_env, warm_connections, with_read_timeout
+from app.services.resilience import CircuitOpen, Upstream, upstream_from_env
 
 PAYMENT_URL = os.getenv("PAYMENT_URL", "http://18.231.197.236:8082")
 
 
-def checkout(booking_id: int, amount: float, method: str, coupon: str | None = None):
+def _checkout_payload(booking_id: int, amount: float, method: str, coupon: str | None):
     payload = {"booking_id": booking_id, "amount": amount, "method": method}
     if coupon:
         payload["coupon"] = coupon
-    r = requests.post(f"{PAYMENT_URL}/checkout", json=payload, timeout=15)
-    r.raise_for_status()
-    return r.json()
\ No newline at end of file
+    return payload
+
+
+def not_charged(exc: BaseException) -> bool:
+    """
+    True só quando com certeza não houve cobrança: circuito aberto ou conexão
+    que nem abriu (a chamada não saiu) ou 4xx. Timeout de leitura, conexão
+    caída no meio e 5xx são ambíguos.
+    """
+    if isinstance(exc, (CircuitOpen, httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)):
+        return True
+    return isinstance(exc, httpx.HTTPStatusError) and exc.response.status_code < 500
+
+
+class PaymentClient:
+    """Cliente assíncrono do Sports-Payment sobre um pool de conexões keep-alive por worker (limites em client_from_env)."""
+
+    def __init__(self, http: httpx.AsyncClient, upstream: Optional[Upstream] = None):
+        self._http = http
+        self.upstream = upstream or Upstream("payment")
+
+    async def checkout(
+        self,
+        booking_id: int,
+        amount: float,
+        method: str,
+        coupon: str | None = None,
+        idempotency_key: str | None = None,
+    ):
+        headers = {"Idempotency-Key": idempotency_key} if idempotency_key else None
+
+        async def attempt(read_timeout: float):
+            with metrics.timed("payment", "/checkout"):
+                r = await self._http.post(
+                    "/checkout",
+                    json=_checkout_payload(booking_id, amount, method, coupon),
+                    headers=headers,
+                    timeout=with_read_timeout(self._http, read_timeout),
+                )
+            r.raise_for_status()
+            return r.json()
+
+        # cobrança não é idempotente: sem retry nem hedge, só breaker e o timeout configurado
+        return await self.upstream.call(attempt, adaptive=False)
+
+    async def warm(self, connections: int):
+        await warm_connections(self._http, connections)
+
+    async def aclose(self):
+        await self._http.aclose()
+
+
+_client: Optional[PaymentClient] = None
+
+
+def get_client() -> PaymentClient:
+    global _client
+    if _client is None:
+        _client = PaymentClient(
+            client_from_env("PAYMENT", PAYMENT_URL, read_timeout=15),
+            upstream_from_env("PAYMENT", "payment", read_timeout=15),
+        )
+    return _client
+
+
+async def close_client():
+    global _client
+    client, _client = _client, None
+    if client is not None:
+        await client.aclose()
+
@@ -0,0 +1,182 @@
+import asyncio
+import logging
+import os
+from datetime import date
+from typing import Optional
+
+from app.core import db
+
+logger = logging.getLogger("uvicorn.error")
+
+# preços usados enquanto as tabelas não foram carregadas (ou estão vazias)
+EXTRA_PRICES = {"ball": 5.0, "vest": 8.0, "lights": 12.0}
+BASE_PRICE = 50.0
+
+POLL_INTERVAL = float(os.getenv("PRICING_POLL_INTERVAL", "30"))
+
+
+class PricingSnapshot:
+    """
+    Tabelas de preço compiladas em dicts imutáveis na prática: o cache troca
+    o snapshot inteiro, nunca altera um em uso. Toda consulta é O(1).
+    """
+
+    __slots__ = ("version", "default_base", "court_base", "slot_multiplier",
+                 "overrides", "court_overrides", "season_multiplier", "extras")
+
+    def __init__(self, version: int = 0, default_base: float = BASE_PRICE,
+                 court_base: Optional[dict] = None, slot_multiplier: Optional[dict] = None,
+                 overrides: Optional[dict] = None, season_multiplier: float = 1.0,
+                 extras: Optional[dict] = None):
+        self.version = version
+        self.default_base = default_base
+        self.court_base = court_base or {}
+        self.slot_multiplier = slot_multiplier or {}
+        self.overrides = overrides or {}
+        self.court_overrides: dict[int, dict[int, float]] = {}
+        for (court_id, slot_id), price in self.overrides.items():
+            self.court_overrides.setdefault(court_id, {})[slot_id] = price
+        self.season_multiplier = season_multiplier
+        self.extras = dict(EXTRA_PRICES) if extras is None else extras
+
+    def base_price(self, court_id: int, slot_id: int) -> float:
+        price = self.overrides.get((court_id, slot_id))
+        if price is None:
+            price = (
+                self.court_base.get(court_id, self.default_base)
+                * self.slot_multiplier.get(slot_id, 1.0)
+                * self.season_multiplier
+            )
+        return round(price, 2)
+
+    def price_rows(self, court_ids: list[int], slot_ids: range, add: float = 0.0) -> list[list[float]]:
+        """
+        base_price(quadra, slot) + add para a grade inteira. Há poucos
+        multiplicadores distintos, então cada linha é calculada uma vez por
+        valor distinto e depois só indexada.
+        """
+        multipliers = [self.slot_multiplier.get(s, 1.0) for s in slot_ids]
+        distinct = set(multipliers)
+        season = self.season_multiplier
+        start = slot_ids.start
+        rows = []
+        for court_id in court_ids:
+            base = self.court_base.get(court_id, self.default_base)
+            value = {m: round(base * m * season, 2) + add for m in distinct}
+            row = [value[m] for m in multipliers]
+            for slot_id, price in self.court_overrides.get(court_id, {}).items():
+                if slot_id in slot_ids:
+                    row[slot_id - start] = round(price, 2) + add
+            rows.append(row)
+        return rows
+
+    def extra_price(self, extra: str) -> float:
+        return self.extras.get(extra, 0.0)
+
+
+async def load_snapshot(today: Optional[date] = None) -> PricingSnapshot:
+    today = today or date.today()
+    # tabela de preços muda raramente e é recarregada por polling: lag da réplica não importa
+    async with db.connection(readonly=True) as conn:
+        cur = conn.cursor()
+        await cur.execute("SELECT version FROM pricing_version")
+        version = (await cur.fetchone())[0]
+        await cur.execute("SELECT court_id, base_price FROM court_prices")
+        court_base = {c: float(p) for c, p in await cur.fetchall()}
+        await cur.execute("SELECT slot_id, multiplier FROM slot_multipliers")
+        slot_multiplier = {s: float(m) for s, m in await cur.fetchall()}
+        await cur.execute("SELECT court_id, slot_id, price FROM court_slot_prices")
+        overrides = {(c, s): float(p) for c, s, p in await cur.fetchall()}
+        await cur.execute(
+            "SELECT multiplier FROM pricing_seasons WHERE %s BETWEEN starts_on AND ends_on ORDER BY id DESC LIMIT 1",
+            (today,),
+        )
+        season = await cur.fetchone()
+        await cur.execute("SELECT type, price FROM extra_prices")
+        extras = {t: float(p) for t, p in await cur.fetchall()}
+        await conn.commit()
+        cur.close()
+    return PricingSnapshot(
+        version=version,
+        court_base=court_base,
+        slot_multiplier=slot_multiplier,
+        overrides=overrides,
+        season_multiplier=float(season[0]) if season else 1.0,
+        extras=extras or None,
+    )
+
+
+async def fetch_version() -> int:
+    async with db.connection(readonly=True) as conn:
+        cur = conn.cursor()
+        await cur.execute("SELECT version FROM pricing_version")
+        row = await cur.fetchone()
+        await conn.commit()
+        cur.close()
+    return row[0]
+
+
+class PricingCache:
+    """
+    Snapshot atual + tarefa que recarrega quando `pricing_version` muda,
+    quando o dia muda (temporadas) ou quando alguém chama `invalidate()`.
+    """
+
+    def __init__(self, loader=load_snapshot, version=fetch_version, poll_interval: float = POLL_INTERVAL):
+        self.snapshot = PricingSnapshot()
+        self._loader = loader
+        self._version = version
+        self.poll_interval = poll_interval
+        self._loaded_on: Optional[date] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def reload(self) -> PricingSnapshot:
+        self.snapshot = await self._loader()
+        self._loaded_on = date.today()
+        return self.snapshot
+
+    def invalidate(self):
+        self._loaded_on = None
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def refresh_if_stale(self):
+        if self._loaded_on != date.today() or await self._version() != self.snapshot.version:
+            await self.reload()
+
+    async def start(self):
+        self._wakeup = asyncio.Event()
+        try:
+            await self.reload()
+        except Exception:
+            logger.exception("pricing tables not loaded; using default prices")
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.refresh_if_stale()
+            except Exception:
+                logger.exception("pricing reload failed; keeping version %s", self.snapshot.version)
+
+
+cache = PricingCache()
+
+
+def current() -> PricingSnapshot:
+    return cache.snapshot
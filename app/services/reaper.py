@@ -0,0 +1,113 @@
+import asyncio
+import json
+import logging
+import os
+from typing import Optional
+
+from app.core import cache, db, events, metrics
+from app.services import agenda_client, outbox
+
+logger = logging.getLogger("uvicorn.error")
+
+REAPED = metrics.Counter("sb_reaper_reaped_total", "CREATED bookings cancelled after the Agenda lock expired")
+
+
+def _reap(raw, batch_size: int, ttl: float):
+    cur = raw.cursor()
+    try:
+        # um lote: cancela e grava os mark_released no outbox no mesmo statement
+        cur.execute(
+            """
+            WITH expired AS (
+                SELECT id FROM bookings
+                WHERE status = 'CREATED' AND created_at < now() - %s * interval '1 second'
+                ORDER BY created_at
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            ), cancelled AS (
+                UPDATE bookings b SET status = 'CANCELLED'
+                FROM expired e
+                WHERE b.id = e.id
+                RETURNING b.id, b.court_id, b.slot_id
+            ), queued AS (
+                INSERT INTO outbox (upstream, action, payload)
+                SELECT 'agenda', 'mark_released',
+                       jsonb_build_object('court_id', court_id, 'slot_id', slot_id, 'booking_id', id)
+                FROM cancelled
+            )
+            SELECT id, court_id, slot_id FROM cancelled
+            """,
+            (ttl, batch_size),
+        )
+        reaped = [
+            {"booking_id": booking_id, "status": "CANCELLED", "court_id": court_id, "slot_id": slot_id}
+            for booking_id, court_id, slot_id in cur.fetchall()
+        ]
+        if reaped:
+            cur.execute(
+                "SELECT pg_notify(%s, e) FROM unnest(%s::text[]) AS e",
+                (events.CHANNEL, [json.dumps({**event, "origin": events.origin()}) for event in reaped]),
+            )
+        raw.commit()
+        return reaped
+    finally:
+        cur.close()
+
+
+class BookingReaper:
+    """
+    Cancela bookings CREATED cujo lock no Agenda já venceu (abandonadas antes
+    do checkout). Lotes limitados com SKIP LOCKED: vários workers dividem a
+    varredura sem esperar um pelo outro; bookings em checkout já estão em
+    PENDING_PAYMENT e ficam de fora.
+    """
+
+    def __init__(self, *, batch_size: int = 500, interval: float = 30.0, ttl: float = 330.0):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.ttl = ttl
+        self.reaped = 0
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def run_once(self) -> int:
+        async with db.connection() as conn:
+            reaped = await conn.run(_reap, self.batch_size, self.ttl)
+        if not reaped:
+            return 0
+        self.reaped += len(reaped)
+        REAPED.inc(amount=len(reaped))
+        for event in reaped:
+            await cache.booking_views.invalidate(event["booking_id"])
+            events.hub.publish(event)
+        outbox.dispatcher.notify()
+        return len(reaped)
+
+    async def _run(self):
+        while True:
+            try:
+                # lote cheio: provavelmente tem mais, volta sem esperar
+                if await self.run_once() >= self.batch_size:
+                    continue
+            except Exception:
+                logger.exception("booking reaper failed")
+            await asyncio.sleep(self.interval)
+
+
+reaper = BookingReaper(
+    batch_size=int(os.getenv("REAPER_BATCH_SIZE", "500")),
+    interval=float(os.getenv("REAPER_INTERVAL", "30")),
+    # margem sobre o TTL do lock para não disputar com um checkout que acabou de chegar
+    ttl=agenda_client.LOCK_TTL + float(os.getenv("REAPER_GRACE", "30")),
+)
@@ -0,0 +1,263 @@
+import asyncio
+import os
+import random
+import time
+from collections import deque
+from typing import Awaitable, Callable, Optional
+
+import httpx
+
+from app.core import metrics
+
+CIRCUIT_STATE = metrics.Gauge("sb_circuit_state", "Upstream circuit breaker state (0 closed, 1 half-open, 2 open)", ("upstream",))
+CIRCUIT_REJECTED = metrics.Counter("sb_circuit_rejected_total", "Calls refused by an open circuit", ("upstream",))
+UPSTREAM_RETRIES = metrics.Counter("sb_upstream_retries_total", "Retries and hedged requests sent upstream", ("upstream", "kind"))
+
+CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+
+
+class CircuitOpen(Exception):
+    """O upstream falhou demais e está em pausa; a chamada nem foi feita."""
+
+    def __init__(self, upstream: str, retry_after: float):
+        super().__init__(f"{upstream} circuit is open")
+        self.upstream = upstream
+        self.retry_after = retry_after
+
+
+def is_failure(exc: BaseException) -> bool:
+    """Erro de rede/timeout ou 5xx conta contra o upstream; 4xx é resposta válida."""
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code >= 500
+    return isinstance(exc, (httpx.TransportError, asyncio.TimeoutError))
+
+
+class CircuitBreaker:
+    """
+    Abre depois de `failure_threshold` falhas seguidas; após `reset_timeout`
+    deixa passar uma chamada de teste (half-open) e fecha se ela der certo.
+    """
+
+    def __init__(self, name: str, *, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        self._set(CLOSED)
+
+    def _set(self, state: int):
+        self.state = state
+        CIRCUIT_STATE.set(state, self.name)
+
+    def allow(self):
+        if self.state == CLOSED:
+            return
+        remaining = self.opened_at + self.reset_timeout - time.monotonic()
+        if self.state == OPEN and remaining <= 0:
+            self._set(HALF_OPEN)
+        if self.state == HALF_OPEN and not self._probing:
+            self._probing = True
+            return
+        CIRCUIT_REJECTED.inc(self.name)
+        raise CircuitOpen(self.name, max(1.0, remaining))
+
+    def record_success(self):
+        self.failures = 0
+        self._probing = False
+        if self.state != CLOSED:
+            self._set(CLOSED)
+
+    def record_failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            self._set(OPEN)
+
+    def release_probe(self):
+        """Chamada terminou sem resultado (cancelada): a próxima pode testar o upstream."""
+        self._probing = False
+
+
+class RetryBudget:
+    """
+    Retries limitados a uma fração das chamadas: cada chamada deposita `ratio`
+    fichas e cada retry/hedge gasta uma. Com o upstream fora do ar os retries
+    param de multiplicar a carga sobre ele.
+    """
+
+    def __init__(self, *, ratio: float = 0.2, initial: float = 10.0, maximum: float = 100.0):
+        self.ratio = ratio
+        self.maximum = maximum
+        self.tokens = initial
+
+    def deposit(self):
+        self.tokens = min(self.maximum, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class AdaptiveTimeout:
+    """
+    Timeout de leitura = p99 recente × `multiplier`, entre `floor` e `ceiling`.
+    Até juntar `min_samples` latências vale o `ceiling` (o timeout configurado).
+    """
+
+    def __init__(self, *, floor: float = 0.5, ceiling: float = 10.0, multiplier: float = 3.0,
+                 window: int = 256, min_samples: int = 20):
+        self.floor = floor
+        self.ceiling = ceiling
+        self.multiplier = multiplier
+        self.min_samples = min_samples
+        self._samples: deque[float] = deque(maxlen=window)
+        self._dirty = 0
+        self._current = ceiling
+        self._p95 = ceiling
+
+    def observe(self, elapsed: float):
+        self._samples.append(elapsed)
+        self._dirty += 1
+        # ordena só de tempos em tempos; o valor não precisa ser exato
+        if len(self._samples) >= self.min_samples and self._dirty >= 16:
+            self._dirty = 0
+            ordered = sorted(self._samples)
+            p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+            self._p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+            self._current = min(self.ceiling, max(self.floor, p99 * self.multiplier))
+
+    @property
+    def current(self) -> float:
+        return self._current
+
+    @property
+    def p95(self) -> float:
+        return self._p95
+
+
+class Upstream:
+    """
+    Política de chamada de um upstream: circuit breaker, timeout adaptativo,
+    retries com backoff (só para chamadas idempotentes, dentro do RetryBudget)
+    e hedge opcional: sem resposta até o p95, manda uma segunda cópia e fica
+    com a primeira que responder.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        *,
+        breaker: Optional[CircuitBreaker] = None,
+        budget: Optional[RetryBudget] = None,
+        timeout: Optional[AdaptiveTimeout] = None,
+        max_attempts: int = 3,
+        base_backoff: float = 0.05,
+        max_backoff: float = 1.0,
+    ):
+        self.name = name
+        self.breaker = breaker or CircuitBreaker(name)
+        self.budget = budget or RetryBudget()
+        self.timeout = timeout or AdaptiveTimeout()
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+
+    async def call(
+        self,
+        fn: Callable[[float], Awaitable],
+        *,
+        idempotent: bool = False,
+        hedge: bool = False,
+        adaptive: bool = True,
+    ):
+        """
+        fn(read_timeout) faz uma tentativa; erros de rede/5xx contam no breaker.
+        Com `adaptive=False` o timeout é sempre o configurado (o teto): para
+        chamadas não idempotentes, em que cortar cedo só troca lentidão por
+        resultado ambíguo.
+        """
+        self.budget.deposit()
+        attempt = 1
+        while True:
+            self.breaker.allow()
+            try:
+                if hedge:
+                    return await self._hedged(fn)
+                return await self._attempt(fn, adaptive)
+            except Exception as e:
+                if not (idempotent and is_failure(e) and attempt < self.max_attempts and self.budget.withdraw()):
+                    raise
+            UPSTREAM_RETRIES.inc(self.name, "retry")
+            # full jitter: retries de vários requests não chegam juntos
+            await asyncio.sleep(random.uniform(0, min(self.max_backoff, self.base_backoff * 2 ** attempt)))
+            attempt += 1
+
+    async def _attempt(self, fn, adaptive: bool = True):
+        start = time.perf_counter()
+        try:
+            result = await fn(self.timeout.current if adaptive else self.timeout.ceiling)
+        except Exception as e:
+            if is_failure(e):
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+            raise
+        except BaseException:
+            # CancelledError não é Exception: sem isto a chamada de teste do
+            # half-open ficaria marcada para sempre e o circuito nunca fecharia
+            self.breaker.release_probe()
+            raise
+        self.breaker.record_success()
+        self.timeout.observe(time.perf_counter() - start)
+        return result
+
+    async def _hedged(self, fn):
+        first = asyncio.ensure_future(self._attempt(fn))
+        done, _ = await asyncio.wait({first}, timeout=self.timeout.p95)
+        if done or not self.budget.withdraw():
+            return await first
+        UPSTREAM_RETRIES.inc(self.name, "hedge")
+        second = asyncio.ensure_future(self._attempt(fn))
+        pending = {first, second}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+            # as duas falharam: propaga o erro da primeira
+            return first.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+def upstream_from_env(prefix: str, name: str, read_timeout: float) -> Upstream:
+    """
+    Upstream configurado por `<PREFIX>_BREAKER_THRESHOLD`, `<PREFIX>_BREAKER_RESET`,
+    `<PREFIX>_RETRY_RATIO`, `<PREFIX>_MAX_ATTEMPTS`, `<PREFIX>_TIMEOUT_FLOOR` e
+    `<PREFIX>_TIMEOUT_MULTIPLIER`; o teto do timeout é `<PREFIX>_READ_TIMEOUT`.
+    """
+    def env(key, default):
+        return os.getenv(f"{prefix}_{key}", default)
+
+    return Upstream(
+        name,
+        breaker=CircuitBreaker(
+            name,
+            failure_threshold=int(env("BREAKER_THRESHOLD", "5")),
+            reset_timeout=float(env("BREAKER_RESET", "30")),
+        ),
+        budget=RetryBudget(ratio=float(env("RETRY_RATIO", "0.2"))),
+        timeout=AdaptiveTimeout(
+            floor=float(env("TIMEOUT_FLOOR", "0.5")),
+            ceiling=float(env("READ_TIMEOUT", str(read_timeout))),
+            multiplier=float(env("TIMEOUT_MULTIPLIER", "3")),
+        ),
+        max_attempts=int(env("MAX_ATTEMPTS", "3")),
+    )
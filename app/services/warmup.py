@@ -0,0 +1,35 @@
+import asyncio
+import logging
+import os
+import time
+
+from app.core import auth, db
+from app.repositories import bookings
+from app.services import agenda_client, payment_client
+
+logger = logging.getLogger("uvicorn.error")
+
+# conexões keep-alive abertas com cada upstream antes do primeiro request
+WARM_CONNECTIONS = int(os.getenv("WARMUP_HTTP_CONNECTIONS", "2"))
+
+
+async def run():
+    """
+    Aquece o worker antes de ele aceitar tráfego: statements preparados nas
+    conexões do pool, conexões com Agenda e Payment e o JWKS do Auth0.
+
+    Falha aqui não impede a subida: o custo só volta para o primeiro request.
+    """
+    started = time.perf_counter()
+    steps = {
+        "db": db.get_pool().warm(bookings.prepare_all),
+        "agenda": agenda_client.get_client().warm(WARM_CONNECTIONS),
+        "payment": payment_client.get_client().warm(WARM_CONNECTIONS),
+        "jwks": auth.get_jwks_cache().refresh(),
+    }
+    results = await asyncio.gather(*steps.values(), return_exceptions=True)
+    failed = {name: result for name, result in zip(steps, results) if isinstance(result, Exception)}
+    for name, error in failed.items():
+        logger.warning("warm-up of %s failed: %r", name, error)
+    logger.info("worker warm in %.0f ms", (time.perf_counter() - started) * 1000)
+    return sorted(failed)
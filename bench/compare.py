@@ -0,0 +1,76 @@
+"""
+Compara dois resultados de bench.run e sai com código 1 se houver regressão:
+
+    python -m bench.compare bench/baseline.json bench/results.json
+
+Regressão = throughput caiu mais que --max-throughput-drop, ou o p95 de
+alguma rota subiu mais que --max-latency-rise (e mais que --min-delta-ms,
+para ruído em rotas rápidas não reprovar o PR).
+"""
+import argparse
+import json
+import sys
+from pathlib import Path
+
+
+def _change(before: float, after: float) -> float:
+    return (after - before) / before if before else 0.0
+
+
+def compare(baseline: dict, current: dict, max_throughput_drop: float, max_latency_rise: float, min_delta_ms: float):
+    rows, regressions = [], []
+
+    before = baseline["throughput"]["requests_per_s"]
+    after = current["throughput"]["requests_per_s"]
+    change = _change(before, after)
+    rows.append(("total req/s", before, after, change))
+    if change < -max_throughput_drop:
+        regressions.append(f"throughput dropped {-change:.0%} ({before} -> {after} req/s)")
+
+    for name, base in sorted(baseline["endpoints"].items()):
+        now = current["endpoints"].get(name)
+        if now is None:
+            regressions.append(f"{name} missing from current run")
+            continue
+        change = _change(base["p95_ms"], now["p95_ms"])
+        rows.append((f"{name} p95 ms", base["p95_ms"], now["p95_ms"], change))
+        if change > max_latency_rise and now["p95_ms"] - base["p95_ms"] > min_delta_ms:
+            regressions.append(f"{name} p95 rose {change:.0%} ({base['p95_ms']} -> {now['p95_ms']} ms)")
+        if now["errors"] > base["errors"]:
+            regressions.append(f"{name} errors {base['errors']} -> {now['errors']}")
+
+    rows.append(("db connections (max)", baseline["db_connections"]["max"], current["db_connections"]["max"],
+                 _change(baseline["db_connections"]["max"], current["db_connections"]["max"])))
+    return rows, regressions
+
+
+def markdown(rows, regressions) -> str:
+    lines = ["| metric | baseline | current | change |", "|---|---:|---:|---:|"]
+    lines += [f"| {name} | {before} | {after} | {change:+.1%} |" for name, before, after, change in rows]
+    lines.append("")
+    lines += [f"- :x: {r}" for r in regressions] or ["No regressions."]
+    return "\n".join(lines) + "\n"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("baseline", type=Path)
+    parser.add_argument("current", type=Path)
+    parser.add_argument("--max-throughput-drop", type=float, default=0.15)
+    parser.add_argument("--max-latency-rise", type=float, default=0.20)
+    parser.add_argument("--min-delta-ms", type=float, default=5.0)
+    args = parser.parse_args()
+
+    rows, regressions = compare(
+        json.loads(args.baseline.read_text()),
+        json.loads(args.current.read_text()),
+        args.max_throughput_drop,
+        args.max_latency_rise,
+        args.min_delta_ms,
+    )
+    print(markdown(rows, regressions), end="")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Stand-ins locais do Sports-Agenda, do Sports-Payment e do JWKS do Auth0,
+com latência injetada. Rodam num processo só, uma porta por serviço:
+
+    python -m bench.fakes --agenda-port 18081 --payment-port 18082 --jwks-port 18083
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+
+import uvicorn
+from fastapi import FastAPI
+
+
+def _delay(mean_ms: float, jitter: float = 0.2):
+    return max(0.0, random.gauss(mean_ms, mean_ms * jitter)) / 1000
+
+
+def agenda_app(latency_ms: float) -> FastAPI:
+    app = FastAPI()
+    calls: dict[str, int] = {}
+
+    async def handle(action: str, response: dict):
+        await asyncio.sleep(_delay(latency_ms))
+        calls[action] = calls.get(action, 0) + 1
+        return response
+
+    @app.post("/locks")
+    async def create_lock(court_id: int, slot_id: int, booking_id: int, ttl_seconds: int = 300):
+        return await handle("create_lock", {"lock_id": f"{court_id}-{slot_id}-{booking_id}"})
+
+    @app.post("/locks/release")
+    async def release_lock(lock_id: str):
+        return await handle("release_lock", {"ok": True})
+
+    @app.post("/mark-booked")
+    async def mark_booked(court_id: int, slot_id: int, booking_id: int):
+        return await handle("mark_booked", {"ok": True})
+
+    @app.post("/mark-released")
+    async def mark_released(court_id: int, slot_id: int, booking_id: int):
+        return await handle("mark_released", {"ok": True})
+
+    @app.get("/_stats")
+    async def stats():
+        return calls
+
+    return app
+
+
+def payment_app(latency_ms: float) -> FastAPI:
+    app = FastAPI()
+    ids = itertools.count(1)
+
+    @app.post("/checkout")
+    async def checkout(payload: dict):
+        await asyncio.sleep(_delay(latency_ms))
+        # o callback é enviado pelo driver do benchmark, para medir a rota também
+        return {"payment_id": next(ids), "status": "PENDING"}
+
+    return app
+
+
+def jwks_app(latency_ms: float, jwks: dict) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/.well-known/jwks.json")
+    async def keys():
+        await asyncio.sleep(_delay(latency_ms))
+        return jwks
+
+    return app
+
+
+async def serve(apps: list[tuple[FastAPI, int]]):
+    servers = [
+        uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+        for app, port in apps
+    ]
+    await asyncio.gather(*(server.serve() for server in servers))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--agenda-port", type=int, default=18081)
+    parser.add_argument("--payment-port", type=int, default=18082)
+    parser.add_argument("--jwks-port", type=int, default=18083)
+    parser.add_argument("--agenda-latency", type=float, default=20, help="ms")
+    parser.add_argument("--payment-latency", type=float, default=80, help="ms")
+    parser.add_argument("--jwks-latency", type=float, default=50, help="ms")
+    args = parser.parse_args()
+
+    # chave pública gerada pelo driver (bench.run), que assina os tokens
+    jwks = json.loads(os.environ["BENCH_JWKS"])
+    asyncio.run(serve([
+        (agenda_app(args.agenda_latency), args.agenda_port),
+        (payment_app(args.payment_latency), args.payment_port),
+        (jwks_app(args.jwks_latency, jwks), args.jwks_port),
+    ]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,341 @@
+"""
+Benchmark de ponta a ponta do fluxo de reserva:
+
+    POST /bookings -> POST /bookings/{id}/checkout -> POST /callbacks/payment
+    -> GET /bookings/{id} (CONFIRMED) -> mark-booked entregue pelo outbox
+
+Sobe os fakes (bench.fakes) e a aplicação com uvicorn, contra um Postgres
+local em BENCH_DATABASE_URL (as tabelas são recriadas/truncadas!), e grava
+req/s, p50/p95/p99 por rota e conexões abertas no banco em JSON.
+
+    BENCH_DATABASE_URL=postgresql://postgres@localhost/bench python -m bench.run --output bench/results.json
+"""
+import argparse
+import asyncio
+import base64
+import itertools
+import json
+import os
+import platform
+import random
+import signal
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import httpx
+import psycopg2
+import rsa
+from jose import jwt
+
+ROOT = Path(__file__).resolve().parent.parent
+SCHEMA = Path(__file__).resolve().parent / "schema.sql"
+AUDIENCE = "https://bench.local/api"
+DOMAIN = "bench.local"
+# tabelas de estado esvaziadas antes de cada execução (CASCADE leva as dependentes)
+TRUNCATE = "TRUNCATE bookings, outbox, payment_callbacks RESTART IDENTITY CASCADE"
+
+
+# ---------- chaves e tokens ----------
+
+def _b64(n: int) -> str:
+    raw = n.to_bytes((n.bit_length() + 7) // 8, "big")
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+
+def make_keys():
+    public, private = rsa.newkeys(2048)
+    jwks = {"keys": [{"kty": "RSA", "kid": "bench", "use": "sig", "alg": "RS256",
+                      "n": _b64(public.n), "e": _b64(public.e)}]}
+    return private.save_pkcs1().decode(), jwks
+
+
+def make_token(private_pem: str, sub: str) -> str:
+    claims = {"sub": sub, "aud": AUDIENCE, "iss": f"https://{DOMAIN}/", "exp": int(time.time()) + 3600}
+    return jwt.encode(claims, private_pem, algorithm="RS256", headers={"kid": "bench"})
+
+
+# ---------- banco ----------
+
+def prepare_database(dsn: str, app_dir: Path):
+    conn = psycopg2.connect(dsn)
+    try:
+        cur = conn.cursor()
+        cur.execute(SCHEMA.read_text())
+        for migration in sorted((app_dir / "migrations").glob("*.sql")):
+            cur.execute(migration.read_text())
+        cur.execute(TRUNCATE)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def count_connections(dsn: str) -> int:
+    conn = psycopg2.connect(dsn)
+    try:
+        cur = conn.cursor()
+        # a própria conexão de amostragem fica de fora
+        cur.execute(
+            """
+            SELECT count(*) FROM pg_stat_activity
+            WHERE datname = current_database() AND backend_type = 'client backend'
+              AND pid <> pg_backend_pid()
+            """
+        )
+        return cur.fetchone()[0]
+    finally:
+        conn.close()
+
+
+def count_confirmed(dsn: str) -> int:
+    conn = psycopg2.connect(dsn)
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT count(*) FROM bookings WHERE status = 'CONFIRMED'")
+        return cur.fetchone()[0]
+    finally:
+        conn.close()
+
+
+# ---------- processos ----------
+
+def start_process(args: list[str], env: dict, cwd: Path) -> subprocess.Popen:
+    return subprocess.Popen([sys.executable, *args], env={**os.environ, **env}, cwd=cwd)
+
+
+def stop_process(proc: subprocess.Popen):
+    if proc.poll() is None:
+        proc.send_signal(signal.SIGTERM)
+        try:
+            proc.wait(10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+async def wait_ready(url: str, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while True:
+            try:
+                if (await client.get(url)).status_code < 500:
+                    return
+            except httpx.HTTPError:
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"{url} did not come up in {timeout}s")
+            await asyncio.sleep(0.2)
+
+
+# ---------- carga ----------
+
+class Recorder:
+    def __init__(self):
+        self.latencies: dict[str, list[float]] = {}
+        self.errors: dict[str, int] = {}
+        self.measuring = False
+
+    async def call(self, name: str, request):
+        start = time.perf_counter()
+        try:
+            response = await request
+            ok = response.status_code < 400
+        except httpx.HTTPError:
+            response, ok = None, False
+        if self.measuring:
+            self.latencies.setdefault(name, []).append(time.perf_counter() - start)
+            if not ok:
+                self.errors[name] = self.errors.get(name, 0) + 1
+        return response if ok else None
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(p / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+async def user_loop(client: httpx.AsyncClient, recorder: Recorder, token: str, slots, stop: asyncio.Event, flows: list):
+    auth = {"Authorization": f"Bearer {token}"}
+    while not stop.is_set():
+        start = time.perf_counter()
+        slot_id = next(slots)
+        body = {"court_id": random.randint(1, 50), "slot_id": slot_id, "extras": random.choice([[], ["ball"], ["ball", "vest"]])}
+        created = await recorder.call("POST /bookings", client.post("/bookings", json=body, headers=auth))
+        if created is None:
+            continue
+        booking_id = created.json()["booking_id"]
+        paid = await recorder.call(
+            "POST /bookings/{id}/checkout",
+            client.post(f"/bookings/{booking_id}/checkout", json={"method": "PIX"}),
+        )
+        if paid is None:
+            continue
+        callback = await recorder.call("POST /callbacks/payment", client.post("/callbacks/payment", params={
+            "payment_id": paid.json()["payment_id"], "booking_id": booking_id,
+            "status": "APPROVED", "paid_amount": created.json()["estimate"]["total"],
+        }))
+        if callback is None:
+            continue
+        view = await recorder.call("GET /bookings/{id}", client.get(f"/bookings/{booking_id}", headers=auth))
+        if view is not None and view.json()["status"] == "CONFIRMED" and recorder.measuring:
+            flows.append(time.perf_counter() - start)
+
+
+async def sample_connections(dsn: str, stop: asyncio.Event, samples: list, interval: float = 0.5):
+    while not stop.is_set():
+        try:
+            samples.append(await asyncio.to_thread(count_connections, dsn))
+        except psycopg2.Error:
+            pass
+        try:
+            await asyncio.wait_for(stop.wait(), interval)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def drive(args, private_pem: str) -> dict:
+    recorder = Recorder()
+    flows: list[float] = []
+    samples: list[int] = []
+    stop = asyncio.Event()
+    slots = itertools.count(1)
+    tokens = [make_token(private_pem, f"auth0|bench-{i}") for i in range(args.concurrency)]
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+
+    async with httpx.AsyncClient(base_url=args.app_url, limits=limits, timeout=30) as client:
+        sampler = asyncio.create_task(sample_connections(args.database_url, stop, samples))
+        users = [asyncio.create_task(user_loop(client, recorder, token, slots, stop, flows)) for token in tokens]
+        await asyncio.sleep(args.warmup)
+        recorder.measuring = True
+        started = time.perf_counter()
+        await asyncio.sleep(args.duration)
+        recorder.measuring = False
+        elapsed = time.perf_counter() - started
+        stop.set()
+        await asyncio.gather(*users, sampler)
+
+        # dá um tempo para o outbox entregar o que ficou pendente
+        confirmed = await asyncio.to_thread(count_confirmed, args.database_url)
+        deadline = time.monotonic() + args.drain
+        async with httpx.AsyncClient() as fake:
+            while True:
+                delivered = (await fake.get(f"http://127.0.0.1:{args.agenda_port}/_stats")).json()
+                if delivered.get("mark_booked", 0) >= confirmed or time.monotonic() > deadline:
+                    break
+                await asyncio.sleep(0.5)
+
+    endpoints = {}
+    total = 0
+    for name, values in recorder.latencies.items():
+        values.sort()
+        total += len(values)
+        endpoints[name] = {
+            "count": len(values),
+            "errors": recorder.errors.get(name, 0),
+            "rps": round(len(values) / elapsed, 1),
+            "p50_ms": round(percentile(values, 50) * 1000, 2),
+            "p95_ms": round(percentile(values, 95) * 1000, 2),
+            "p99_ms": round(percentile(values, 99) * 1000, 2),
+        }
+    flows.sort()
+    return {
+        "config": {k: getattr(args, k) for k in (
+            "duration", "warmup", "concurrency", "workers",
+            "agenda_latency", "payment_latency", "jwks_latency",
+        )},
+        "host": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "throughput": {
+            "requests_per_s": round(total / elapsed, 1),
+            "flows_per_s": round(len(flows) / elapsed, 1),
+            "flow_p95_ms": round(percentile(flows, 95) * 1000, 2),
+        },
+        "endpoints": endpoints,
+        "db_connections": {
+            "max": max(samples, default=0),
+            "mean": round(sum(samples) / len(samples), 1) if samples else 0,
+        },
+        "outbox": {"confirmed": confirmed, "mark_booked_delivered": delivered.get("mark_booked", 0)},
+    }
+
+
+def print_report(result: dict):
+    print(f"\n{'endpoint':32} {'count':>7} {'err':>5} {'req/s':>8} {'p50':>8} {'p95':>8} {'p99':>8}")
+    for name, e in sorted(result["endpoints"].items()):
+        print(f"{name:32} {e['count']:7} {e['errors']:5} {e['rps']:8} {e['p50_ms']:8} {e['p95_ms']:8} {e['p99_ms']:8}")
+    t = result["throughput"]
+    print(f"\ntotal {t['requests_per_s']} req/s, {t['flows_per_s']} flows/s (p95 {t['flow_p95_ms']} ms)")
+    print(f"db connections: max {result['db_connections']['max']}, mean {result['db_connections']['mean']}")
+    print(f"outbox: {result['outbox']['mark_booked_delivered']}/{result['outbox']['confirmed']} mark-booked delivered")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default=os.getenv("BENCH_DATABASE_URL"))
+    parser.add_argument("--app-dir", type=Path, default=ROOT, help="checkout a ser medido (ex.: worktree da base do PR)")
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--warmup", type=float, default=5)
+    parser.add_argument("--drain", type=float, default=10, help="espera máxima pelo outbox no fim (s)")
+    parser.add_argument("--concurrency", type=int, default=32, help="usuários virtuais")
+    parser.add_argument("--workers", type=int, default=1, help="workers do uvicorn")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--agenda-port", type=int, default=18081)
+    parser.add_argument("--payment-port", type=int, default=18082)
+    parser.add_argument("--jwks-port", type=int, default=18083)
+    parser.add_argument("--agenda-latency", type=float, default=20, help="ms")
+    parser.add_argument("--payment-latency", type=float, default=80, help="ms")
+    parser.add_argument("--jwks-latency", type=float, default=50, help="ms")
+    parser.add_argument("--output", type=Path)
+    args = parser.parse_args()
+    if not args.database_url:
+        parser.error("BENCH_DATABASE_URL (or --database-url) is required")
+    args.app_dir = args.app_dir.resolve()
+    args.app_url = f"http://127.0.0.1:{args.port}"
+
+    prepare_database(args.database_url, args.app_dir)
+    private_pem, jwks = make_keys()
+    fakes = start_process(
+        ["-m", "bench.fakes",
+         "--agenda-port", str(args.agenda_port), "--payment-port", str(args.payment_port),
+         "--jwks-port", str(args.jwks_port), "--agenda-latency", str(args.agenda_latency),
+         "--payment-latency", str(args.payment_latency), "--jwks-latency", str(args.jwks_latency)],
+        {"BENCH_JWKS": json.dumps(jwks)},
+        ROOT,
+    )
+    app = start_process(
+        ["-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(args.port),
+         "--workers", str(args.workers), "--log-level", "warning"],
+        {
+            "DATABASE_URL": args.database_url,
+            "DB_SSLMODE": os.getenv("BENCH_DB_SSLMODE", "disable"),
+            "AUTH0_DOMAIN": DOMAIN,
+            "AUTH0_API_AUDIENCE": AUDIENCE,
+            "AUTH0_JWKS_URL": f"http://127.0.0.1:{args.jwks_port}/.well-known/jwks.json",
+            "AGENDA_URL": f"http://127.0.0.1:{args.agenda_port}",
+            "PAYMENT_URL": f"http://127.0.0.1:{args.payment_port}",
+            # cada usuário sintético roda sem pausa: os limites por cliente medem abuso, não vazão
+            "ADMISSION_RATE": "100000",
+            "ADMISSION_BURST": "100000",
+            "ADMISSION_ROUTE_LIMITS": json.dumps({
+                route: {"rate": 100000, "burst": 100000, "concurrency": 64}
+                for route in ("POST /bookings", "POST /bookings/{booking_id}/checkout")
+            }),
+        },
+        args.app_dir,
+    )
+    try:
+        asyncio.run(wait_ready(f"http://127.0.0.1:{args.agenda_port}/_stats"))
+        asyncio.run(wait_ready(f"{args.app_url}/metrics"))
+        result = asyncio.run(drive(args, private_pem))
+    finally:
+        stop_process(app)
+        stop_process(fakes)
+
+    print_report(result)
+    if args.output:
+        args.output.write_text(json.dumps(result, indent=2) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,21 @@
+-- Tabelas base do Sports-Booking (criadas fora de migrations/ em produção).
+-- Usadas só pelo benchmark, antes de aplicar migrations/ em ordem.
+
+CREATE TABLE IF NOT EXISTS bookings (
+    id             BIGSERIAL PRIMARY KEY,
+    court_id       INTEGER        NOT NULL,
+    slot_id        INTEGER        NOT NULL,
+    status         TEXT           NOT NULL,
+    estimate_total NUMERIC(10, 2) NOT NULL,
+    paid_total     NUMERIC(10, 2),
+    invoice_id     BIGINT,
+    invoice_url    TEXT
+);
+
+CREATE TABLE IF NOT EXISTS booking_extras (
+    id         BIGSERIAL PRIMARY KEY,
+    booking_id BIGINT         NOT NULL REFERENCES bookings (id),
+    type       TEXT           NOT NULL,
+    qty        INTEGER        NOT NULL,
+    price      NUMERIC(10, 2) NOT NULL
+);
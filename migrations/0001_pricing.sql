@@ -0,0 +1,62 @@
+-- Tabelas de preço carregadas em memória por app/services/pricing.py.
+-- Qualquer alteração incrementa pricing_version, que os workers consultam
+-- periodicamente para recarregar o snapshot.
+
+CREATE TABLE IF NOT EXISTS pricing_version (
+    id      BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    version BIGINT  NOT NULL DEFAULT 1
+);
+INSERT INTO pricing_version (id, version) VALUES (TRUE, 1) ON CONFLICT DO NOTHING;
+
+-- preço base por quadra (sem linha = preço padrão)
+CREATE TABLE IF NOT EXISTS court_prices (
+    court_id   INTEGER PRIMARY KEY,
+    base_price NUMERIC(10, 2) NOT NULL
+);
+
+-- horário de pico / fora de pico: multiplicador por slot, vale para todas as quadras
+CREATE TABLE IF NOT EXISTS slot_multipliers (
+    slot_id    INTEGER PRIMARY KEY,
+    multiplier NUMERIC(6, 3) NOT NULL
+);
+
+-- preço fechado para uma quadra num slot (ignora os multiplicadores)
+CREATE TABLE IF NOT EXISTS court_slot_prices (
+    court_id INTEGER NOT NULL,
+    slot_id  INTEGER NOT NULL,
+    price    NUMERIC(10, 2) NOT NULL,
+    PRIMARY KEY (court_id, slot_id)
+);
+
+-- temporadas: multiplicador aplicado enquanto a data atual estiver no intervalo
+CREATE TABLE IF NOT EXISTS pricing_seasons (
+    id         SERIAL PRIMARY KEY,
+    starts_on  DATE NOT NULL,
+    ends_on    DATE NOT NULL,
+    multiplier NUMERIC(6, 3) NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS extra_prices (
+    type  TEXT PRIMARY KEY,
+    price NUMERIC(10, 2) NOT NULL
+);
+
+CREATE OR REPLACE FUNCTION bump_pricing_version() RETURNS trigger AS $$
+BEGIN
+    UPDATE pricing_version SET version = version + 1;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DO $$
+DECLARE t TEXT;
+BEGIN
+    FOREACH t IN ARRAY ARRAY['court_prices', 'slot_multipliers', 'court_slot_prices', 'pricing_seasons', 'extra_prices']
+    LOOP
+        EXECUTE format('DROP TRIGGER IF EXISTS %I_bump_version ON %I', t, t);
+        EXECUTE format(
+            'CREATE TRIGGER %I_bump_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON %I '
+            'FOR EACH STATEMENT EXECUTE FUNCTION bump_pricing_version()', t, t);
+    END LOOP;
+END;
+$$;
@@ -0,0 +1,19 @@
+-- Notificações para outros serviços gravadas na mesma transação da mudança
+-- de estado e entregues depois por app/services/outbox.py.
+
+CREATE TABLE IF NOT EXISTS outbox (
+    id            BIGSERIAL PRIMARY KEY,
+    upstream      TEXT        NOT NULL,
+    action        TEXT        NOT NULL,
+    payload       JSONB       NOT NULL,
+    attempts      INTEGER     NOT NULL DEFAULT 0,
+    last_error    TEXT,
+    created_at    TIMESTAMPTZ NOT NULL DEFAULT now(),
+    available_at  TIMESTAMPTZ NOT NULL DEFAULT now(),
+    dispatched_at TIMESTAMPTZ,
+    failed_at     TIMESTAMPTZ
+);
+
+CREATE INDEX IF NOT EXISTS outbox_pending_idx
+    ON outbox (available_at, id)
+    WHERE dispatched_at IS NULL AND failed_at IS NULL;
@@ -0,0 +1,9 @@
+-- Callbacks do Payment já processados; (payment_id, status) repetido é ignorado.
+
+CREATE TABLE IF NOT EXISTS payment_callbacks (
+    payment_id  BIGINT      NOT NULL,
+    status      TEXT        NOT NULL,
+    booking_id  BIGINT      NOT NULL,
+    received_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    PRIMARY KEY (payment_id, status)
+);
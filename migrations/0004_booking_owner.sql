@@ -0,0 +1,8 @@
+-- Dono (claim `sub` do Auth0) e data de criação para listagem e exportação.
+
+ALTER TABLE bookings ADD COLUMN IF NOT EXISTS user_sub TEXT;
+ALTER TABLE bookings ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ NOT NULL DEFAULT now();
+
+CREATE INDEX IF NOT EXISTS bookings_user_sub_id_idx ON bookings (user_sub, id);
+CREATE INDEX IF NOT EXISTS bookings_court_id_id_idx ON bookings (court_id, id);
+CREATE INDEX IF NOT EXISTS bookings_created_at_idx ON bookings (created_at);
@@ -0,0 +1,5 @@
+-- Bookings CREATED ainda não expiradas, na ordem em que o reaper as varre.
+
+CREATE INDEX IF NOT EXISTS bookings_created_pending_idx
+    ON bookings (created_at)
+    WHERE status = 'CREATED';
@@ -0,0 +1,8 @@
+-- No máximo uma booking ativa por (quadra, slot). O gate em memória de
+-- app/services/contention.py recusa a maioria das tentativas antes do banco;
+-- este índice segura a disputa entre workers.
+-- Falha se já houver duplicatas ativas: cancele-as antes de aplicar.
+
+CREATE UNIQUE INDEX IF NOT EXISTS bookings_active_slot_uidx
+    ON bookings (court_id, slot_id)
+    WHERE status IN ('CREATED', 'PENDING_PAYMENT', 'CONFIRMED');
@@ -0,0 +1,22 @@
+-- Checkouts assíncronos: POST /bookings/{id}/checkout?mode=async grava o job
+-- e responde 202; app/services/checkout.py chama o Payment fora da requisição.
+
+CREATE TABLE IF NOT EXISTS checkout_jobs (
+    id             BIGSERIAL PRIMARY KEY,
+    booking_id     BIGINT         NOT NULL REFERENCES bookings (id),
+    amount         NUMERIC(10, 2) NOT NULL,
+    method         TEXT           NOT NULL,
+    coupon         TEXT,
+    status         TEXT           NOT NULL DEFAULT 'QUEUED',
+    attempts       INTEGER        NOT NULL DEFAULT 0,
+    payment_id     TEXT,
+    payment_status TEXT,
+    last_error     TEXT,
+    created_at     TIMESTAMPTZ    NOT NULL DEFAULT now(),
+    available_at   TIMESTAMPTZ    NOT NULL DEFAULT now(),
+    finished_at    TIMESTAMPTZ
+);
+
+CREATE INDEX IF NOT EXISTS checkout_jobs_pending_idx
+    ON checkout_jobs (available_at, id)
+    WHERE status = 'QUEUED';
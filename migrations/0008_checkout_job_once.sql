@@ -0,0 +1,13 @@
+-- No máximo um checkout assíncrono em andamento por booking: o segundo
+-- clique recebe 409 em vez de enfileirar outra cobrança.
+-- Jobs RUNNING com lease vencido viram UNKNOWN (app/services/checkout.py);
+-- o índice parcial abaixo deixa essa varredura barata.
+-- Falha se já houver jobs duplicados em andamento: encerre-os antes de aplicar.
+
+CREATE UNIQUE INDEX IF NOT EXISTS checkout_jobs_active_booking_uidx
+    ON checkout_jobs (booking_id)
+    WHERE status IN ('QUEUED', 'RUNNING');
+
+CREATE INDEX IF NOT EXISTS checkout_jobs_running_idx
+    ON checkout_jobs (available_at)
+    WHERE status = 'RUNNING';
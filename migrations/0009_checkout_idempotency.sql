@@ -0,0 +1,17 @@
+-- Chave de idempotência por booking (não por job) enviada ao Payment nos dois
+-- modos de checkout, e UNKNOWN também bloqueia uma nova cobrança até o
+-- callback do Payment resolver o job (app/repositories/bookings.py).
+-- Jobs antigos foram enviados com "checkout-job-<id>": a chave é mantida.
+-- Falha se uma booking tiver mais de um job QUEUED/RUNNING/UNKNOWN: encerre-os antes de aplicar.
+
+ALTER TABLE checkout_jobs ADD COLUMN IF NOT EXISTS idempotency_key TEXT;
+UPDATE checkout_jobs SET idempotency_key = 'checkout-job-' || id WHERE idempotency_key IS NULL;
+ALTER TABLE checkout_jobs ALTER COLUMN idempotency_key SET NOT NULL;
+
+-- contagem de recusas (chave) e "algum job chegou ao Payment" (reversão) por booking
+CREATE INDEX IF NOT EXISTS checkout_jobs_booking_idx ON checkout_jobs (booking_id, status);
+
+CREATE UNIQUE INDEX IF NOT EXISTS checkout_jobs_open_booking_uidx
+    ON checkout_jobs (booking_id)
+    WHERE status IN ('QUEUED', 'RUNNING', 'UNKNOWN');
+DROP INDEX IF EXISTS checkout_jobs_active_booking_uidx;
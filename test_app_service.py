@@ -1,64 +1,458 @@
-
+import asyncio
+import httpx
 import pytest
-from unittest.mock import patch, MagicMock
-from app.services import agenda_client, payment_client
+from contextlib import asynccontextmanager
+from unittest.mock import MagicMock
+from app.core import auth, db
+from app.services import agenda_client, checkout, contention, occupancy, outbox, payment_client, pricing, reaper, resilience, warmup
+from app.api.routes.quotes import calculate_quote, calculate_quote_matrix
+
+# ---------- ASYNC CLIENTS ----------
+
 
-# ---------- AGENDA CLIENT ----------
+def mock_http(handler):
+    return httpx.AsyncClient(base_url="http://upstream.test", transport=httpx.MockTransport(handler))
 
-@patch("app.services.agenda_client.requests.post")
-def test_create_lock(mock_post):
-    mock_response = MagicMock()
-    mock_response.json.return_value = {"lock_id": "1-2-3", "expires_at": "in+300"}
-    mock_response.raise_for_status.return_value = None
-    mock_post.return_value = mock_response
+def test_async_create_lock():
+    seen = []
 
-    result = agenda_client.create_lock(1, 2, 3)
+    def handler(request):
+        seen.append(request)
+        return httpx.Response(200, json={"lock_id": "1-2-3"})
+
+    client = agenda_client.AgendaClient(mock_http(handler))
+    result = asyncio.run(client.create_lock(1, 2, 3))
     assert result["lock_id"] == "1-2-3"
-    mock_post.assert_called_once()
-
-@patch("app.services.agenda_client.requests.post")
-def test_release_lock(mock_post):
-    mock_response = MagicMock()
-    mock_response.json.return_value = {"released": True}
-    mock_response.raise_for_status.return_value = None
-    mock_post.return_value = mock_response
-
-    result = agenda_client.release_lock("1-2-3")
-    assert result["released"] is True
-    mock_post.assert_called_once()
-
-@patch("app.services.agenda_client.requests.post")
-def test_mark_booked(mock_post):
-    mock_response = MagicMock()
-    mock_response.json.return_value = {"ok": True}
-    mock_response.raise_for_status.return_value = None
-    mock_post.return_value = mock_response
-
-    result = agenda_client.mark_booked(1, 2, 3)
-    assert result["ok"] is True
-    mock_post.assert_called_once()
-
-@patch("app.services.agenda_client.requests.post")
-def test_mark_released(mock_post):
-    mock_response = MagicMock()
-    mock_response.json.return_value = {"ok": True}
-    mock_response.raise_for_status.return_value = None
-    mock_post.return_value = mock_response
-
-    result = agenda_client.mark_released(1, 2, 3)
-    assert result["ok"] is True
-    mock_post.assert_called_once()
-
-# ---------- PAYMENT CLIENT ----------
-
-@patch("app.services.payment_client.requests.post")
-def test_checkout(mock_post):
-    mock_response = MagicMock()
-    mock_response.json.return_value = {"payment_id": "abc123", "status": "PENDING"}
-    mock_response.raise_for_status.return_value = None
-    mock_post.return_value = mock_response
-
-    result = payment_client.checkout(1, 100.0, "pix", coupon="DISCOUNT10")
+    assert seen[0].url.path == "/locks"
+    assert seen[0].url.params["ttl_seconds"] == "300"
+
+def test_async_mark_booked_raises_on_error():
+    client = agenda_client.AgendaClient(mock_http(lambda request: httpx.Response(500)))
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(client.mark_booked(1, 2, 3))
+
+def test_async_release_and_mark_calls():
+    seen = []
+
+    def handler(request):
+        seen.append(request)
+        return httpx.Response(200, json={"ok": True})
+
+    client = agenda_client.AgendaClient(mock_http(handler))
+    assert asyncio.run(client.release_lock("1-2-3")) == {"ok": True}
+    assert asyncio.run(client.mark_booked(1, 2, 3)) == {"ok": True}
+    assert asyncio.run(client.mark_released(1, 2, 3)) == {"ok": True}
+    assert [r.url.path for r in seen] == ["/locks/release", "/mark-booked", "/mark-released"]
+    assert seen[0].url.params["lock_id"] == "1-2-3"
+
+def test_async_checkout():
+    seen = []
+
+    def handler(request):
+        seen.append(request)
+        return httpx.Response(200, json={"payment_id": "abc123", "status": "PENDING"})
+
+    client = payment_client.PaymentClient(mock_http(handler))
+    result = asyncio.run(client.checkout(1, 100.0, "pix", coupon="DISCOUNT10"))
     assert result["payment_id"] == "abc123"
-    assert result["status"] == "PENDING"
-    mock_post.assert_called_once()
+    assert b'"coupon":"DISCOUNT10"' in seen[0].content
+
+# ---------- PRICING ----------
+
+
+SNAPSHOT = pricing.PricingSnapshot(
+    version=7,
+    court_base={1: 80.0},
+    slot_multiplier={20: 1.5},
+    overrides={(2, 20): 99.0},
+    season_multiplier=1.1,
+    extras={"ball": 6.0},
+)
+
+def test_snapshot_base_price_precedence():
+    assert SNAPSHOT.base_price(2, 20) == 99.0
+    assert SNAPSHOT.base_price(1, 20) == 132.0
+    assert SNAPSHOT.base_price(3, 8) == 55.0
+
+def test_calculate_quote_uses_snapshot():
+    quote = calculate_quote(1, 8, ["ball", "unknown"], snapshot=SNAPSHOT)
+    assert quote["subtotal"] == 88.0
+    assert quote["extras"] == [{"type": "ball", "price": 6.0}, {"type": "unknown", "price": 0.0}]
+    assert quote["total"] == 94.0
+
+def test_pricing_cache_reloads_on_version_change():
+    versions = [7]
+    loads = []
+
+    async def loader():
+        loads.append(versions[0])
+        return pricing.PricingSnapshot(version=versions[0])
+
+    async def version():
+        return versions[0]
+
+    async def scenario():
+        cache = pricing.PricingCache(loader=loader, version=version)
+        await cache.reload()
+        await cache.refresh_if_stale()
+        versions[0] = 8
+        await cache.refresh_if_stale()
+        cache.invalidate()
+        await cache.refresh_if_stale()
+        return cache
+
+    cache = asyncio.run(scenario())
+    assert loads == [7, 8, 8]
+    assert cache.snapshot.version == 8
+
+def test_quote_matrix_matches_calculate_quote():
+    matrix = calculate_quote_matrix([1, 2, 3], 18, 22, ["ball"], snapshot=SNAPSHOT)
+    for i, court_id in enumerate([1, 2, 3]):
+        for j, slot_id in enumerate(range(18, 23)):
+            assert matrix["total"][i][j] == calculate_quote(court_id, slot_id, ["ball"], snapshot=SNAPSHOT)["total"]
+
+# ---------- OUTBOX ----------
+
+
+def fake_db(monkeypatch, claimed):
+    recorded = []
+
+    async def run(self, fn, *args):
+        if fn is outbox._claim:
+            return claimed
+        recorded.append(args)
+
+    @asynccontextmanager
+    async def connection():
+        yield db.AsyncConnection(MagicMock())
+
+    monkeypatch.setattr(db.AsyncConnection, "run", run)
+    monkeypatch.setattr(db, "connection", connection)
+    return recorded
+
+def test_outbox_dispatch_marks_done_and_backs_off(monkeypatch):
+    delivered = []
+
+    async def mark_booked(payload):
+        delivered.append(payload)
+
+    async def release_lock(payload):
+        raise RuntimeError("agenda down")
+
+    recorded = fake_db(monkeypatch, [
+        (1, "agenda", "mark_booked", {"booking_id": 1}, 1),
+        (2, "agenda", "release_lock", {"lock_id": "x"}, 3),
+        (3, "agenda", "release_lock", {"lock_id": "y"}, 5),
+    ])
+    dispatcher = outbox.OutboxDispatcher(max_attempts=5, base_backoff=2, handlers={
+        ("agenda", "mark_booked"): mark_booked,
+        ("agenda", "release_lock"): release_lock,
+    })
+
+    assert asyncio.run(dispatcher.run_once()) == 3
+    assert delivered == [{"booking_id": 1}]
+    done, retry = recorded[0]
+    assert done == [1]
+    (retry_id, delay, error, dead), (dead_id, _, _, gave_up) = retry
+    assert retry_id == 2 and 4 <= delay <= 8 and "agenda down" in error and not dead
+    assert dead_id == 3 and gave_up
+    assert dispatcher.dead == 1
+
+# ---------- REAPER ----------
+
+def test_reaper_cancels_expired_batch_and_queues_releases(monkeypatch):
+    raw = MagicMock()
+    cur = raw.cursor.return_value
+    cur.fetchall.return_value = [(5, 1, 10), (6, 1, 11)]
+
+    @asynccontextmanager
+    async def connection():
+        yield db.AsyncConnection(raw)
+
+    monkeypatch.setattr(db, "connection", connection)
+    before = reaper.REAPED.value()
+    job = reaper.BookingReaper(batch_size=2, ttl=330)
+
+    assert asyncio.run(job.run_once()) == 2
+    sql, params = cur.execute.call_args_list[0].args
+    assert "FOR UPDATE SKIP LOCKED" in sql and "'mark_released'" in sql
+    assert params == (330, 2)
+    notify_sql, (channel, payloads) = cur.execute.call_args_list[1].args
+    assert "pg_notify" in notify_sql and channel == "booking_events" and len(payloads) == 2
+    raw.commit.assert_called_once()
+    assert job.reaped == 2 and reaper.REAPED.value() == before + 2
+
+# ---------- CONTENTION ----------
+
+def test_slot_gate_lets_one_attempt_through():
+    gate = contention.SlotGate(held_ttl=60)
+    with gate.claim(1, 10):
+        with pytest.raises(contention.SlotHeld):
+            with gate.claim(1, 10):
+                pass
+    assert gate.is_held((1, 10))
+
+    gate.on_event({"booking_id": 5, "status": "CANCELLED", "court_id": 1, "slot_id": 10})
+    assert not gate.is_held((1, 10))
+
+def test_slot_gate_frees_slot_when_attempt_fails():
+    gate = contention.SlotGate()
+    with pytest.raises(RuntimeError):
+        with gate.claim(1, 10):
+            raise RuntimeError("agenda down")
+    assert not gate.is_held((1, 10))
+
+    with pytest.raises(RuntimeError):
+        with gate.claim(1, 10) as slot:
+            gate.hold(slot, 5)
+            raise RuntimeError("409 Conflict")
+    assert gate.is_held((1, 10))
+
+# ---------- OCCUPANCY ----------
+
+def test_occupancy_index_tracks_transitions():
+    index = occupancy.OccupancyIndex()
+    index.replace([(1, 7, 10), (2, 7, 12)])
+    assert index.free_slots([7, 8], 9, 13) == {7: [9, 11, 13], 8: [9, 10, 11, 12, 13]}
+
+    index.on_event({"booking_id": 3, "status": "CREATED", "court_id": 8, "slot_id": 9})
+    index.on_event({"booking_id": 1, "status": "CANCELLED", "court_id": 7, "slot_id": 10})
+    # CANCELLED atrasado de uma booking que não é mais dona do slot
+    index.on_event({"booking_id": 4, "status": "CONFIRMED", "court_id": 7, "slot_id": 11})
+    index.on_event({"booking_id": 99, "status": "CANCELLED", "court_id": 7, "slot_id": 11})
+    assert index.free_slots([7, 8], 9, 13) == {7: [9, 10, 13], 8: [10, 11, 12, 13]}
+
+def test_occupancy_index_ignores_slots_above_bound():
+    index = occupancy.OccupancyIndex(max_slot_id=15)
+    index.on_event({"booking_id": 1, "status": "CREATED", "court_id": 7, "slot_id": 10**9})
+    index.on_event({"booking_id": 2, "status": "CREATED", "court_id": 7, "slot_id": -1})
+    assert len(index) == 0
+    assert index._bits == {}
+    with pytest.raises(ValueError):
+        index.free_slots([7], 0, 16)
+
+def test_occupancy_load_replays_events_seen_during_the_query(monkeypatch):
+    index = occupancy.OccupancyIndex()
+    raw = MagicMock()
+
+    def fetchall():
+        # evento chega enquanto o SELECT está em andamento
+        index.on_event({"booking_id": 2, "status": "CANCELLED", "court_id": 1, "slot_id": 5})
+        return [(2, 1, 5), (3, 1, 6)]
+
+    raw.cursor.return_value.fetchall.side_effect = fetchall
+
+    @asynccontextmanager
+    async def connection():
+        yield db.AsyncConnection(raw)
+
+    monkeypatch.setattr(db, "connection", connection)
+    asyncio.run(index.load())
+    assert index.loaded and index.free_slots([1], 5, 6) == {1: [5]}
+
+def test_occupancy_reload_skips_scan_already_newer_than_listen(monkeypatch):
+    index = occupancy.OccupancyIndex()
+    raw = MagicMock()
+    raw.cursor.return_value.fetchall.return_value = [(2, 1, 5)]
+
+    @asynccontextmanager
+    async def connection():
+        yield db.AsyncConnection(raw)
+
+    monkeypatch.setattr(db, "connection", connection)
+
+    async def startup():
+        # LISTEN estabelecido antes da carga do startup: a recarga não repete a varredura
+        index.reload_later()
+        await index.load()
+        await asyncio.sleep(0.01)
+        scans = raw.cursor.return_value.execute.call_count
+        # reconexão depois da carga: eventos podem ter se perdido, recarrega
+        index.reload_later()
+        await asyncio.sleep(0.01)
+        return scans, raw.cursor.return_value.execute.call_count
+
+    assert asyncio.run(startup()) == (1, 2)
+    assert "created_at >=" in raw.cursor.return_value.execute.call_args.args[0]
+
+# ---------- ASYNC CHECKOUT ----------
+
+def test_checkout_worker_records_payment_outcomes(monkeypatch):
+    recorded = []
+
+    async def run(self, fn, *args):
+        if fn is checkout._claim:
+            return [
+                (1, 10, 50, "PIX", None, 1, "booking-10-0"),
+                (2, 11, 50, "CARD", None, 1, "booking-11-0"),
+                (3, 12, 50, "CARD", None, 1, "booking-12-0"),
+                (4, 13, 50, "CARD", None, 1, "booking-13-0"),
+            ]
+        recorded.extend(args[0])
+        return []
+
+    @asynccontextmanager
+    async def connection():
+        yield db.AsyncConnection(MagicMock())
+
+    keys = []
+
+    async def pay(booking_id, amount, method, coupon=None, idempotency_key=None):
+        keys.append(idempotency_key)
+        if booking_id == 13:
+            raise httpx.ReadTimeout("no answer")
+        if booking_id == 11:
+            raise httpx.ConnectError("payment down")
+        if booking_id == 12:
+            raise httpx.HTTPStatusError("400", request=httpx.Request("POST", "/checkout"), response=httpx.Response(400))
+        return {"payment_id": 99, "status": "PENDING"}
+
+    client = MagicMock()
+    client.checkout.side_effect = pay
+    monkeypatch.setattr(db.AsyncConnection, "run", run)
+    monkeypatch.setattr(db, "connection", connection)
+    monkeypatch.setattr(payment_client, "get_client", lambda: client)
+
+    assert asyncio.run(checkout.CheckoutWorker(concurrency=4).run_once()) == 4
+    by_job = {r[0]: r for r in recorded}
+    assert by_job[1][1:4] == ("DONE", "99", "PENDING")
+    assert by_job[2][1] == "QUEUED" and by_job[2][5] > 0
+    assert by_job[3][1] == "FAILED"
+    # timeout pode ter cobrado: não volta para a fila
+    assert by_job[4][1] == "UNKNOWN"
+    assert sorted(keys) == [f"booking-{b}-0" for b in range(10, 14)]
+
+# ---------- RESILIENCE ----------
+
+def test_circuit_breaker_opens_and_probes(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(resilience.time, "monotonic", lambda: now[0])
+    breaker = resilience.CircuitBreaker("test", failure_threshold=2, reset_timeout=10)
+    breaker.record_failure()
+    breaker.allow()
+    breaker.record_failure()
+    with pytest.raises(resilience.CircuitOpen):
+        breaker.allow()
+
+    now[0] += 11
+    breaker.allow()  # chamada de teste
+    with pytest.raises(resilience.CircuitOpen):
+        breaker.allow()
+    breaker.record_success()
+    assert breaker.state == resilience.CLOSED
+
+def test_idempotent_agenda_call_retries_within_budget():
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(503 if len(calls) == 1 else 200, json={"ok": True})
+
+    upstream = resilience.Upstream("agenda-test", base_backoff=0.001)
+    client = agenda_client.AgendaClient(mock_http(handler), upstream)
+    assert asyncio.run(client.mark_booked(1, 2, 3)) == {"ok": True}
+    assert len(calls) == 2
+
+    # sem fichas no budget a falha volta direto, sem retry
+    upstream.budget.tokens = 0
+    failing = agenda_client.AgendaClient(mock_http(lambda request: calls.append(request) or httpx.Response(503)), upstream)
+    calls.clear()
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(failing.release_lock("1-2-3"))
+    assert len(calls) == 1
+
+def test_checkout_is_not_retried_and_open_circuit_short_circuits():
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(502)
+
+    upstream = resilience.Upstream("payment-test", breaker=resilience.CircuitBreaker("payment-test", failure_threshold=1))
+    client = payment_client.PaymentClient(mock_http(handler), upstream)
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(client.checkout(1, 10.0, "PIX"))
+    with pytest.raises(resilience.CircuitOpen):
+        asyncio.run(client.checkout(1, 10.0, "PIX"))
+    assert len(calls) == 1
+
+def test_cancelled_probe_frees_half_open_circuit(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(resilience.time, "monotonic", lambda: now[0])
+    upstream = resilience.Upstream("probe-test", breaker=resilience.CircuitBreaker("probe-test", failure_threshold=1))
+    upstream.breaker.record_failure()
+    now[0] += 31
+
+    async def hang(read_timeout):
+        await asyncio.sleep(10)
+
+    async def cancelled_probe():
+        task = asyncio.ensure_future(upstream.call(hang))
+        await asyncio.sleep(0)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(cancelled_probe())
+    upstream.breaker.allow()  # a próxima chamada ainda pode testar o upstream
+    assert upstream.breaker.state == resilience.HALF_OPEN
+
+def test_checkout_uses_configured_read_timeout():
+    seen = []
+
+    def handler(request):
+        seen.append(request.extensions["timeout"]["read"])
+        return httpx.Response(200, json={"payment_id": 1, "status": "PENDING"})
+
+    timeout = resilience.AdaptiveTimeout(ceiling=15, min_samples=1)
+    for _ in range(16):
+        timeout.observe(0.01)
+    upstream = resilience.Upstream("payment-timeout", timeout=timeout)
+    client = payment_client.PaymentClient(mock_http(handler), upstream)
+    asyncio.run(client.checkout(1, 10.0, "PIX", idempotency_key="checkout-job-1"))
+    # p99 de 10ms daria 0.5s; a cobrança espera o timeout configurado
+    assert timeout.current == 0.5 and seen == [15]
+
+def test_hedged_lock_uses_the_faster_copy():
+    calls = []
+
+    async def handler(request):
+        calls.append(request)
+        if len(calls) == 1:
+            await asyncio.sleep(1)
+        return httpx.Response(200, json={"lock_id": f"copy-{len(calls)}"})
+
+    timeout = resilience.AdaptiveTimeout(min_samples=1)
+    for _ in range(16):
+        timeout.observe(0.01)
+    upstream = resilience.Upstream("agenda-hedge", timeout=timeout)
+    client = agenda_client.AgendaClient(mock_http(handler), upstream)
+
+    async def lock():
+        return await client._post("/locks", {"court_id": 1, "slot_id": 2, "booking_id": 3}, hedge=True)
+
+    assert asyncio.run(lock()) == {"lock_id": "copy-2"}
+    assert len(calls) == 2
+
+
+def test_warmup_runs_every_step_and_tolerates_failures(monkeypatch):
+    calls = []
+
+    class Warmable:
+        def __init__(self, name):
+            self.name = name
+
+        async def warm(self, arg):
+            calls.append((self.name, arg))
+
+    class DownJWKS:
+        async def refresh(self):
+            raise httpx.ConnectError("auth0 down")
+
+    monkeypatch.setattr(db, "get_pool", lambda: Warmable("db"))
+    monkeypatch.setattr(agenda_client, "get_client", lambda: Warmable("agenda"))
+    monkeypatch.setattr(payment_client, "get_client", lambda: Warmable("payment"))
+    monkeypatch.setattr(auth, "get_jwks_cache", lambda: DownJWKS())
+
+    assert asyncio.run(warmup.run()) == ["jwks"]
+    assert sorted(name for name, _ in calls) == ["agenda", "db", "payment"]
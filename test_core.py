@@ -0,0 +1,626 @@
+import asyncio
+import io
+import json
+import logging
+import threading
+import time
+import httpx
+import psycopg2
+import pytest
+import rsa
+from jose import jwk, jwt
+from unittest.mock import MagicMock
+
+from fastapi import FastAPI, Request, Response
+from fastapi.testclient import TestClient
+
+from app.core import admission, auth, cache, consistency, db, events, logs, metrics, profiler
+
+
+def make_pool(**kwargs):
+    created = []
+
+    def connect():
+        conn = MagicMock()
+        conn.closed = 0
+        conn.get_transaction_status.return_value = 0
+        created.append(conn)
+        return conn
+
+    return db.ConnectionPool(connect, **kwargs), created
+
+# ---------- DB POOL ----------
+
+def test_pool_reuses_connections():
+    async def scenario():
+        pool, created = make_pool(min_size=1, max_size=2)
+        await pool.open()
+        for _ in range(5):
+            conn = await pool.acquire()
+            await pool.release(conn)
+        return pool, created
+
+    pool, created = asyncio.run(scenario())
+    assert len(created) == 1
+    assert pool.size == 1 and pool.idle == 1
+
+def test_pool_acquire_timeout():
+    async def scenario():
+        pool, _ = make_pool(min_size=0, max_size=1, timeout=0.05)
+        await pool.acquire()
+        with pytest.raises(db.PoolTimeout):
+            await pool.acquire()
+
+    asyncio.run(scenario())
+
+def test_pool_discards_unhealthy_idle_connection():
+    async def scenario():
+        pool, created = make_pool(min_size=1, max_size=1, check_after=0)
+        await pool.open()
+        created[0].cursor.return_value.execute.side_effect = Exception("server closed the connection")
+        conn = await pool.acquire()
+        return conn, created
+
+    conn, created = asyncio.run(scenario())
+    assert len(created) == 2
+    assert conn is created[1]
+    created[0].close.assert_called_once()
+
+def test_pool_rolls_back_open_transaction_on_release():
+    async def scenario():
+        pool, created = make_pool(min_size=0, max_size=1)
+        conn = await pool.acquire()
+        conn.get_transaction_status.return_value = 2
+        await pool.release(conn)
+        return conn
+
+    conn = asyncio.run(scenario())
+    conn.rollback.assert_called_once()
+
+def test_readonly_connection_falls_back_to_primary_when_replica_is_down(monkeypatch):
+    async def scenario():
+        primary, _ = make_pool(min_size=0, max_size=1)
+        replica = db.ConnectionPool(MagicMock(side_effect=psycopg2.OperationalError("no route to host")), min_size=0)
+        monkeypatch.setattr(db, "_pool", primary)
+        monkeypatch.setattr(db, "_replica", replica)
+        monkeypatch.setattr(db, "_replica_down_until", 0.0)
+        async with db.connection(readonly=True) as conn:
+            first = conn.raw
+        assert not db.replica_available()
+        async with db.connection(readonly=True) as conn:
+            second = conn.raw
+        return first, second, replica
+
+    first, second, replica = asyncio.run(scenario())
+    assert first is second
+    # réplica fora: a segunda leitura nem tenta conectar nela
+    assert replica._connect.call_count == 1
+
+def test_readonly_connection_uses_replica(monkeypatch):
+    async def scenario():
+        primary, primary_conns = make_pool(min_size=0, max_size=1)
+        replica, replica_conns = make_pool(min_size=0, max_size=1)
+        monkeypatch.setattr(db, "_pool", primary)
+        monkeypatch.setattr(db, "_replica", replica)
+        monkeypatch.setattr(db, "_replica_down_until", 0.0)
+        async with db.connection(readonly=True):
+            pass
+        async with db.connection():
+            pass
+        return primary_conns, replica_conns
+
+    primary_conns, replica_conns = asyncio.run(scenario())
+    assert len(primary_conns) == 1 and len(replica_conns) == 1
+
+def test_read_your_writes_window():
+    tracker = consistency.ReadYourWrites(window=60)
+    response = Response()
+    tracker.wrote(7, response)
+    assert tracker.use_primary(7) and not tracker.use_primary(8)
+    assert consistency.COOKIE in response.headers["set-cookie"]
+
+    cookie = response.headers["set-cookie"].split(";")[0].split("=", 1)[1]
+    request = Request({"type": "http", "headers": [(b"cookie", f"{consistency.COOKIE}={cookie}".encode())]})
+    assert tracker.use_primary(8, request)
+    assert not tracker.use_primary(8, Request({"type": "http", "headers": []}))
+
+# ---------- AUTH ----------
+
+_pub, _priv = rsa.newkeys(1024)
+PRIVATE_PEM = _priv.save_pkcs1().decode()
+PUBLIC_JWK = dict(jwk.construct(_pub.save_pkcs1().decode(), "RS256").to_dict(), kid="k1", use="sig")
+
+
+def make_jwks_cache(calls, **kwargs):
+    def handler(request):
+        calls.append(request.url)
+        return httpx.Response(200, json={"keys": [PUBLIC_JWK]}, headers={"Cache-Control": "max-age=600"})
+
+    return auth.JWKSCache("https://tenant.test/.well-known/jwks.json",
+                          transport=httpx.MockTransport(handler), **kwargs)
+
+
+def make_token(kid="k1", **claims):
+    claims = {"sub": "auth0|1", "aud": "api", "iss": "https://tenant.test/", "exp": int(time.time()) + 60, **claims}
+    return jwt.encode(claims, PRIVATE_PEM, algorithm="RS256", headers={"kid": kid})
+
+
+@pytest.fixture
+def auth_env(monkeypatch):
+    calls = []
+    cache = make_jwks_cache(calls)
+    monkeypatch.setattr(auth, "get_settings", lambda: {"domain": "tenant.test", "audience": "api", "algorithms": ["RS256"]})
+    monkeypatch.setattr(auth, "get_jwks_cache", lambda: cache)
+    monkeypatch.setattr(auth, "verified_tokens", auth.VerifiedTokenCache(10))
+    return calls
+
+def test_verify_token_fetches_jwks_once(auth_env):
+    async def scenario():
+        first = await auth.verify_token(make_token())
+        second = await auth.verify_token(make_token(sub="auth0|2"))
+        again = await auth.verify_token(make_token(sub="auth0|2"))
+        return first, second, again
+
+    first, second, again = asyncio.run(scenario())
+    assert first["sub"] == "auth0|1"
+    assert second["sub"] == again["sub"] == "auth0|2"
+    assert len(auth_env) == 1
+
+def test_unknown_kid_refresh_is_rate_limited(auth_env):
+    async def scenario():
+        await auth.verify_token(make_token())
+        for _ in range(5):
+            with pytest.raises(auth.HTTPException) as exc:
+                await auth.verify_token(make_token(kid="forged"))
+            assert exc.value.status_code == 401
+
+    asyncio.run(scenario())
+    assert len(auth_env) == 1
+
+def test_jwks_ttl_follows_cache_control():
+    calls = []
+    cache = make_jwks_cache(calls, ttl=3600)
+    asyncio.run(cache.get_key("k1"))
+    assert 590 < cache._expires_at - time.monotonic() <= 600
+
+def test_verified_token_cache_drops_expired_claims():
+    cache = auth.VerifiedTokenCache(maxsize=2)
+    cache.put("a", {"exp": time.time() - 1})
+    cache.put("b", {"exp": time.time() + 60})
+    cache.put("c", {"exp": time.time() + 60})
+    cache.put("d", {"exp": time.time() + 60})
+    assert cache.get("a") is None
+    assert cache.get("b") is None
+    assert cache.get("d")["exp"] > time.time()
+
+# ---------- CACHE ----------
+
+
+class FakeRedis:
+    """Stand-in local para o redis.asyncio usado pelo SharedBackend."""
+
+    def __init__(self):
+        self.data = {}
+
+    async def get(self, key):
+        return self.data.get(key)
+
+    async def set(self, key, value, ex=None):
+        self.data[key] = value
+
+    async def delete(self, key):
+        self.data.pop(key, None)
+
+def test_ttl_cache_expires_and_evicts():
+    c = cache.TTLCache(maxsize=2, ttl=60)
+    c.set("a", 1)
+    c.set("b", 2)
+    c.get("a")
+    c.set("c", 3)
+    assert c.get("b") is None and c.get("a") == 1
+    c.set("d", 4, ttl=-1)
+    assert c.get("d") is None
+
+def test_read_through_cache_uses_shared_backend():
+    redis = FakeRedis()
+    worker_a = cache.ReadThroughCache(cache.TTLCache(), cache.SharedBackend(redis, "booking"))
+    worker_b = cache.ReadThroughCache(cache.TTLCache(), cache.SharedBackend(redis, "booking"))
+    loads = []
+
+    async def loader():
+        loads.append(1)
+        return {"status": "CREATED"}
+
+    async def scenario():
+        await worker_a.get_or_load(1, loader)
+        from_b = await worker_b.get_or_load(1, loader)
+        await worker_a.invalidate(1)
+        return from_b, await worker_b.shared.get(1)
+
+    from_b, after_invalidate = asyncio.run(scenario())
+    assert from_b == {"status": "CREATED"}
+    assert loads == [1]
+    assert after_invalidate is None
+
+def test_read_through_cache_skips_fill_invalidated_during_load():
+    c = cache.ReadThroughCache(cache.TTLCache())
+
+    async def scenario():
+        async def loader():
+            await c.invalidate(1)
+            return {"status": "CREATED"}
+
+        await c.get_or_load(1, loader)
+        return await c.get(1)
+
+    assert asyncio.run(scenario()) is None
+
+def test_event_invalidation_skips_fill_of_load_in_progress():
+    c = cache.ReadThroughCache(cache.TTLCache())
+
+    async def scenario():
+        async def loader():
+            # evento de outro worker chega enquanto o load lê a réplica
+            c.invalidate_local(1)
+            return {"status": "CREATED"}
+
+        await c.get_or_load(1, loader)
+        return await c.get(1)
+
+    assert asyncio.run(scenario()) is None
+
+# ---------- EVENTS ----------
+
+def test_hub_wakes_all_waiters_without_missing_events():
+    hub = events.BookingHub()
+
+    async def scenario():
+        async with hub.subscribe(1) as a, hub.subscribe(1) as b:
+            waiters = [asyncio.create_task(s.wait(1)) for s in (a, b)]
+            await asyncio.sleep(0)
+            hub.publish({"booking_id": 1, "status": "PENDING_PAYMENT"})
+            first = await asyncio.gather(*waiters)
+            # publicado antes do próximo wait: não pode se perder
+            hub.publish({"booking_id": 1, "status": "CONFIRMED"})
+            second = await a.wait(1)
+            timed_out = await a.wait(0.01)
+        return first, second, timed_out
+
+    first, second, timed_out = asyncio.run(scenario())
+    assert [e["status"] for e in first] == ["PENDING_PAYMENT", "PENDING_PAYMENT"]
+    assert second["status"] == "CONFIRMED"
+    assert timed_out is None
+    assert hub.waiting == 0
+
+def test_pg_listener_publishes_events_from_other_workers():
+    received = []
+    listener = events.PgListener(MagicMock(), events.CHANNEL, received.append)
+    conn = MagicMock()
+    conn.notifies = [
+        MagicMock(payload='{"booking_id": 1, "status": "CONFIRMED", "origin": "other:1"}'),
+        MagicMock(payload='{"booking_id": 2, "status": "CANCELLED", "origin": "%s"}' % events.origin()),
+    ]
+    listener._conn = conn
+    listener._on_readable()
+    assert received == [{"booking_id": 1, "status": "CONFIRMED"}]
+
+# ---------- METRICS ----------
+
+def test_histogram_renders_cumulative_buckets():
+    hist = metrics.Histogram("test_latency_seconds", "test", ("route",), buckets=(0.1, 1.0))
+    try:
+        hist.observe(0.05, "/a")
+        hist.observe(0.5, "/a")
+        hist.observe(5, "/a")
+        lines = hist.render()
+    finally:
+        metrics.REGISTRY.remove(hist)
+    assert 'test_latency_seconds_bucket{route="/a",le="0.1"} 1' in lines
+    assert 'test_latency_seconds_bucket{route="/a",le="1.0"} 2' in lines
+    assert 'test_latency_seconds_bucket{route="/a",le="+Inf"} 3' in lines
+    assert 'test_latency_seconds_count{route="/a"} 3' in lines
+
+def test_metrics_middleware_labels_by_route_and_adds_server_timing():
+    app = FastAPI()
+    app.add_middleware(metrics.MetricsMiddleware)
+
+    @app.get("/items/{item_id}")
+    async def item(item_id: int):
+        with metrics.timed("db", "execute"):
+            pass
+        return {"id": item_id}
+
+    before = metrics.HTTP_REQUESTS.value("GET", "/items/{item_id}", "200")
+    response = TestClient(app).get("/items/7")
+    assert response.status_code == 200
+    timing = response.headers["server-timing"]
+    assert timing.startswith("db;dur=") and "app;dur=" in timing
+    assert metrics.HTTP_REQUESTS.value("GET", "/items/{item_id}", "200") == before + 1
+    assert metrics.HTTP_LATENCY.count("GET", "/items/{item_id}") >= 1
+
+
+# ---------- ADMISSION ----------
+
+def admission_app(policy):
+    app = FastAPI()
+    app.add_middleware(admission.AdmissionMiddleware, policy=policy)
+    release = asyncio.Event()
+
+    @app.get("/items/{item_id}")
+    async def item(item_id: int):
+        return {"id": item_id}
+
+    @app.get("/slow")
+    async def slow():
+        await release.wait()
+        return {}
+
+    @app.get("/health")
+    async def health():
+        return {}
+
+    return app, release
+
+def test_admission_rate_limits_per_client_and_route():
+    policy = admission.AdmissionPolicy(
+        admission.MemoryBuckets(), rate=100, burst=100,
+        routes={"GET /items/{item_id}": {"rate": 0.5, "burst": 2}}, exempt=("/health",),
+    )
+    app, _ = admission_app(policy)
+    client = TestClient(app)
+    assert [client.get(f"/items/{i}").status_code for i in range(3)] == [200, 200, 429]
+    rejected = client.get("/items/9")
+    assert rejected.status_code == 429 and int(rejected.headers["retry-after"]) >= 1
+    assert client.get("/health").status_code == 200
+
+    # token já verificado ganha bucket próprio, separado do IP
+    auth.verified_tokens.put("sig-admission", {"sub": "user-a", "exp": time.time() + 60})
+    headers = {"Authorization": "Bearer x.y.sig-admission"}
+    assert client.get("/items/1", headers=headers).status_code == 200
+    assert admission.client_key({"headers": [(b"authorization", b"Bearer x.y.sig-admission")]}) == "sub:user-a"
+    assert admission.client_key({"headers": [(b"authorization", b"Bearer x.y.unknown")], "client": ("10.0.0.1", 1)}) == "ip:10.0.0.1"
+
+def test_admission_sheds_over_concurrency_limits():
+    policy = admission.AdmissionPolicy(
+        admission.MemoryBuckets(), max_in_flight=2, routes={"GET /slow": {"concurrency": 1}},
+    )
+    app, release = admission_app(policy)
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as c:
+            first = asyncio.create_task(c.get("/slow"))
+            while not policy.in_flight:
+                await asyncio.sleep(0)
+            route_busy = await c.get("/slow")
+            policy.max_in_flight = 1
+            server_busy = await c.get("/items/1")
+            release.set()
+            return (await first).status_code, route_busy, server_busy
+
+    first, route_busy, server_busy = asyncio.run(scenario())
+    assert first == 200
+    assert route_busy.status_code == 503 and route_busy.headers["retry-after"] == "1"
+    assert server_busy.status_code == 503
+    assert policy.in_flight == 0 and policy.route_in_flight == {}
+
+def test_admission_counts_streams_apart_from_in_flight():
+    policy = admission.AdmissionPolicy(
+        admission.MemoryBuckets(), max_in_flight=1, max_streams=1,
+        routes={"GET /slow": {"stream": "wait"}},
+    )
+    app, release = admission_app(policy)
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as c:
+            waiter = asyncio.create_task(c.get("/slow", params={"wait": 30}))
+            while not policy.streams:
+                await asyncio.sleep(0)
+            # o long-poll parado não tira a vaga das requisições curtas
+            short = await c.get("/items/1")
+            second_waiter = await c.get("/slow", params={"wait": 30})
+            release.set()
+            return (await waiter).status_code, short.status_code, second_waiter.status_code
+
+    assert asyncio.run(scenario()) == (200, 200, 503)
+    assert policy.streams == 0 and policy.in_flight == 0
+    assert admission._long_lived({"query_string": b"wait=0"}, "wait") is False
+    assert admission._long_lived({"query_string": b""}, True) is True
+
+def test_shared_buckets_fall_back_to_memory():
+    class Down:
+        async def eval(self, *args):
+            raise ConnectionError("down")
+
+    buckets = admission.SharedBuckets(Down())
+
+    async def scenario():
+        return [await buckets.take("ip:1", 1, 1) for _ in range(2)]
+
+    first, second = asyncio.run(scenario())
+    assert first == 0 and second > 0
+
+
+# ---------- LOGS ----------
+
+def test_log_pipeline_writes_json_from_background_thread():
+    stream = io.StringIO()
+    pipeline = logs.Pipeline(stream=stream)
+    logger = logging.getLogger("test.logs.pipeline")
+    logger.setLevel(logging.INFO)
+    pipeline.start(("test.logs.pipeline",))
+    token = logs.request_id.set("req-1")
+    try:
+        try:
+            raise ValueError("boom")
+        except ValueError as e:
+            logger.error("failed %s", "here", exc_info=e, extra={"fields": {"route": "/x"}})
+    finally:
+        logs.request_id.reset(token)
+        pipeline.stop()
+    entry = json.loads(stream.getvalue())
+    assert entry["msg"] == "failed here" and entry["request_id"] == "req-1" and entry["route"] == "/x"
+    assert "ValueError: boom" in entry["exc"]
+    assert logger.handlers == []
+
+def test_log_queue_drops_when_full():
+    pipeline = logs.Pipeline(maxsize=1)
+    record = logging.LogRecord("test", logging.WARNING, __file__, 1, "msg", None, None)
+    before = logs.DROPPED.value("WARNING")
+    pipeline.handler.handle(record)
+    pipeline.handler.handle(record)
+    assert logs.DROPPED.value("WARNING") == before + 1
+
+def test_traceback_sampler_dedups_within_window():
+    sampler = logs.TracebackSampler(window=60)
+
+    def fail(kind):
+        try:
+            raise kind("x")
+        except Exception as e:
+            return e
+
+    assert sampler.check(fail(ValueError)) == 0
+    assert sampler.check(fail(ValueError)) is None
+    assert sampler.check(fail(KeyError)) == 0
+    sampler._seen[sampler.fingerprint(fail(ValueError))][0] = 0
+    assert sampler.check(fail(ValueError)) == 1
+
+def test_request_id_middleware_propagates_header():
+    app = FastAPI()
+    app.add_middleware(logs.RequestIdMiddleware)
+
+    @app.get("/rid")
+    async def rid():
+        return {"rid": logs.request_id.get()}
+
+    client = TestClient(app)
+    given = client.get("/rid", headers={"X-Request-ID": "abc-123"})
+    assert given.json()["rid"] == "abc-123" and given.headers["x-request-id"] == "abc-123"
+    generated = client.get("/rid", headers={"X-Request-ID": "bad id"})
+    assert generated.json()["rid"] == generated.headers["x-request-id"] != "bad id"
+    assert logs.truncate(b"a" * 10, limit=4) == "aaaa...<6 more bytes>"
+
+
+# ---------- PROFILER ----------
+
+def test_profiler_samples_selected_requests_as_collapsed_stacks():
+    app = FastAPI()
+    app.add_middleware(profiler.ProfilerMiddleware)
+
+    def blocking_query():
+        time.sleep(0.05)
+
+    def busy_loop():
+        deadline = time.perf_counter() + 0.05
+        while time.perf_counter() < deadline:
+            pass
+
+    @app.get("/work")
+    async def work():
+        await asyncio.to_thread(blocking_query)
+        busy_loop()
+        return {}
+
+    @app.get("/other")
+    async def other():
+        busy_loop()
+        return {}
+
+    client = TestClient(app)
+    p = profiler.profiler
+    client.get("/work")
+    assert not p.active and p._thread is None
+
+    p.start(profiler.Session(routes=("/work",), interval=0.001))
+    try:
+        client.get("/work")
+        client.get("/other")
+    finally:
+        session = p.stop()
+    stacks = p.collapsed().splitlines()
+    assert session.requests == 1 and session.samples > 0
+    assert all(line.startswith("/work;app.core.profiler:ProfilerMiddleware.__call__;") for line in stacks)
+    assert any("test_core:test_profiler_samples_selected_requests_as_collapsed_stacks.<locals>.work;asyncio.threads:to_thread" in line for line in stacks)
+    assert any(line.rsplit(" ", 1)[0].endswith("<locals>.busy_loop") for line in stacks)
+    assert not p.active and p._requests == {}
+
+
+def test_profiler_collapsed_reads_while_sampler_writes():
+    p = profiler.Profiler()
+    session = profiler.Session()
+    p.last = session
+
+    def sampler():
+        for i in range(5000):
+            session.add(f"/r;frame{i}")
+
+    thread = threading.Thread(target=sampler)
+    thread.start()
+    # sem a cópia sob lock: "dictionary changed size during iteration"
+    while thread.is_alive():
+        p.collapsed()
+        session.describe()
+    thread.join()
+    assert p.collapsed().count("\n") == session.samples == 5000
+
+# ---------- REPOSITORY ----------
+
+def test_repository_prepares_once_per_connection():
+    from app.repositories import bookings
+
+    async def scenario():
+        first, second = MagicMock(), MagicMock()
+        first.fetchone.return_value = second.fetchone.return_value = (7,)
+        await bookings.insert(db.AsyncCursor(first), 1, 2, 60.0, None, [("ball", 5.0)])
+        await bookings.insert(db.AsyncCursor(first), 1, 3, 55.0, None, [])
+        await bookings.insert(db.AsyncCursor(second), 1, 4, 55.0, None, [])
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    sqls = [c.args[0] for c in first.execute.call_args_list]
+    assert [s.split()[0] for s in sqls] == ["PREPARE", "EXECUTE", "EXECUTE"]
+    assert first.execute.call_args_list[1].args[1][:6] == (1, 2, 60.0, None, ["ball"], [5.0])
+    assert second.execute.call_args_list[0].args[0].startswith("PREPARE sb_booking_insert")
+
+def test_pool_warm_prepares_statements_on_idle_connections():
+    from app.repositories import bookings
+
+    pool, created = make_pool(min_size=2, max_size=2)
+
+    async def scenario():
+        await pool.open()
+        await pool.warm(bookings.prepare_all)
+        prepared = [[c.args[0].split()[:2] for c in conn.cursor.return_value.execute.call_args_list] for conn in created]
+        conn = await pool.acquire()
+        cur = conn.cursor.return_value
+        cur.connection = conn
+        cur.execute.reset_mock()
+        await bookings.view(db.AsyncCursor(cur), 1)
+        return prepared, [c.args[0].split()[0] for c in cur.execute.call_args_list]
+
+    prepared, used = asyncio.run(scenario())
+    assert all(sorted(name for _, name in p) == sorted(bookings.STATEMENTS) for p in prepared)
+    assert all(conn.rollback.call_count == 1 for conn in created)
+    assert used == ["EXECUTE"]
+
+def test_pool_warm_discards_connection_left_in_failed_transaction():
+    from app.repositories import bookings
+
+    pool, created = make_pool(min_size=1, max_size=1)
+
+    async def scenario():
+        await pool.open()
+        conn = created[0]
+        conn.cursor.return_value.execute.side_effect = RuntimeError("prepare failed")
+        conn.rollback.side_effect = RuntimeError("connection lost")
+        conn.get_transaction_status.return_value = 3  # INERROR
+        with pytest.raises(RuntimeError):
+            await pool.warm(bookings.prepare_all)
+        return pool.size, pool.idle
+
+    assert asyncio.run(scenario()) == (0, 0)
+    # o rollback foi tentado no finally do prepare_all e de novo no release
+    assert created[0].rollback.call_count == 2
+    assert created[0].close.called
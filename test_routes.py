@@ -1,27 +1,75 @@
-
+import httpx
+import json
+import os
 import pytest
+from contextlib import asynccontextmanager
 from fastapi.testclient import TestClient
-from unittest.mock import patch, MagicMock
+from unittest.mock import ANY, patch, MagicMock, AsyncMock
 from fastapi import FastAPI
+from psycopg2 import errors
+from app.core import admission, cache, consistency
+from app.services import contention, occupancy
+from app.services.resilience import CircuitOpen
+from app.core.auth import verify_token
+from app.core.db import AsyncConnection
+from app.api.routes.availability import router as availability_router
 from app.api.routes.health import router as health_router
 from app.api.routes.quotes import router as quotes_router
 from app.api.routes.bookings_user import router as bookings_router
-from app.api.routes.callbacks import router as callbacks_router
+from app.api.routes.callbacks import router as callbacks_router, seen_callbacks
+from app.api.routes.profiling import router as profiling_router
 
 app = FastAPI()
 app.include_router(health_router)
 app.include_router(quotes_router)
 app.include_router(bookings_router)
 app.include_router(callbacks_router)
+app.include_router(availability_router)
+app.include_router(profiling_router)
+app.dependency_overrides[verify_token] = lambda: {"sub": "auth0|test"}
 
 client = TestClient(app)
 
+
+@pytest.fixture(autouse=True)
+def reset_state():
+    seen_callbacks.clear()
+    cache.booking_views.local.clear()
+    contention.gate.clear()
+    consistency.tracker.clear()
+    occupancy.index.clear()
+    admission.default_policy.buckets.clear()
+    client.cookies.clear()
+
+
+def fake_connection(mock_cursor):
+    raw = MagicMock()
+    raw.cursor.return_value = mock_cursor
+
+    @asynccontextmanager
+    async def connection(*args, **kwargs):
+        yield AsyncConnection(raw)
+
+    return connection
+
 # ---------- HEALTH ----------
 def test_health():
     response = client.get("/health")
     assert response.status_code == 200
     assert response.json() == {"status": "ok"}
 
+def test_metrics_endpoint():
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert "# TYPE sb_http_request_duration_seconds histogram" in response.text
+    assert "# TYPE sb_outbox_pending gauge" in response.text
+
+@patch("app.core.db.connection")
+def test_metrics_scrape_does_not_touch_database(mock_conn):
+    assert client.get("/metrics").status_code == 200
+    mock_conn.assert_not_called()
+
 # ---------- QUOTES ----------
 def test_quote_endpoint():
     response = client.get("/quotes", params={"court_id": 1, "slot_id": 2, "extras": ["ball", "vest"]})
@@ -30,16 +78,41 @@ def test_quote_endpoint():
     assert data["total"] == 63.0
     assert len(data["extras"]) == 2
 
+def test_quote_matrix_endpoint():
+    response = client.get("/quotes/matrix", params={"court_ids": [1, 2], "slot_from": 8, "slot_to": 10, "extras": ["ball"]})
+    assert response.status_code == 200
+    data = response.json()
+    assert data["court_ids"] == [1, 2]
+    assert data["extras_total"] == 5.0
+    assert data["total"] == [[55.0, 55.0, 55.0], [55.0, 55.0, 55.0]]
+
+def test_quote_matrix_rejects_oversized_grid():
+    response = client.get("/quotes/matrix", params={"court_ids": [1], "slot_from": 0, "slot_to": 10**6})
+    assert response.status_code == 422
+
+# ---------- AVAILABILITY ----------
+def test_availability_from_occupancy_index():
+    assert client.get("/availability", params={"court_ids": [1], "slot_from": 8, "slot_to": 10}).status_code == 503
+    occupancy.index.replace([(1, 1, 9)])
+    occupancy.index.loaded = True
+
+    response = client.get("/availability", params={"court_ids": [1, 2], "slot_from": 8, "slot_to": 10})
+    assert response.status_code == 200
+    assert response.json()["courts"] == [{"court_id": 1, "free": [8, 10]}, {"court_id": 2, "free": [8, 9, 10]}]
+    assert client.get("/availability", params={"court_ids": [1], "slot_from": 10, "slot_to": 8}).status_code == 422
+    too_far = occupancy.index.max_slot_id + 1
+    assert client.get("/availability", params={"court_ids": [1], "slot_from": too_far, "slot_to": too_far}).status_code == 422
+
 # ---------- BOOKINGS ----------
-@patch("app.api.routes.bookings_user.get_conn")
-@patch("app.services.agenda_client.create_lock")
+@patch("app.core.db.connection")
+@patch("app.services.agenda_client.get_client")
 @patch("app.api.routes.quotes.calculate_quote")
 def test_create_booking(mock_quote, mock_lock, mock_conn):
     mock_quote.return_value = {"total": 60.0, "extras": [{"type": "ball", "price": 10.0}]}
-    mock_lock.return_value = {"lock_id": "1-2-3"}
+    mock_lock.return_value.create_lock = AsyncMock(return_value={"lock_id": "1-2-3"})
     mock_cursor = MagicMock()
     mock_cursor.fetchone.return_value = [123]
-    mock_conn.return_value.cursor.return_value = mock_cursor
+    mock_conn.side_effect = fake_connection(mock_cursor)
 
     response = client.post("/bookings", params={"court_id": 1, "slot_id": 2, "extras": ["ball"], "notes": "bring water"})
     assert response.status_code == 200
@@ -48,86 +121,449 @@ def test_create_booking(mock_quote, mock_lock, mock_conn):
     assert data["status"] == "CREATED"
     assert data["lock_id"] == "1-2-3"
 
-@patch("app.api.routes.bookings_user.get_conn")
+@patch("app.core.db.connection")
+@patch("app.services.agenda_client.get_client")
+def test_create_booking_holds_slot_for_later_attempts(mock_lock, mock_conn):
+    mock_lock.return_value.create_lock = AsyncMock(return_value={"lock_id": "1-2-123"})
+    mock_cursor = MagicMock()
+    mock_cursor.fetchone.return_value = [123]
+    mock_conn.side_effect = fake_connection(mock_cursor)
+
+    assert client.post("/bookings", json={"court_id": 1, "slot_id": 2}).status_code == 200
+    mock_conn.reset_mock()
+
+    response = client.post("/bookings", json={"court_id": 1, "slot_id": 2})
+    assert response.status_code == 409
+    mock_conn.assert_not_called()
+    assert mock_lock.return_value.create_lock.await_count == 1
+
+@patch("app.core.db.connection")
+@patch("app.services.agenda_client.get_client")
+def test_create_booking_unique_violation_is_conflict(mock_lock, mock_conn):
+    mock_cursor = MagicMock()
+    mock_cursor.execute.side_effect = errors.UniqueViolation("duplicate key")
+    mock_conn.side_effect = fake_connection(mock_cursor)
+
+    response = client.post("/bookings", json={"court_id": 1, "slot_id": 2})
+    assert response.status_code == 409
+    mock_lock.return_value.create_lock.assert_not_called()
+    assert contention.gate.is_held((1, 2))
+
+@patch("app.core.db.connection")
+@patch("app.services.agenda_client.get_client")
+def test_create_booking_open_circuit_is_unavailable(mock_lock, mock_conn):
+    mock_lock.return_value.create_lock = AsyncMock(side_effect=CircuitOpen("agenda", 12))
+    mock_cursor = MagicMock()
+    mock_cursor.fetchone.return_value = [123]
+    mock_conn.side_effect = fake_connection(mock_cursor)
+
+    response = client.post("/bookings", json={"court_id": 1, "slot_id": 2})
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "12"
+    assert not contention.gate.is_held((1, 2))
+
+@patch("app.core.db.connection")
 def test_get_booking_found(mock_conn):
     mock_cursor = MagicMock()
     mock_cursor.fetchone.return_value = [1, 2, 3, "CREATED", 50.0, 25.0, "note"]
-    mock_conn.return_value.cursor.return_value = mock_cursor
+    mock_conn.side_effect = fake_connection(mock_cursor)
 
     response = client.get("/bookings/1")
     assert response.status_code == 200
     assert response.json()["court_id"] == 2
 
-@patch("app.api.routes.bookings_user.get_conn")
+@patch("app.core.db.connection")
 def test_get_booking_not_found(mock_conn):
     mock_cursor = MagicMock()
     mock_cursor.fetchone.return_value = None
-    mock_conn.return_value.cursor.return_value = mock_cursor
+    mock_conn.side_effect = fake_connection(mock_cursor)
 
     response = client.get("/bookings/999")
     assert response.status_code == 404
     assert response.json()["detail"] == "booking not found"
 
-@patch("app.api.routes.bookings_user.get_conn")
+@patch("app.core.db.connection")
+def test_get_booking_cached_with_etag(mock_conn):
+    mock_cursor = MagicMock()
+    mock_cursor.fetchone.return_value = [5, 2, 3, "CREATED", 50.0, None]
+    mock_conn.side_effect = fake_connection(mock_cursor)
+
+    first = client.get("/bookings/5")
+    etag = first.headers["ETag"]
+    second = client.get("/bookings/5", headers={"If-None-Match": etag})
+    assert first.status_code == 200
+    assert second.status_code == 304
+    assert second.headers["ETag"] == etag
+    assert mock_conn.call_count == 1
+
+@patch("app.core.db.connection")
+def test_get_booking_long_poll_times_out_with_304(mock_conn):
+    mock_cursor = MagicMock()
+    mock_cursor.fetchone.return_value = [5, 2, 3, "PENDING_PAYMENT", 50.0, None]
+    mock_conn.side_effect = fake_connection(mock_cursor)
+
+    etag = client.get("/bookings/5").headers["ETag"]
+    response = client.get("/bookings/5", params={"wait": 0.05}, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+@patch("app.core.db.connection")
+def test_booking_events_stream_ends_on_final_status(mock_conn):
+    mock_cursor = MagicMock()
+    mock_cursor.fetchone.return_value = [5, 2, 3, "CONFIRMED", 50.0, 50.0]
+    mock_conn.side_effect = fake_connection(mock_cursor)
+
+    response = client.get("/bookings/5/events")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    assert response.text.startswith("event: status\n")
+    assert '"status": "CONFIRMED"' in response.text
+
+@patch("app.core.db.connection")
+def test_cancel_booking_invalidates_cached_view(mock_conn):
+    mock_cursor = MagicMock()
+    mock_cursor.fetchone.side_effect = [[5, 2, 3, "CREATED", 50.0, None], ["CREATED", 2, 3, 1], [5, 2, 3, "CANCELLED", 50.0, None]]
+    mock_conn.side_effect = fake_connection(mock_cursor)
+
+    etag = client.get("/bookings/5").headers["ETag"]
+    assert client.delete("/bookings/5").status_code == 200
+    response = client.get("/bookings/5", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json()["status"] == "CANCELLED"
+    assert response.headers["ETag"] != etag
+
+@patch("app.core.db.connection")
+def test_reads_go_to_primary_right_after_a_write(mock_conn):
+    mock_cursor = MagicMock()
+    mock_cursor.fetchone.side_effect = [[5, 2, 3, "CREATED", 50.0, None], ["CREATED", 2, 3, 1], [5, 2, 3, "CANCELLED", 50.0, None]]
+    mock_conn.side_effect = fake_connection(mock_cursor)
+
+    client.get("/bookings/5")
+    response = client.delete("/bookings/5")
+    assert consistency.COOKIE in response.cookies
+    client.get("/bookings/5")
+    readonly = [c.kwargs.get("readonly", False) for c in mock_conn.call_args_list]
+    assert readonly == [True, False, False]
+
+@patch("app.core.db.connection")
 def test_cancel_booking_success(mock_conn):
     mock_cursor = MagicMock()
-    mock_cursor.fetchone.return_value = ["CREATED"]
-    mock_conn.return_value.cursor.return_value = mock_cursor
+    mock_cursor.fetchone.return_value = ["CREATED", 2, 3, 1]
+    mock_conn.side_effect = fake_connection(mock_cursor)
+    contention.gate.hold((2, 3))
 
     response = client.delete("/bookings/1")
     assert response.status_code == 200
     assert response.json()["ok"]
+    assert not contention.gate.is_held((2, 3))
+    # SELECT, UPDATE e NOTIFY num único EXECUTE
+    assert mock_cursor.execute.call_args.args == ("EXECUTE sb_booking_cancel (%s, %s, %s)", (1, "booking_events", ANY))
 
-@patch("app.api.routes.bookings_user.get_conn")
+@patch("app.core.db.connection")
 def test_cancel_booking_not_found(mock_conn):
     mock_cursor = MagicMock()
     mock_cursor.fetchone.return_value = None
-    mock_conn.return_value.cursor.return_value = mock_cursor
+    mock_conn.side_effect = fake_connection(mock_cursor)
 
     response = client.delete("/bookings/999")
     assert response.status_code == 404
 
-@patch("app.api.routes.bookings_user.get_conn")
+@patch("app.core.db.connection")
 def test_cancel_booking_confirmed(mock_conn):
     mock_cursor = MagicMock()
-    mock_cursor.fetchone.return_value = ["CONFIRMED"]
-    mock_conn.return_value.cursor.return_value = mock_cursor
+    mock_cursor.fetchone.return_value = ["CONFIRMED", 2, 3, 0]
+    mock_conn.side_effect = fake_connection(mock_cursor)
 
     response = client.delete("/bookings/1")
     assert response.status_code == 400
     assert response.json()["detail"] == "cannot cancel confirmed booking"
 
-@patch("app.api.routes.bookings_user.get_conn")
+@patch("app.core.db.connection")
 def test_list_bookings(mock_conn):
     mock_cursor = MagicMock()
     mock_cursor.fetchall.return_value = [(1, 2, 3, "CREATED", 50.0)]
-    mock_conn.return_value.cursor.return_value = mock_cursor
+    mock_conn.side_effect = fake_connection(mock_cursor)
 
     response = client.get("/me/bookings")
     assert response.status_code == 200
     assert response.json()[0]["status"] == "CREATED"
 
-@patch("app.api.routes.bookings_user.get_conn")
-@patch("app.services.payment_client.checkout")
+@patch("app.core.db.connection")
+def test_list_bookings_forces_owner_and_paginates(mock_conn):
+    mock_cursor = MagicMock()
+    mock_cursor.fetchall.return_value = [(4, 1, 10, "CREATED", 50.0, None, None), (9, 1, 11, "CONFIRMED", 55.0, 55.0, None)]
+    mock_conn.side_effect = fake_connection(mock_cursor)
+
+    response = client.get("/bookings", params={"court_id": 1, "owner": "auth0|other", "after": 3, "limit": 2})
+    assert response.status_code == 200
+    data = response.json()
+    assert [b["id"] for b in data["items"]] == [4, 9]
+    assert data["next_after"] == 9
+    sql, params = mock_cursor.execute.call_args.args
+    assert "user_sub = %s" in sql and "id > %s" in sql and sql.endswith("ORDER BY id LIMIT %s")
+    assert params == ["auth0|test", 1, 3, 2]
+
+@patch("app.core.db.connection")
+def test_list_bookings_ops_can_see_all(mock_conn):
+    mock_cursor = MagicMock()
+    mock_cursor.fetchall.return_value = []
+    mock_conn.side_effect = fake_connection(mock_cursor)
+    app.dependency_overrides[verify_token] = lambda: {"sub": "auth0|ops", "permissions": ["read:all_bookings"]}
+    try:
+        response = client.get("/bookings", params={"court_id": 1, "date_from": "2025-03-01", "date_to": "2025-03-01"})
+    finally:
+        app.dependency_overrides[verify_token] = lambda: {"sub": "auth0|test"}
+    assert response.json() == {"items": [], "next_after": None}
+    sql, params = mock_cursor.execute.call_args.args
+    assert "user_sub" not in sql
+    assert [str(p) for p in params] == ["1", "2025-03-01", "2025-03-02", "50"]
+
+@patch("app.core.db.connection")
+def test_export_bookings_streams_chunks(mock_conn):
+    mock_cursor = MagicMock()
+    mock_cursor.fetchmany.side_effect = [[(1, 1, 10, "CREATED", 50.0, None, None)], [(2, 1, 11, "CANCELLED", 50.0, None, None)], []]
+    mock_conn.side_effect = fake_connection(mock_cursor)
+
+    ndjson = client.get("/bookings/export")
+    assert ndjson.headers["content-type"] == "application/x-ndjson"
+    assert [line["id"] for line in map(json.loads, ndjson.text.splitlines())] == [1, 2]
+    mock_cursor.close.assert_called_once()
+
+    mock_cursor.fetchmany.side_effect = [[(1, 1, 10, "CREATED", 50.0, None, None)], []]
+    csv_text = client.get("/bookings/export", params={"format": "csv"}).text
+    assert csv_text.splitlines() == ["id,court_id,slot_id,status,estimate_total,paid_total,created_at", "1,1,10,CREATED,50.0,,"]
+
+@patch("app.core.db.connection")
+@patch("app.services.payment_client.get_client")
 def test_checkout_booking(mock_checkout, mock_conn):
     mock_cursor = MagicMock()
     mock_cursor.fetchone.return_value = [100.0]
-    mock_conn.return_value.cursor.return_value = mock_cursor
-    mock_checkout.return_value = {"payment_id": "abc123", "status": "PENDING"}
+    mock_conn.side_effect = fake_connection(mock_cursor)
+    mock_checkout.return_value.checkout = AsyncMock(return_value={"payment_id": "abc123", "status": "PENDING"})
 
     response = client.post("/bookings/1/checkout", params={"method": "pix"})
     assert response.status_code == 200
     data = response.json()
     assert data["payment_id"] == "abc123"
 
+def start_row(previous, job_id=None, key=None):
+    """Linha de sb_booking_start_checkout: com job_id o checkout começou."""
+    if job_id is None:
+        return (previous, None, None, None, None, None, 0)
+    return (previous, 100.0, 2, 3, job_id, key, 1)
+
+@patch("app.core.db.connection")
+@patch("app.services.payment_client.get_client")
+def test_checkout_sync_rejects_cancelled_booking_without_charging(mock_payment, mock_conn):
+    mock_cursor = MagicMock()
+    mock_cursor.fetchone.return_value = start_row("CANCELLED")
+    mock_conn.side_effect = fake_connection(mock_cursor)
+
+    response = client.post("/bookings/1/checkout", json={"method": "PIX"})
+    assert response.status_code == 409
+    mock_payment.return_value.checkout.assert_not_called()
+
+@patch("app.services.checkout.record", new_callable=AsyncMock)
+@patch("app.core.db.connection")
+@patch("app.services.payment_client.get_client")
+def test_checkout_sync_reverts_when_payment_rejects(mock_payment, mock_conn, mock_record):
+    mock_cursor = MagicMock()
+    mock_cursor.fetchone.return_value = start_row("CREATED", 9, "booking-1-0")
+    mock_conn.side_effect = fake_connection(mock_cursor)
+    rejected = httpx.HTTPStatusError("bad coupon", request=httpx.Request("POST", "http://p/checkout"),
+                                     response=httpx.Response(422))
+    mock_payment.return_value.checkout = AsyncMock(side_effect=rejected)
+
+    response = client.post("/bookings/1/checkout", json={"method": "PIX"})
+    assert response.status_code == 402
+    assert response.json()["detail"]["upstream_status"] == 422
+    assert mock_payment.return_value.checkout.call_args.kwargs["idempotency_key"] == "booking-1-0"
+    # job FAILED: o _record devolve a booking para CREATED
+    assert mock_record.call_args.args[0][:2] == (9, "FAILED")
+
+@patch("app.services.checkout.record", new_callable=AsyncMock)
+@patch("app.core.db.connection")
+@patch("app.services.payment_client.get_client")
+def test_checkout_sync_timeout_keeps_booking_pending(mock_payment, mock_conn, mock_record):
+    mock_cursor = MagicMock()
+    mock_cursor.fetchone.return_value = start_row("CREATED", 9, "booking-1-0")
+    mock_conn.side_effect = fake_connection(mock_cursor)
+    mock_payment.return_value.checkout = AsyncMock(side_effect=httpx.ReadTimeout("no answer"))
+
+    response = client.post("/bookings/1/checkout", json={"method": "PIX"})
+    assert response.status_code == 504
+    assert response.json()["detail"]["status"] == "PENDING_PAYMENT"
+    # sem reverter: a cobrança pode ter acontecido, e o UNKNOWN bloqueia outra até o callback
+    assert mock_record.call_args.args[0][:2] == (9, "UNKNOWN")
+
+@patch("app.core.db.connection")
+@patch("app.services.payment_client.get_client")
+def test_checkout_sync_refuses_booking_with_open_job(mock_payment, mock_conn):
+    # checkout async na fila (ou UNKNOWN): o síncrono não cobra por fora
+    mock_cursor = MagicMock()
+    mock_cursor.fetchone.return_value = start_row("PENDING_PAYMENT")
+    mock_conn.side_effect = fake_connection(mock_cursor)
+
+    response = client.post("/bookings/1/checkout", json={"method": "PIX"})
+    assert response.status_code == 409
+    assert response.json()["detail"] == "checkout already in progress"
+    mock_payment.return_value.checkout.assert_not_called()
+
+@patch("app.core.db.connection")
+@patch("app.services.payment_client.get_client")
+def test_checkout_sync_race_on_open_job_index(mock_payment, mock_conn):
+    mock_cursor = MagicMock()
+
+    def execute(sql, params=None):
+        if sql.startswith("EXECUTE sb_booking_start_checkout"):
+            raise errors.UniqueViolation()
+
+    mock_cursor.execute.side_effect = execute
+    mock_conn.side_effect = fake_connection(mock_cursor)
+
+    response = client.post("/bookings/1/checkout", json={"method": "PIX"})
+    assert response.status_code == 409
+    mock_payment.return_value.checkout.assert_not_called()
+
+@patch("app.core.db.connection")
+@patch("app.services.payment_client.get_client")
+def test_checkout_async_returns_job_without_calling_payment(mock_payment, mock_conn):
+    mock_cursor = MagicMock()
+    mock_cursor.fetchone.return_value = start_row("CREATED", 42, "booking-7-0")
+    mock_conn.side_effect = fake_connection(mock_cursor)
+
+    response = client.post("/bookings/7/checkout", params={"mode": "async"}, json={"method": "PIX"})
+    assert response.status_code == 202
+    assert response.json() == {"job_id": 42, "booking_id": 7, "status": "QUEUED"}
+    assert response.headers["Location"] == "/checkout-jobs/42"
+    mock_payment.return_value.checkout.assert_not_called()
+    assert "QUEUED" in mock_cursor.execute.call_args.args[1]
+
+@patch("app.core.db.connection")
+def test_checkout_async_rejects_finished_booking(mock_conn):
+    mock_cursor = MagicMock()
+    mock_cursor.fetchone.return_value = start_row("CONFIRMED")
+    mock_conn.side_effect = fake_connection(mock_cursor)
+
+    response = client.post("/bookings/7/checkout", params={"mode": "async"}, json={"method": "PIX"})
+    assert response.status_code == 409
+    assert response.json()["detail"] == "cannot checkout confirmed booking"
+
+@patch("app.core.db.connection")
+def test_checkout_async_rejects_second_job_for_booking(mock_conn):
+    mock_cursor = MagicMock()
+    mock_cursor.fetchone.return_value = start_row("PENDING_PAYMENT")
+    mock_conn.side_effect = fake_connection(mock_cursor)
+
+    response = client.post("/bookings/7/checkout", params={"mode": "async"}, json={"method": "PIX"})
+    assert response.status_code == 409
+    assert response.json()["detail"] == "checkout already in progress"
+
+@patch("app.core.db.connection")
+def test_checkout_job_status(mock_conn):
+    mock_cursor = MagicMock()
+    mock_cursor.fetchone.return_value = (7, "DONE", 1, "p-1", "PENDING", None)
+    mock_conn.side_effect = fake_connection(mock_cursor)
+
+    response = client.get("/checkout-jobs/42")
+    assert response.status_code == 200
+    assert response.json()["payment_id"] == "p-1" and response.json()["status"] == "DONE"
+
+def batch_agenda(mock_agenda, failing_slot):
+    async def create_lock(court_id, slot_id, booking_id):
+        if slot_id == failing_slot:
+            raise RuntimeError("409 Conflict")
+        return {"lock_id": f"{court_id}-{slot_id}-{booking_id}"}
+
+    agenda = AsyncMock()
+    agenda.create_lock.side_effect = create_lock
+    mock_agenda.return_value = agenda
+    return agenda
+
+BATCH = [
+    {"court_id": 1, "slot_id": 10, "extras": ["ball"]},
+    {"court_id": 1, "slot_id": 11},
+]
+
+@patch("app.core.db.connection")
+@patch("app.services.agenda_client.get_client")
+@patch("app.api.routes.bookings_user.execute_values")
+def test_create_bookings_batch_best_effort(mock_values, mock_agenda, mock_conn):
+    mock_values.side_effect = [[(100, 1, 10), (101, 1, 11)], None]
+    mock_cursor = MagicMock()
+    mock_conn.side_effect = fake_connection(mock_cursor)
+    agenda = batch_agenda(mock_agenda, failing_slot=11)
+
+    response = client.post("/bookings/batch", json={"mode": "best_effort", "items": BATCH})
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert results[0]["booking_id"] == 100 and results[0]["lock_id"] == "1-10-100"
+    assert results[1]["status"] == "FAILED"
+    assert mock_cursor.execute.call_args_list[0].args == ("DELETE FROM bookings WHERE id = ANY(%s)", ([101],))
+    notified = json.loads(mock_cursor.execute.call_args_list[1].args[1][1][0])
+    assert notified["booking_id"] == 100 and notified["status"] == "CREATED"
+    assert mock_values.call_args_list[1].args[2] == [(100, "ball", 1, 5.0)]
+    agenda.release_lock.assert_not_awaited()
+
+@patch("app.core.db.connection")
+@patch("app.services.agenda_client.get_client")
+@patch("app.api.routes.bookings_user.execute_values")
+def test_create_bookings_batch_atomic_releases_locks(mock_values, mock_agenda, mock_conn):
+    mock_values.side_effect = [[(100, 1, 10), (101, 1, 11)]]
+    mock_conn.side_effect = fake_connection(MagicMock())
+    agenda = batch_agenda(mock_agenda, failing_slot=11)
+
+    response = client.post("/bookings/batch", json={"items": BATCH})
+    assert response.status_code == 409
+    results = response.json()["detail"]["results"]
+    assert [r["status"] for r in results] == ["ROLLED_BACK", "FAILED"]
+    agenda.release_lock.assert_awaited_once_with("1-10-100")
+    assert mock_values.call_count == 1
+
+@patch("app.core.db.connection")
+@patch("app.services.agenda_client.get_client")
+@patch("app.api.routes.bookings_user.execute_values")
+def test_create_bookings_batch_best_effort_reports_taken_slot(mock_values, mock_agenda, mock_conn):
+    # slot 11 já tem booking ativa: ON CONFLICT DO NOTHING não devolve linha para ele
+    mock_values.side_effect = [[(100, 1, 10)], None]
+    mock_conn.side_effect = fake_connection(MagicMock())
+    agenda = batch_agenda(mock_agenda, failing_slot=None)
+
+    response = client.post("/bookings/batch", json={"mode": "best_effort", "items": BATCH})
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert results[0]["status"] == "CREATED" and results[0]["booking_id"] == 100
+    assert results[1] == {"index": 1, "status": "FAILED", "error": "slot not available"}
+    assert agenda.create_lock.await_count == 1
+    assert "ON CONFLICT" in mock_values.call_args_list[0].args[1]
+
+@patch("app.core.db.connection")
+@patch("app.services.agenda_client.get_client")
+@patch("app.api.routes.bookings_user.execute_values")
+def test_create_bookings_batch_atomic_taken_slot_locks_nothing(mock_values, mock_agenda, mock_conn):
+    mock_values.side_effect = [[(100, 1, 10)]]
+    mock_conn.side_effect = fake_connection(MagicMock())
+    agenda = batch_agenda(mock_agenda, failing_slot=None)
+
+    response = client.post("/bookings/batch", json={"items": BATCH})
+    assert response.status_code == 409
+    assert [r["status"] for r in response.json()["detail"]["results"]] == ["ROLLED_BACK", "FAILED"]
+    agenda.create_lock.assert_not_awaited()
+
 # ---------- CALLBACK ----------
-@patch("app.api.routes.callbacks.get_conn")
-@patch("app.services.agenda_client.mark_booked")
-@patch("app.services.agenda_client.release_lock")
-def test_payment_callback_approved(mock_release, mock_mark, mock_conn):
+def callback_params(mock_cursor):
+    """Parâmetros dos EXECUTE do callback (o PREPARE vai antes, uma vez por conexão)."""
+    return [
+        c.args[1]
+        for c in mock_cursor.execute.call_args_list
+        if c.args[0].startswith("EXECUTE sb_booking_payment_callback")
+    ]
+
+@patch("app.core.db.connection")
+@patch("app.services.agenda_client.get_client")
+def test_payment_callback_approved(mock_agenda, mock_conn):
     mock_cursor = MagicMock()
-    mock_cursor.fetchone.return_value = [1, 2]
-    mock_conn.return_value.cursor.return_value = mock_cursor
+    mock_cursor.fetchone.return_value = (1, 1, 2, 0, 1, 1)
+    mock_conn.side_effect = fake_connection(mock_cursor)
 
     response = client.post("/callbacks/payment", params={
         "payment_id": 1,
@@ -139,13 +575,18 @@ def test_payment_callback_approved(mock_release, mock_mark, mock_conn):
     })
     assert response.status_code == 200
     assert response.json() == {"ok": True}
+    assert mock_cursor.execute.call_args_list[0].args[0].startswith("PREPARE sb_booking_payment_callback")
+    [params] = callback_params(mock_cursor)
+    assert params[:9] == (1, "APPROVED", 1, "CONFIRMED", ["CREATED", "PENDING_PAYMENT"], 100.0, 10, "url", "mark_booked")
+    mock_agenda.assert_not_called()
 
-@patch("app.api.routes.callbacks.get_conn")
-@patch("app.services.agenda_client.release_lock")
-def test_payment_callback_declined(mock_release, mock_conn):
+@patch("app.core.db.connection")
+@patch("app.services.agenda_client.get_client")
+def test_payment_callback_declined(mock_agenda, mock_conn):
     mock_cursor = MagicMock()
-    mock_cursor.fetchone.return_value = [1, 2]
-    mock_conn.return_value.cursor.return_value = mock_cursor
+    mock_cursor.fetchone.return_value = (1, 1, 2, 0, 1, 1)
+    mock_conn.side_effect = fake_connection(mock_cursor)
+    contention.gate.hold((1, 2))
 
     response = client.post("/callbacks/payment", params={
         "payment_id": 1,
@@ -154,12 +595,16 @@ def test_payment_callback_declined(mock_release, mock_conn):
     })
     assert response.status_code == 200
     assert response.json() == {"ok": True}
+    [params] = callback_params(mock_cursor)
+    assert params[3] == "CANCELLED" and params[5] is None and params[8] == "release_lock"
+    assert not contention.gate.is_held((1, 2))
+    mock_agenda.assert_not_called()
 
-@patch("app.api.routes.callbacks.get_conn")
+@patch("app.core.db.connection")
 def test_payment_callback_other(mock_conn):
     mock_cursor = MagicMock()
-    mock_cursor.fetchone.return_value = [1, 2]
-    mock_conn.return_value.cursor.return_value = mock_cursor
+    mock_cursor.fetchone.return_value = (1, 1, 2, 0, 0, 1)
+    mock_conn.side_effect = fake_connection(mock_cursor)
 
     response = client.post("/callbacks/payment", params={
         "payment_id": 1,
@@ -168,12 +613,13 @@ def test_payment_callback_other(mock_conn):
     })
     assert response.status_code == 200
     assert response.json() == {"ok": True}
+    assert callback_params(mock_cursor)[0][8] is None
 
-@patch("app.api.routes.callbacks.get_conn")
+@patch("app.core.db.connection")
 def test_payment_callback_booking_not_found(mock_conn):
     mock_cursor = MagicMock()
-    mock_cursor.fetchone.return_value = None
-    mock_conn.return_value.cursor.return_value = mock_cursor
+    mock_cursor.fetchone.return_value = (1, None, None, 0, 0, 0)
+    mock_conn.side_effect = fake_connection(mock_cursor)
 
     response = client.post("/callbacks/payment", params={
         "payment_id": 1,
@@ -182,3 +628,95 @@ def test_payment_callback_booking_not_found(mock_conn):
     })
     assert response.status_code == 200
     assert response.json() == {"ignored": True}
+
+@patch("app.core.db.connection")
+def test_payment_callback_replay_short_circuits(mock_conn):
+    mock_cursor = MagicMock()
+    mock_cursor.fetchone.return_value = (1, 1, 2, 0, 1, 1)
+    mock_conn.side_effect = fake_connection(mock_cursor)
+    params = {"payment_id": 7, "booking_id": 1, "status": "APPROVED", "paid_amount": 100}
+
+    assert client.post("/callbacks/payment", params=params).json() == {"ok": True}
+    assert client.post("/callbacks/payment", params=params).json() == {"ok": True, "duplicate": True}
+    assert mock_conn.call_count == 1
+
+@patch("app.core.db.connection")
+def test_payment_callback_duplicate_in_db(mock_conn):
+    mock_cursor = MagicMock()
+    mock_cursor.fetchone.return_value = (0, None, None, 0, 0, 0)
+    mock_conn.side_effect = fake_connection(mock_cursor)
+
+    response = client.post("/callbacks/payment", params={"payment_id": 8, "booking_id": 1, "status": "APPROVED"})
+    assert response.json() == {"ok": True, "duplicate": True}
+    assert len(callback_params(mock_cursor)) == 1
+
+@patch("app.core.db.connection")
+def test_payment_callback_out_of_order_is_ignored(mock_conn):
+    mock_cursor = MagicMock()
+    mock_cursor.fetchone.return_value = (1, None, None, 0, 0, 0)
+    mock_conn.side_effect = fake_connection(mock_cursor)
+
+    response = client.post("/callbacks/payment", params={"payment_id": 9, "booking_id": 1, "status": "PENDING"})
+    assert response.json() == {"ignored": True}
+    [params] = callback_params(mock_cursor)
+    assert params[3] == "PENDING_PAYMENT" and params[4] == ["CREATED"] and params[8] is None
+
+@patch("app.core.db.connection")
+def test_payment_callbacks_batch_reports_per_item(mock_conn):
+    mock_cursor = MagicMock()
+    # rodada 1: booking 1 (PENDING) e booking 2 (inexistente); rodada 2: booking 1 (APPROVED)
+    mock_cursor.fetchall.side_effect = [
+        [(0, True, 5, 6, False, 0, 1), (1, True, None, None, False, 0, 0)],
+        [(0, True, 5, 6, False, 1, 1)],
+    ]
+    mock_conn.side_effect = fake_connection(mock_cursor)
+
+    response = client.post("/callbacks/payment/batch", json=[
+        {"payment_id": 1, "booking_id": 1, "status": "PENDING"},
+        {"payment_id": 2, "booking_id": 2, "status": "APPROVED"},
+        {"payment_id": 1, "booking_id": 1, "status": "APPROVED", "paid_amount": 100},
+        {"payment_id": 1, "booking_id": 1, "status": "PENDING"},
+        {"payment_id": "x", "status": "APPROVED"},
+    ])
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [r["result"] for r in results] == ["ok", "ignored", "ok", "duplicate", "invalid"]
+    assert {e["loc"][0] for e in results[4]["error"]} == {"payment_id", "booking_id"}
+    rounds = [c.args[1] for c in mock_cursor.execute.call_args_list
+              if c.args[0].startswith("EXECUTE sb_booking_payment_callbacks")]
+    assert [r[1] for r in rounds] == [[1, 2], [1]]
+    assert rounds[1][5] == ["CREATED,PENDING_PAYMENT"] and rounds[1][6] == [100.0]
+    assert mock_conn.call_count == 1
+    assert (1, "APPROVED") in seen_callbacks
+
+def test_profile_endpoints_require_admin_permission():
+    assert client.post("/admin/profile", json={"routes": ["/bookings"]}).status_code == 403
+
+    app.dependency_overrides[verify_token] = lambda: {"sub": "auth0|ops", "permissions": ["admin:profile"]}
+    try:
+        started = client.post("/admin/profile", json={"routes": ["/bookings"], "duration": 30})
+        status = client.get("/admin/profile").json()
+        stopped = client.delete("/admin/profile").json()
+        collapsed = client.get("/admin/profile/collapsed")
+    finally:
+        app.dependency_overrides[verify_token] = lambda: {"sub": "auth0|test"}
+    assert started.status_code == 200 and started.json()["routes"] == ["/bookings"]
+    assert status["active"] is True
+    assert stopped["active"] is False and stopped["session"]["routes"] == ["/bookings"]
+    assert collapsed.status_code == 200 and collapsed.headers["content-type"].startswith("text/plain")
+    # estado por processo: toda resposta diz qual worker atendeu
+    pid = os.getpid()
+    assert started.json()["pid"] == status["pid"] == stopped["pid"] == pid
+    assert collapsed.headers["X-Worker-Pid"] == str(pid)
+
+def test_ready_reports_warm_up_without_token():
+    app.dependency_overrides.pop(verify_token)
+    try:
+        starting = client.get("/ready")
+        app.state.ready = True
+        ready = client.get("/ready")
+    finally:
+        app.state.ready = False
+        app.dependency_overrides[verify_token] = lambda: {"sub": "auth0|test"}
+    assert starting.status_code == 503 and starting.headers["retry-after"] == "1"
+    assert ready.status_code == 200 and ready.json() == {"status": "ready"}